@@ -0,0 +1,259 @@
+""" Fake `zfs` executable for benchmarks.
+
+Implements the subset of the `zfs` CLI used by zfs_uploader. Datasets and
+snapshots are kept in a JSON state file. Send streams are synthetic and
+start with a small header so that `zfs receive` knows where the stream ends,
+like the real stream format.
+
+Environment variables
+---------------------
+FAKE_ZFS_STATE_DIR
+    Directory holding the state file. Required.
+FAKE_ZFS_SEND_SIZE
+    Size of full send streams in bytes. Default: 256 MiB.
+FAKE_ZFS_INC_RATIO
+    Size of incremental send streams relative to full streams. Default: 0.1.
+FAKE_ZFS_SEND_RATE
+    Send rate limit in bytes per second. Default: unlimited.
+FAKE_ZFS_RECEIVE_RATE
+    Receive rate limit in bytes per second. Default: unlimited.
+"""
+import fcntl
+import json
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'FAKEZFS1'
+BLOCK_SIZE = 1024 * 1024
+
+
+def main(argv):
+    state = State(os.environ['FAKE_ZFS_STATE_DIR'])
+    command, args = argv[0], argv[1:]
+
+    with state:
+        handler = COMMANDS.get(command)
+        if handler is None:
+            sys.stderr.write(f'fake zfs: unsupported command {command}\n')
+            return 1
+        return handler(state, args) or 0
+
+
+class State:
+    """ Datasets and snapshots stored in a JSON file. """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._path = os.path.join(directory, 'state.json')
+        self._lock = open(os.path.join(directory, 'state.lock'), 'w')
+        self.filesystems = {}
+
+    def __enter__(self):
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            with open(self._path) as f:
+                self.filesystems = json.load(f)
+        except FileNotFoundError:
+            self.filesystems = {}
+        return self
+
+    def __exit__(self, *args):
+        with open(self._path, 'w') as f:
+            json.dump(self.filesystems, f)
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def unlock(self):
+        """ Save state and release the lock during long running I/O. """
+        self.__exit__()
+
+    def relock(self):
+        self.__enter__()
+
+    def snapshots(self, filesystem):
+        return self.filesystems.get(filesystem, [])
+
+    def descendants(self, filesystem):
+        return sorted(name for name in self.filesystems
+                      if name == filesystem or
+                      name.startswith(f'{filesystem}/'))
+
+
+def zfs_list(state, args):
+    if 'snapshot' in args:
+        print('NAME USED AVAIL REFER MOUNTPOINT')
+        for filesystem, snapshots in sorted(state.filesystems.items()):
+            for snapshot in snapshots:
+                print(f'{filesystem}@{snapshot} 1024 - 1024 -')
+    else:
+        filesystem = args[-1]
+        for name in state.descendants(filesystem):
+            print(name)
+
+
+def zfs_create(state, args):
+    state.filesystems.setdefault(args[-1], [])
+
+
+def zfs_snapshot(state, args):
+    recursive = '-r' in args
+    for target in _positional(args):
+        filesystem, name = target.split('@')
+        if filesystem not in state.filesystems:
+            sys.stderr.write(f"dataset does not exist: '{filesystem}'\n")
+            return 1
+        filesystems = (state.descendants(filesystem) if recursive
+                       else [filesystem])
+        for fs in filesystems:
+            state.filesystems[fs].append(name)
+
+
+def zfs_destroy(state, args):
+    target = _positional(args)[-1]
+    if '@' in target:
+        filesystem, names = target.split('@')
+        filesystems = (state.descendants(filesystem) if '-r' in args
+                       else [filesystem])
+        for fs in filesystems:
+            for name in names.split(','):
+                if name in state.snapshots(fs):
+                    state.filesystems[fs].remove(name)
+    else:
+        for fs in state.descendants(target):
+            del state.filesystems[fs]
+
+
+def zfs_rename(state, args):
+    source, destination = _positional(args)
+    for fs in state.descendants(source):
+        state.filesystems[destination + fs[len(source):]] = \
+            state.filesystems.pop(fs)
+
+
+def zfs_rollback(state, args):
+    filesystem, name = _positional(args)[-1].split('@')
+    snapshots = state.snapshots(filesystem)
+    if name in snapshots:
+        del snapshots[snapshots.index(name) + 1:]
+
+
+def zfs_noop(state, args):
+    pass
+
+
+def zfs_get(state, args):
+    # properties are not tracked
+    print('-')
+
+
+def zfs_send(state, args):
+    positional = _positional(args)
+    filesystem, name = positional[-1].split('@')
+    snapshots = state.snapshots(filesystem)
+    if name not in snapshots:
+        sys.stderr.write(f"snapshot does not exist: '{positional[-1]}'\n")
+        return 1
+
+    size = int(os.environ.get('FAKE_ZFS_SEND_SIZE', 256 * BLOCK_SIZE))
+    if '-i' in args or '-I' in args:
+        base = positional[0].split('@')[1]
+        size = int(size * float(os.environ.get('FAKE_ZFS_INC_RATIO', 0.1)))
+        included = snapshots[snapshots.index(base) + 1:
+                             snapshots.index(name) + 1]
+        if '-i' in args:
+            included = included[-1:]
+    else:
+        included = [name]
+
+    if '--dryrun' in args or '-n' in args:
+        print(f'full\t{positional[-1]}\t{size}')
+        print(f'size\t{size}')
+        return
+
+    state.unlock()
+    header = json.dumps({'size': size, 'snapshots': included}).encode()
+    out = sys.stdout.buffer
+    out.write(MAGIC + struct.pack('>I', len(header)) + header)
+    _copy(None, out, size, os.environ.get('FAKE_ZFS_SEND_RATE'))
+    out.flush()
+    state.relock()
+
+
+def zfs_receive(state, args):
+    target = _positional(args)[-1]
+    filesystem = target.split('@')[0]
+
+    state.unlock()
+    stream = sys.stdin.buffer
+    if stream.read(len(MAGIC)) != MAGIC:
+        sys.stderr.write('cannot receive: invalid stream\n')
+        state.relock()
+        return 1
+    length, = struct.unpack('>I', stream.read(4))
+    header = json.loads(stream.read(length))
+    received = _copy(stream, None, header['size'],
+                     os.environ.get('FAKE_ZFS_RECEIVE_RATE'))
+    state.relock()
+
+    if received < header['size']:
+        sys.stderr.write('cannot receive: stream is truncated\n')
+        return 1
+
+    if '-n' in args:
+        return
+
+    snapshots = state.filesystems.setdefault(filesystem, [])
+    for name in header['snapshots']:
+        if name not in snapshots:
+            snapshots.append(name)
+
+
+def _copy(source, destination, size, rate=None):
+    """ Copy or generate size bytes, optionally limited to rate bytes/s. """
+    rate = float(rate) if rate else None
+    block = os.urandom(BLOCK_SIZE)
+    start = time.monotonic()
+    copied = 0
+
+    while copied < size:
+        amount = min(BLOCK_SIZE, size - copied)
+        if source is None:
+            data = block[:amount]
+        else:
+            data = source.read(amount)
+            if not data:
+                break
+        if destination is not None:
+            destination.write(data)
+        copied += len(data)
+
+        if rate:
+            delay = copied / rate - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    return copied
+
+
+def _positional(args):
+    return [arg for arg in args if not arg.startswith('-')]
+
+
+COMMANDS = {
+    'list': zfs_list,
+    'create': zfs_create,
+    'snapshot': zfs_snapshot,
+    'destroy': zfs_destroy,
+    'rename': zfs_rename,
+    'rollback': zfs_rollback,
+    'mount': zfs_noop,
+    'load-key': zfs_noop,
+    'get': zfs_get,
+    'send': zfs_send,
+    'receive': zfs_receive,
+}
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,369 @@
+""" End-to-end throughput benchmarks.
+
+Runs backup, restore and retention against a fake `zfs` executable and a
+local S3 stand-in. Reports MB/s, CPU time, peak RSS and S3 request counts.
+Results are appended to a JSON lines file and compared with the previous
+result of the same parameters in order to catch regressions.
+
+Usage
+-----
+python benchmarks/run.py --size 512 --rate 200
+python benchmarks/run.py --endpoint http://127.0.0.1:9000  # MinIO
+"""
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from zfs_uploader import DATETIME_FORMAT # noqa
+from zfs_uploader.job import ZFSjob # noqa
+from zfs_uploader.utils import derive_s3_key # noqa
+
+MB = 1024 * 1024
+BUCKET = 'zfsup-benchmark'
+ACCESS_KEY = 'benchmark'
+SECRET_KEY = 'benchmark'
+FILESYSTEM = 'bench/data'
+RESTORE_FILESYSTEM = 'bench/restore'
+SCENARIOS = ('backup_full', 'backup_inc', 'restore', 'retention')
+
+
+def main():
+    args = _parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        _install_fake_zfs(directory, args)
+        with _s3(args) as endpoint:
+            results = run(args, endpoint)
+
+    record = {
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+        'commit': _get_commit(),
+        'python': platform.python_version(),
+        'params': _get_params(args),
+        'results': results
+    }
+    _print_results(results)
+
+    regressions = _compare(record, args.results, args.threshold)
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    if regressions:
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        sys.exit(1)
+
+
+def run(args, endpoint):
+    """ Run benchmark scenarios.
+
+    Returns
+    -------
+    dict
+        Results keyed by scenario.
+
+    """
+    _zfs('create', 'bench')
+    _zfs('create', FILESYSTEM)
+
+    job = ZFSjob(BUCKET, *_get_credentials(), FILESYSTEM,
+                 endpoint=endpoint, max_incremental_backups_per_full=1000,
+                 buffer_size=args.buffer_size * MB if args.buffer_size
+                 else None)
+    requests = _count_requests(job)
+    scenarios = args.scenarios.split(',')
+    results = {}
+
+    size_full = args.size * MB
+    size_inc = int(size_full * args.inc_ratio)
+
+    if 'backup_full' in scenarios or 'restore' in scenarios:
+        results['backup_full'] = _measure(job.start, requests, size_full)
+
+    if 'backup_inc' in scenarios or 'restore' in scenarios:
+        # snapshot names have a one second resolution
+        time.sleep(1)
+        results['backup_inc'] = _measure(job.start, requests, size_inc)
+
+    if 'restore' in scenarios:
+        results['restore'] = _measure(
+            lambda: job.restore(filesystem=RESTORE_FILESYSTEM), requests,
+            size_full + size_inc)
+
+    if 'retention' in scenarios:
+        results['retention'] = _run_retention(args, endpoint)
+
+    return {k: v for k, v in results.items() if k in scenarios}
+
+
+def _run_retention(args, endpoint):
+    """ Prune backups and snapshots down to a quarter. """
+    filesystem = f'{FILESYSTEM}_retention'
+    _zfs('create', filesystem)
+
+    job = ZFSjob(BUCKET, *_get_credentials(), filesystem,
+                 endpoint=endpoint, max_snapshots=args.backups // 4,
+                 max_backups=args.backups // 4,
+                 max_incremental_backups_per_full=0)
+
+    start = datetime(2021, 1, 1)
+    for i in range(args.backups):
+        backup_time = (start + timedelta(hours=i)).strftime(DATETIME_FORMAT)
+        s3_key = derive_s3_key(f'{backup_time}.full', filesystem, None)
+        _zfs('snapshot', f'{filesystem}@{backup_time}')
+        job.bucket.put_object(Key=s3_key, Body=b'z' * 1024)
+        job.backup_db.create_backup(backup_time, 'full', s3_key, None, 1024)
+    job.snapshot_db.refresh()
+
+    requests = _count_requests(job)
+
+    def prune():
+        job._limit_snapshots() # noqa
+        job._limit_backups() # noqa
+
+    result = _measure(prune, requests, 0)
+    result['backups'] = args.backups
+    result['backups_left'] = len(job.backup_db.get_backups())
+    return result
+
+
+def _measure(func, requests, size):
+    requests.clear()
+    self_0 = resource.getrusage(resource.RUSAGE_SELF)
+    children_0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    time_0 = time.monotonic()
+
+    func()
+
+    wall = time.monotonic() - time_0
+    self_1 = resource.getrusage(resource.RUSAGE_SELF)
+    children_1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        'seconds': round(wall, 3),
+        'mb_per_s': round(size / MB / wall, 1) if size else None,
+        'cpu_seconds': round(_cpu(self_1) - _cpu(self_0), 3),
+        'cpu_children_seconds': round(_cpu(children_1) - _cpu(children_0),
+                                      3),
+        # process high water mark
+        'peak_rss_mb': round(self_1.ru_maxrss / 1024, 1),
+        'requests': dict(requests),
+        'requests_total': sum(requests.values())
+    }
+
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def _count_requests(job):
+    requests = Counter()
+
+    def request_created(operation_name, **kwargs):
+        requests[operation_name] += 1
+
+    job.s3.meta.client.meta.events.register('request-created.s3',
+                                            request_created)
+    return requests
+
+
+def _install_fake_zfs(directory, args):
+    bin_dir = os.path.join(directory, 'bin')
+    os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, 'zfs')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n'
+                f'exec "{sys.executable}" '
+                f'"{os.path.join(BENCHMARK_DIR, "fake_zfs.py")}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    os.environ['PATH'] = f'{bin_dir}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['FAKE_ZFS_STATE_DIR'] = os.path.join(directory, 'state')
+    os.environ['FAKE_ZFS_SEND_SIZE'] = str(args.size * MB)
+    os.environ['FAKE_ZFS_INC_RATIO'] = str(args.inc_ratio)
+    if args.rate:
+        os.environ['FAKE_ZFS_SEND_RATE'] = str(args.rate * MB)
+        os.environ['FAKE_ZFS_RECEIVE_RATE'] = str(args.rate * MB)
+
+
+@contextmanager
+def _s3(args):
+    """ Start the S3 stand-in and create the bucket. Yields the endpoint. """
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', ACCESS_KEY)
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', SECRET_KEY)
+
+    if args.endpoint:
+        _create_bucket(args.endpoint)
+        yield args.endpoint
+
+    elif args.s3 == 'moto-server':
+        from moto.server import ThreadedMotoServer
+
+        port = _get_free_port()
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                    verbose=False)
+        server.start()
+        endpoint = f'http://127.0.0.1:{port}'
+        try:
+            _create_bucket(endpoint)
+            yield endpoint
+        finally:
+            server.stop()
+
+    else:
+        try:
+            from moto import mock_aws
+        except ImportError:
+            from moto import mock_s3 as mock_aws
+
+        with mock_aws():
+            _create_bucket(None)
+            yield None
+
+
+def _create_bucket(endpoint):
+    import boto3
+
+    access_key, secret_key = _get_credentials()
+    s3 = boto3.resource('s3', region_name='us-east-1',
+                        aws_access_key_id=access_key,
+                        aws_secret_access_key=secret_key,
+                        endpoint_url=endpoint)
+    s3.create_bucket(Bucket=BUCKET)
+
+
+def _get_credentials():
+    return (os.environ['AWS_ACCESS_KEY_ID'],
+            os.environ['AWS_SECRET_ACCESS_KEY'])
+
+
+def _get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _zfs(*args):
+    out = subprocess.run(['zfs'] + list(args), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, encoding='utf-8')
+    if out.returncode:
+        raise RuntimeError(out.stderr)
+
+
+def _get_commit():
+    out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         encoding='utf-8', cwd=BENCHMARK_DIR)
+    return out.stdout.strip() or None
+
+
+def _get_params(args):
+    return {
+        's3': 'endpoint' if args.endpoint else args.s3,
+        'size_mb': args.size,
+        'inc_ratio': args.inc_ratio,
+        'rate_mb_per_s': args.rate,
+        'buffer_size_mb': args.buffer_size,
+        'backups': args.backups
+    }
+
+
+def _compare(record, results_path, threshold):
+    """ Compare throughput with the previous result of the same params. """
+    previous = None
+    try:
+        with open(results_path) as f:
+            for line in f:
+                r = json.loads(line)
+                if r['params'] == record['params']:
+                    previous = r
+    except FileNotFoundError:
+        pass
+
+    if previous is None:
+        return []
+
+    regressions = []
+    for scenario, result in record['results'].items():
+        before = previous['results'].get(scenario)
+        if not before:
+            continue
+
+        if result['mb_per_s'] and before['mb_per_s']:
+            change = result['mb_per_s'] / before['mb_per_s'] - 1
+            if change < -threshold:
+                regressions.append(
+                    f'{scenario} {before["mb_per_s"]} -> '
+                    f'{result["mb_per_s"]} MB/s ({change:.0%}) since '
+                    f'{previous["commit"]}')
+        elif result['seconds'] > before['seconds'] * (1 + threshold):
+            regressions.append(
+                f'{scenario} {before["seconds"]} -> {result["seconds"]} s '
+                f'since {previous["commit"]}')
+
+    return regressions
+
+
+def _print_results(results):
+    print(f'{"scenario":<12} {"seconds":>8} {"MB/s":>8} {"cpu s":>8} '
+          f'{"child s":>8} {"rss MB":>8} {"requests":>8}')
+    print('-' * 68)
+    for scenario, r in results.items():
+        mb_per_s = r['mb_per_s'] if r['mb_per_s'] is not None else '-'
+        print(f'{scenario:<12} {r["seconds"]:>8} {mb_per_s:>8} '
+              f'{r["cpu_seconds"]:>8} {r["cpu_children_seconds"]:>8} '
+              f'{r["peak_rss_mb"]:>8} {r["requests_total"]:>8}')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--s3', choices=('moto-server', 'moto-mock'),
+                        default='moto-server',
+                        help='Local S3 stand-in. moto-mock skips HTTP.')
+    parser.add_argument('--endpoint',
+                        help='S3 compatible endpoint such as MinIO. '
+                             'Credentials are read from AWS_ACCESS_KEY_ID '
+                             'and AWS_SECRET_ACCESS_KEY.')
+    parser.add_argument('--size', type=int, default=256,
+                        help='Full send stream size in MiB.')
+    parser.add_argument('--inc-ratio', type=float, default=0.1,
+                        help='Incremental stream size relative to full.')
+    parser.add_argument('--rate', type=int, default=0,
+                        help='Send and receive rate limit in MiB/s.')
+    parser.add_argument('--buffer-size', type=int,
+                        help='Ring buffer size in MiB.')
+    parser.add_argument('--backups', type=int, default=100,
+                        help='Number of backups for the retention scenario.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated scenarios.')
+    parser.add_argument('--results',
+                        default=os.path.join(BENCHMARK_DIR, 'results.jsonl'),
+                        help='Results history file.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed throughput drop before failing.')
+    parser.add_argument('--no-save', action='store_true',
+                        help='Do not append results to the history file.')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import unittest
+import warnings
+
+from apscheduler.triggers.cron import CronTrigger
+
+from zfs_uploader.aio import AsyncRuntime, get_next_fire_time, read_part
+from zfs_uploader.config import Config
+from zfs_uploader.zfs import create_filesystem, destroy_filesystem
+
+
+class ReadPartTests(unittest.TestCase):
+    def test_read_part(self):
+        """ Read full parts and a short last part. """
+        # Given
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        stream = asyncio.StreamReader(loop=loop)
+        stream.feed_data(b'a' * 10)
+        stream.feed_eof()
+
+        # When
+        parts = [loop.run_until_complete(read_part(stream, 4))
+                 for _ in range(4)]
+
+        # Then
+        self.assertEqual([b'aaaa', b'aaaa', b'aa', b''], parts)
+
+
+class GetNextFireTimeTests(unittest.TestCase):
+    def setUp(self):
+        # Given
+        self.trigger = CronTrigger(minute='*/10', timezone=timezone.utc)
+        self.start = datetime(2021, 1, 1, 0, 5, tzinfo=timezone.utc)
+
+    def test_next_fire_time(self):
+        """ Wait for the next fire time. """
+        # When
+        fire_time, previous = get_next_fire_time(self.trigger, None,
+                                                 self.start)
+
+        # Then
+        self.assertEqual(self.start + timedelta(minutes=5), fire_time)
+        self.assertEqual(fire_time, previous)
+
+    def test_coalesce_missed_fire_times(self):
+        """ Run missed fire times once right away. """
+        # Given
+        previous = self.start + timedelta(minutes=5)
+        now = self.start + timedelta(minutes=37)
+
+        # When
+        fire_time, previous = get_next_fire_time(self.trigger, previous, now)
+        next_fire_time, _ = get_next_fire_time(self.trigger, previous, now)
+
+        # Then
+        self.assertEqual(self.start + timedelta(minutes=15), fire_time)
+        self.assertEqual(self.start + timedelta(minutes=45), next_fire_time)
+
+
+class AsyncRuntimeTests(unittest.TestCase):
+    def setUp(self):
+        try:
+            import aiobotocore # noqa
+        except ImportError:
+            self.skipTest('aiobotocore is not installed.')
+
+        warnings.filterwarnings("ignore", category=ResourceWarning,
+                                message="unclosed.*<ssl.SSLSocket.*>")
+
+        config = Config('config.cfg')
+        self.job = next(iter(config.jobs.values()))
+        self.job._cron = None
+
+        out = create_filesystem(self.job.filesystem)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+
+    def tearDown(self):
+        out = destroy_filesystem(self.job.filesystem)
+        if out.returncode:
+            self.assertIn('dataset does not exist', out.stderr)
+
+        for item in self.job.bucket.objects.all():
+            item.delete()
+
+    def test_run(self):
+        """ Test full and incremental backups on the event loop. """
+        # When
+        AsyncRuntime([self.job]).run()
+        AsyncRuntime([self.job]).run()
+
+        # Then
+        backups = self.job.backup_db.get_backups()
+        self.assertEqual(['full', 'inc'], [b.backup_type for b in backups])
+        for backup in backups:
+            verification = self.job.verify_backup(backup)
+            self.assertEqual('passed', verification.status)
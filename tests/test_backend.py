@@ -0,0 +1,138 @@
+import unittest
+
+from zfs_uploader.backend import (ChannelProgramBackend, CLIBackend,
+                                  get_backend, LibZFSCoreBackend)
+from zfs_uploader.config import Config
+from zfs_uploader.zfs import (create_filesystem, destroy_filesystem,
+                              list_snapshots, ZFSError)
+
+
+class GetBackendTests(unittest.TestCase):
+    def test_get_backend_default(self):
+        """ Get CLI backend by default. """
+        # When
+        backend = get_backend()
+
+        # Then
+        self.assertIsInstance(backend, CLIBackend)
+        self.assertIs(backend, get_backend('cli'))
+
+    def test_get_backend_unknown(self):
+        """ Raise error for unknown backend. """
+        # When / Then
+        with self.assertRaises(ValueError):
+            get_backend('unknown')
+
+    def test_get_backend_fallback(self):
+        """ Fall back to CLI backend if pyzfs is not installed. """
+        try:
+            import libzfs_core # noqa
+            self.skipTest('pyzfs is installed.')
+        except ImportError:
+            pass
+
+        # When
+        backend = get_backend('libzfs_core')
+
+        # Then
+        self.assertIsInstance(backend, CLIBackend)
+
+
+class BackendTestsMixin:
+    def create_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        # Given
+        config = Config('config.cfg')
+        job = next(iter(config.jobs.values()))
+        self.filesystem = job.filesystem
+        self.child = f'{self.filesystem}/child'
+        self.backend = self.create_backend()
+
+        out = create_filesystem(self.filesystem)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+        out = create_filesystem(self.child)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+
+    def tearDown(self):
+        out = destroy_filesystem(self.filesystem)
+        if out.returncode:
+            self.assertIn('dataset does not exist', out.stderr)
+
+    def test_list_filesystems(self):
+        """ List filesystem and descendants. """
+        # When
+        filesystems = self.backend.list_filesystems(self.filesystem)
+
+        # Then
+        self.assertEqual([self.filesystem, self.child], filesystems)
+
+    def test_create_snapshots(self):
+        """ Create snapshots and list them in creation order. """
+        # When
+        self.backend.create_snapshots([self.filesystem], 'snap_1')
+        self.backend.create_snapshots([self.filesystem], 'snap_2')
+
+        # Then
+        snapshots = self.backend.list_snapshots([self.filesystem])
+        self.assertEqual([f'{self.filesystem}@snap_1',
+                          f'{self.filesystem}@snap_2'], list(snapshots))
+        expected = list_snapshots()[f'{self.filesystem}@snap_1']
+        for prop in ('USED', 'REFER'):
+            self.assertEqual(expected[prop],
+                             snapshots[f'{self.filesystem}@snap_1'][prop])
+
+    def test_create_snapshots_recursive(self):
+        """ Create snapshots of filesystem and descendants. """
+        # When
+        self.backend.create_snapshots([self.filesystem], 'snap_1',
+                                      recursive=True)
+
+        # Then
+        snapshots = self.backend.list_snapshots([self.filesystem,
+                                                 self.child])
+        self.assertIn(f'{self.filesystem}@snap_1', snapshots)
+        self.assertIn(f'{self.child}@snap_1', snapshots)
+
+    def test_create_snapshots_error(self):
+        """ Raise ZFSError if filesystem does not exist. """
+        # When / Then
+        with self.assertRaises(ZFSError):
+            self.backend.create_snapshots([f'{self.filesystem}/missing'],
+                                          'snap_1')
+
+    def test_destroy_snapshots(self):
+        """ Destroy multiple snapshots with one call. """
+        # Given
+        for name in ('snap_1', 'snap_2', 'snap_3'):
+            self.backend.create_snapshots([self.filesystem], name,
+                                          recursive=True)
+
+        # When
+        self.backend.destroy_snapshots(self.filesystem, ['snap_1', 'snap_2'],
+                                       recursive=True)
+
+        # Then
+        snapshots = self.backend.list_snapshots([self.filesystem,
+                                                 self.child])
+        self.assertEqual([f'{self.filesystem}@snap_3',
+                          f'{self.child}@snap_3'], sorted(snapshots))
+
+
+class CLIBackendTests(BackendTestsMixin, unittest.TestCase):
+    def create_backend(self):
+        return CLIBackend()
+
+
+class LibZFSCoreBackendTests(BackendTestsMixin, unittest.TestCase):
+    def create_backend(self):
+        try:
+            return LibZFSCoreBackend()
+        except ImportError:
+            self.skipTest('pyzfs is not installed.')
+
+
+class ChannelProgramBackendTests(BackendTestsMixin, unittest.TestCase):
+    def create_backend(self):
+        return ChannelProgramBackend()
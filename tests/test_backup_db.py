@@ -1,11 +1,26 @@
+import json
 import unittest
 import warnings
 
 from zfs_uploader.config import Config
-from zfs_uploader.backup_db import BackupDB
+from zfs_uploader.backup_db import (_json_default, _json_object_hook, # noqa
+                                    Backup, BackupDB, BackupDBConflictError,
+                                    Verification)
 from zfs_uploader.utils import derive_s3_key
 
 
+class CommittedHeadBackupDB(BackupDB):
+    """ Fails after writing the head index like a timed out request. """
+    fail = False
+
+    def _put_head(self, body):
+        super()._put_head(body)
+        if self.fail:
+            self.fail = False
+            raise BackupDBConflictError('backup.db was changed by another '
+                                        'node.')
+
+
 class BackupDBTests(unittest.TestCase):
     def setUp(self):
         warnings.filterwarnings("ignore", category=ResourceWarning,
@@ -122,3 +137,280 @@ class BackupDBTests(unittest.TestCase):
         # Then
         self.assertRaises(ValueError, backup_db.create_backup, backup_time,
                           backup_type, s3_key, dependency)
+
+    def test_get_restore_point(self):
+        """ Test getting the most recent backup at or before a time. """
+        # Given
+        backup_db = BackupDB(self.bucket, self.filesystem, self.prefix)
+        backups = [('20210425_201838', 'full', None, 100),
+                   ('20210426_201838', 'inc', '20210425_201838', 10),
+                   ('20210427_201838', 'inc', '20210426_201838', 20)]
+
+        for backup_time, backup_type, dependency, backup_size in backups:
+            object_name = f'{backup_time}.{backup_type}'
+            s3_key = derive_s3_key(object_name, self.filesystem, self.prefix)
+            backup_db.create_backup(backup_time, backup_type, s3_key,
+                                    dependency, backup_size)
+
+        # Then
+        self.assertEqual('20210427_201838', backup_db.get_restore_point())
+        self.assertEqual('20210426_201838',
+                         backup_db.get_restore_point('20210427_000000'))
+        self.assertIsNone(backup_db.get_restore_point('20210101_000000'))
+        self.assertEqual(110,
+                         backup_db.get_restore_size('20210426_201838'))
+
+    def test_set_verifications(self):
+        """ Test recording verification results in backup.db. """
+        # Given
+        backup_db = BackupDB(self.bucket, self.filesystem, self.prefix)
+        backup_time = '20210425_201838'
+        backup_type = 'full'
+
+        object_name = f'{backup_time}.{backup_type}'
+        s3_key = derive_s3_key(object_name, self.filesystem, self.prefix)
+        backup_db.create_backup(backup_time, backup_type, s3_key,
+                                backup_size=100, checksum='abc')
+
+        verification = Verification(backup_time, self.filesystem,
+                                    '20210426_201838', 'failed', 'parse',
+                                    100, 'def', 'Checksum does not match.')
+
+        # When
+        backup_db.set_verifications([verification])
+
+        # Then
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+        backup = backup_db_new.get_backup(backup_time)
+        self.assertEqual('abc', backup.checksum)
+        self.assertEqual('failed', backup.verification.status)
+        self.assertEqual('parse', backup.verification.structure)
+        self.assertEqual('Checksum does not match.',
+                         backup.verification.error)
+
+    def test_send_profile(self):
+        """ Test recording the send profile of a backup. """
+        # Given
+        backup_db = BackupDB(self.bucket, self.filesystem, self.prefix)
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+
+        # When
+        backup_db.create_backup('20210425_201838', 'full', s3_key)
+        backup_db.create_backup('20210426_201838', 'full', s3_key,
+                                send_profile='compressed')
+
+        # Then
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+        self.assertEqual(['raw', 'compressed'],
+                         [b.send_profile for b in
+                          backup_db_new.get_backups()])
+
+    def test_concurrent_changes(self):
+        """ Test merging changes of two nodes into backup.db. """
+        # Given
+        backup_db_a = BackupDB(self.bucket, self.filesystem, self.prefix)
+        backup_db_b = BackupDB(self.bucket, self.filesystem, self.prefix)
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+        backup_db_a.create_backup('20210425_201838', 'full', s3_key)
+        backup_db_b.get_backups()
+
+        # When
+        backup_db_a.create_backup('20210426_201838', 'inc', s3_key,
+                                  '20210425_201838')
+        backup_db_b.create_backup('20210427_201838', 'inc', s3_key,
+                                  '20210425_201838')
+
+        # Then
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+        self.assertEqual(['20210425_201838', '20210426_201838',
+                          '20210427_201838'],
+                         backup_db_new.get_backup_times())
+
+    def test_upload_conflict(self):
+        """ Test that a stale backup.db is not uploaded. """
+        # Given
+        backup_db_a = BackupDB(self.bucket, self.filesystem, self.prefix)
+        backup_db_b = BackupDB(self.bucket, self.filesystem, self.prefix)
+        backup_db_b.get_backups()
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+        backup_db_a.create_backup('20210425_201838', 'full', s3_key)
+
+        # Then
+        self.assertRaises(BackupDBConflictError, backup_db_b.upload)
+
+    def test_sharded_backup_db(self):
+        """ Test splitting backup.db into monthly shards. """
+        # Given
+        backup_db = BackupDB(self.bucket, self.filesystem, self.prefix,
+                             shard=True)
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+        backup_db.create_backup('20210425_201838', 'full', s3_key)
+        backup_db.create_backup('20210526_201838', 'inc', s3_key,
+                                '20210425_201838')
+        backup_db.create_backup('20210627_201838', 'full', s3_key)
+
+        # When
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+        backup = backup_db_new.get_latest_backup('full')
+
+        # Then
+        self.assertTrue(backup_db_new.sharded)
+        self.assertEqual('20210627_201838', backup.backup_time)
+        self.assertEqual({'202106'}, backup_db_new._loaded) # noqa
+        self.assertEqual({'202104': {'count': 1,
+                                     'last_full': '20210425_201838'},
+                          '202105': {'count': 1, 'last_full': None},
+                          '202106': {'count': 1,
+                                     'last_full': '20210627_201838'}},
+                         backup_db_new.get_shards())
+        backups = backup_db_new.get_backups(months=['202105'])
+        self.assertEqual(['20210526_201838'],
+                         [b.backup_time for b in backups])
+        self.assertEqual({'202105', '202106'}, backup_db_new._loaded) # noqa
+        self.assertEqual(['20210425_201838', '20210526_201838',
+                          '20210627_201838'],
+                         backup_db_new.get_backup_times())
+        chain = backup_db_new.get_chain('20210526_201838')
+        self.assertEqual(['20210425_201838', '20210526_201838'],
+                         [b.backup_time for b in chain])
+
+    def test_shard_existing_backup_db(self):
+        """ Test migrating backup.db to shards and deleting old shards. """
+        # Given
+        backup_db = BackupDB(self.bucket, self.filesystem, self.prefix)
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+        backup_db.create_backup('20210425_201838', 'full', s3_key)
+        backup_db.create_backup('20210526_201838', 'full', s3_key)
+
+        # When
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix,
+                                 shard=True)
+        backup_db_new.delete_backup('20210425_201838')
+
+        # Then
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+        self.assertTrue(backup_db_new.sharded)
+        self.assertEqual(['20210526_201838'],
+                         backup_db_new.get_backup_times())
+        shard_key = derive_s3_key('backup.db.202105', self.filesystem,
+                                  self.prefix)
+        keys = [item.key for item in self.bucket.objects.all()
+                if item.key.startswith(derive_s3_key('backup.db.',
+                                                     self.filesystem,
+                                                     self.prefix))]
+        self.assertEqual(1, len(keys))
+        self.assertTrue(keys[0].startswith(shard_key))
+
+    def test_concurrent_sharded_changes(self):
+        """ Test merging changes of two nodes into a sharded backup.db. """
+        # Given
+        backup_db_a = BackupDB(self.bucket, self.filesystem, self.prefix,
+                               shard=True)
+        backup_db_b = BackupDB(self.bucket, self.filesystem, self.prefix,
+                               shard=True)
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+        backup_db_a.create_backup('20210425_201838', 'full', s3_key)
+        backup_db_b.get_backups()
+
+        # When
+        backup_db_a.create_backup('20210526_201838', 'inc', s3_key,
+                                  '20210425_201838')
+        backup_db_b.create_backup('20210527_201838', 'inc', s3_key,
+                                  '20210425_201838')
+
+        # Then
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+        self.assertEqual(['20210425_201838', '20210526_201838',
+                          '20210527_201838'],
+                         backup_db_new.get_backup_times())
+
+    def test_sharded_head_committed_on_error(self):
+        """ Test keeping shards of a head index written despite an error. """
+        # Given
+        backup_db = CommittedHeadBackupDB(self.bucket, self.filesystem,
+                                          self.prefix, shard=True)
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+        backup_db.create_backup('20210425_201838', 'full', s3_key)
+        backup_db.fail = True
+
+        # When
+        with self.assertRaises(BackupDBConflictError):
+            backup_db.upload()
+
+        # Then
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+        self.assertEqual(['20210425_201838'],
+                         backup_db_new.get_backup_times())
+
+    def test_delete_orphaned_shards(self):
+        """ Test deleting shards the head index doesn't reference. """
+        # Given
+        backup_db = CommittedHeadBackupDB(self.bucket, self.filesystem,
+                                          self.prefix, shard=True)
+        s3_key = derive_s3_key('20210425_201838.full', self.filesystem,
+                               self.prefix)
+        backup_db.create_backup('20210425_201838', 'full', s3_key)
+        backup_db.fail = True
+        with self.assertRaises(BackupDBConflictError):
+            backup_db.upload()
+        backup_db_new = BackupDB(self.bucket, self.filesystem, self.prefix)
+
+        # When
+        recent = backup_db_new.delete_orphaned_shards()
+        orphans = backup_db_new.delete_orphaned_shards(min_age=0)
+
+        # Then
+        self.assertEqual([], recent)
+        self.assertEqual(1, len(orphans))
+        keys = [item.key for item in self.bucket.objects.all()
+                if item.key.startswith(derive_s3_key('backup.db.',
+                                                     self.filesystem,
+                                                     self.prefix))]
+        self.assertEqual(1, len(keys))
+        self.assertNotIn(keys[0], orphans)
+        self.assertEqual(['20210425_201838'],
+                         backup_db_new.get_backup_times())
+
+
+class BackupSerializationTests(unittest.TestCase):
+    def test_optional_keys_omitted(self):
+        """ Test that unset optional keys aren't written. """
+        # Given
+        backup = Backup('20210425_201838', 'full', 'pool/fs',
+                        'pool/fs/20210425_201838.full')
+
+        # When
+        dct = json.loads(json.dumps(backup, default=_json_default))
+
+        # Then
+        self.assertEqual({'_type', 'backup_time', 'backup_type',
+                          'filesystem', 's3_key', 'dependency',
+                          'backup_size'}, set(dct))
+
+    def test_unknown_keys_ignored(self):
+        """ Test reading a record written by a newer version. """
+        # Given
+        backup = Backup('20210425_201838', 'full', 'pool/fs',
+                        'pool/fs/20210425_201838.full', checksum='abc',
+                        verification=Verification('20210425_201838',
+                                                  'pool/fs',
+                                                  '20210426_000000', 'passed'))
+        dct = json.loads(json.dumps(backup, default=_json_default))
+        dct['future_key'] = 1
+        dct['verification']['future_key'] = 2
+
+        # When
+        backup_new = json.loads(json.dumps(dct),
+                                object_hook=_json_object_hook)
+
+        # Then
+        self.assertEqual(backup, backup_new)
+        self.assertEqual('abc', backup_new.checksum)
+        self.assertEqual('passed', backup_new.verification.status)
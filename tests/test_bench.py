@@ -0,0 +1,72 @@
+import unittest
+
+from zfs_uploader.bench import measure_s3, recommend, S3Result
+from zfs_uploader.config import Config
+
+MB = 1024 * 1024
+
+
+class RecommendTests(unittest.TestCase):
+    def setUp(self):
+        # Given
+        self.results = [
+            S3Result(8 * MB, 4, 40 * MB, 80 * MB),
+            S3Result(8 * MB, 10, 99 * MB, 150 * MB),
+            S3Result(16 * MB, 10, 100 * MB, 160 * MB),
+            S3Result(16 * MB, 20, 100 * MB, 170 * MB)
+        ]
+
+    def test_recommend_s3_bottleneck(self):
+        """ Recommend least concurrency and smallest parts of fastest. """
+        # When
+        rec = recommend(200 * MB, self.results)
+
+        # Then
+        self.assertEqual('S3 upload', rec.bottleneck)
+        self.assertEqual(10, rec.settings['max_concurrency'])
+        self.assertEqual(8 * MB, rec.settings['min_part_size'])
+        self.assertEqual(80 * MB, rec.settings['buffer_size'])
+        self.assertEqual(99 * MB, rec.expected_speed)
+
+    def test_recommend_send_bottleneck(self):
+        """ Report zfs send as bottleneck if slower than the upload. """
+        # When
+        rec = recommend(50 * MB, self.results)
+
+        # Then
+        self.assertEqual('zfs send', rec.bottleneck)
+        self.assertEqual(50 * MB, rec.expected_speed)
+
+    def test_recommend_max_multipart_parts(self):
+        """ Recommend more parts if the part size would grow. """
+        # When
+        rec = recommend(None, self.results, send_size=10_000 * MB,
+                        max_multipart_parts=1000)
+
+        # Then
+        self.assertEqual(1350, rec.settings['max_multipart_parts'])
+
+
+class MeasureS3Tests(unittest.TestCase):
+    def setUp(self):
+        # Given
+        config = Config('config.cfg')
+        self.job = next(iter(config.jobs.values()))
+        self.bucket = self.job.bucket
+
+    def test_measure_s3(self):
+        """ Measure every setting and delete temporary objects. """
+        # When
+        results = measure_s3(self.bucket, self.job.filesystem,
+                             size=16 * MB, part_sizes=[5 * MB, 8 * MB],
+                             concurrencies=[2, 4])
+
+        # Then
+        self.assertEqual(4, len(results))
+        for r in results:
+            self.assertGreater(r.upload_speed, 0)
+            self.assertGreater(r.download_speed, 0)
+
+        prefix = f'{self.job.filesystem}/zfsup_bench_'
+        objects = list(self.bucket.objects.filter(Prefix=prefix))
+        self.assertEqual([], objects)
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+
+from zfs_uploader.backup_db import Backup, Verification
+from zfs_uploader.catalog import Catalog
+
+
+def _backup(filesystem, backup_time, dependency=None, backup_size=100,
+            verification=None):
+    backup_type = 'inc' if dependency else 'full'
+    return Backup(backup_time, backup_type, filesystem,
+                  f'{filesystem}/{backup_time}.{backup_type}', dependency,
+                  backup_size, verification=verification,
+                  storage_class='STANDARD')
+
+
+class CatalogTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'sub', 'catalog.db')
+        self.catalog = Catalog(path)
+
+        # Given
+        verification = Verification('20210102_000000', 'pool/a',
+                                    '20210103_000000', 'passed')
+        self.catalog.update_filesystem('pool/a', [
+            _backup('pool/a', '20210101_000000', backup_size=1000),
+            _backup('pool/a', '20210102_000000', '20210101_000000',
+                    verification=verification)
+        ], '"etag-a"')
+        self.catalog.update_filesystem('pool/b', [
+            _backup('pool/b', '20210105_000000', backup_size=2000)
+        ], '"etag-b"')
+        self.catalog.update_filesystem('pool/c', [])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_backups(self):
+        """ Test listing all backups sorted by filesystem and time. """
+        # When
+        backups = self.catalog.get_backups()
+
+        # Then
+        self.assertEqual([('pool/a', '20210101_000000'),
+                          ('pool/a', '20210102_000000'),
+                          ('pool/b', '20210105_000000')],
+                         [(b['filesystem'], b['backup_time'])
+                          for b in backups])
+        self.assertEqual('passed', backups[1]['verify_status'])
+        self.assertEqual('STANDARD', backups[0]['storage_class'])
+        self.assertFalse(backups[0]['recursive'])
+
+    def test_get_backups_filters(self):
+        """ Test filtering backups by filesystem, time, type and size. """
+        # Then
+        self.assertEqual(
+            ['20210102_000000'],
+            [b['backup_time'] for b in
+             self.catalog.get_backups(filesystems=['pool/a'],
+                                      backup_type='inc')])
+        self.assertEqual(
+            ['20210102_000000', '20210105_000000'],
+            [b['backup_time'] for b in
+             self.catalog.get_backups(since='20210102_000000')])
+        self.assertEqual(
+            ['20210101_000000'],
+            [b['backup_time'] for b in
+             self.catalog.get_backups(until='20210104_000000',
+                                      min_size=500)])
+        self.assertEqual(
+            ['20210101_000000', '20210105_000000'],
+            [b['backup_time'] for b in
+             self.catalog.get_backups(min_size=500, max_size=5000)])
+
+    def test_update_filesystem(self):
+        """ Test replacing the backups of a filesystem. """
+        # When
+        self.catalog.update_filesystem('pool/a', [
+            _backup('pool/a', '20210106_000000')
+        ], '"etag-a2"')
+
+        # Then
+        backups = self.catalog.get_backups(filesystems=['pool/a'])
+        self.assertEqual(['20210106_000000'],
+                         [b['backup_time'] for b in backups])
+        self.assertEqual('"etag-a2"', self.catalog.get_etag('pool/a'))
+
+    def test_get_last_backup_times(self):
+        """ Test getting the most recent backup of each filesystem. """
+        # When
+        last_backup_times = self.catalog.get_last_backup_times()
+
+        # Then
+        self.assertEqual({'pool/a': '20210102_000000',
+                          'pool/b': '20210105_000000',
+                          'pool/c': None}, last_backup_times)
+
+    def test_remove_filesystem(self):
+        """ Test removing a filesystem. """
+        # When
+        self.catalog.remove_filesystem('pool/b')
+
+        # Then
+        self.assertEqual(['pool/a', 'pool/c'],
+                         self.catalog.get_filesystems())
+        self.assertIsNone(self.catalog.get_etag('pool/b'))
+
+    def test_compact(self):
+        """ Test removing filesystems that are no longer configured. """
+        # When
+        self.catalog.compact(['pool/a', 'pool/c'])
+
+        # Then
+        self.assertEqual(['pool/a', 'pool/c'],
+                         self.catalog.get_filesystems())
+        self.assertEqual(2, len(self.catalog.get_backups()))
@@ -0,0 +1,48 @@
+from configparser import ConfigParser
+import os
+import tempfile
+import unittest
+
+from zfs_uploader.config import Config
+
+
+class ConfigTests(unittest.TestCase):
+    def setUp(self):
+        config = Config('config.cfg')
+        filesystem = next(iter(config.jobs))
+        self.a = f'{filesystem}-a'
+        self.b = f'{filesystem}-b'
+
+        self.cfg = ConfigParser()
+        self.cfg.read('config.cfg')
+        for section in self.cfg.sections():
+            self.cfg.remove_section(section)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, 'config.cfg')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_boolean_override(self):
+        """ Test overriding boolean options of the DEFAULT section. """
+        # Given
+        options = ('recursive', 'send_intermediate', 'verify_backups',
+                   'shard_backup_db')
+        for option in options:
+            self.cfg['DEFAULT'][option] = 'true'
+        self.cfg[self.a] = {option: 'false' for option in options}
+        self.cfg[self.b] = {}
+        with open(self.file_path, 'w') as f:
+            self.cfg.write(f)
+
+        # When
+        config = Config(self.file_path)
+
+        # Then
+        for filesystem, expected in ((self.a, False), (self.b, True)):
+            job = config.jobs[filesystem]
+            self.assertEqual(expected, job.recursive)
+            self.assertEqual(expected, job.send_intermediate)
+            self.assertEqual(expected, job.verify_backups)
+            self.assertEqual(expected, job.backup_db._shard) # noqa
@@ -0,0 +1,177 @@
+from configparser import ConfigParser
+import os
+import tempfile
+import unittest
+
+from zfs_uploader.config import Config
+from zfs_uploader.daemon import Daemon, RELOAD_JOB_ID
+from zfs_uploader.maintenance import MaintenanceQueue
+
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        config = Config('config.cfg')
+        filesystem = next(iter(config.jobs))
+        self.a = f'{filesystem}-a'
+        self.b = f'{filesystem}-b'
+        self.c = f'{filesystem}-c'
+
+        self.cfg = ConfigParser()
+        self.cfg.read('config.cfg')
+        for section in self.cfg.sections():
+            self.cfg.remove_section(section)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, 'config.cfg')
+        self.cfg['DEFAULT']['catalog_path'] = os.path.join(
+            self.directory.name, 'catalog.db')
+
+        # Given
+        self.cfg[self.a] = {'cron': '* * * * *', 'max_backups': '5'}
+        self.cfg[self.b] = {'cron': '* * * * *', 'max_backups': '5'}
+        self.cfg[self.c] = {'cron': '0 * * * *', 'max_backups': '5'}
+        self._write_config()
+
+        self.maintenance = MaintenanceQueue()
+        self.daemon = Daemon(Config(self.file_path), self.maintenance)
+        self.daemon.reload()
+        self.jobs = self.daemon.jobs
+
+    def tearDown(self):
+        self.maintenance.shutdown()
+        self.directory.cleanup()
+
+    def _write_config(self):
+        with open(self.file_path, 'w') as f:
+            self.cfg.write(f)
+
+    def _scheduler_jobs(self):
+        return sorted(job.id for job in self.daemon.scheduler.get_jobs())
+
+    def test_load(self):
+        """ Test grouping jobs by cron schedule. """
+        # Then
+        self.assertEqual({'* * * * *': [self.a, self.b],
+                          '0 * * * *': [self.c]}, self.daemon.schedules)
+        self.assertEqual(['* * * * *', '0 * * * *'], self._scheduler_jobs())
+
+    def test_reload_changed_job(self):
+        """ Test replacing only jobs whose options changed. """
+        # Given
+        self.cfg[self.c]['max_backups'] = '10'
+        self._write_config()
+
+        # When
+        self.daemon.reload()
+
+        # Then
+        jobs = self.daemon.jobs
+        self.assertIs(self.jobs[self.a], jobs[self.a])
+        self.assertIs(self.jobs[self.b], jobs[self.b])
+        self.assertIsNot(self.jobs[self.c], jobs[self.c])
+        self.assertEqual(10, jobs[self.c].max_backups)
+
+    def test_reload_keep_spool(self):
+        """ Test sharing the spool of a directory across reloads. """
+        # Given
+        self.cfg['DEFAULT']['spool_dir'] = os.path.join(self.directory.name,
+                                                        'spool')
+        self._write_config()
+        self.daemon.reload()
+        jobs = self.daemon.jobs
+
+        # When
+        self.cfg[self.c]['spool_max_size'] = '1000'
+        self._write_config()
+        self.daemon.reload()
+
+        # Then
+        spool = self.daemon.jobs[self.c].spool
+        self.assertIsNot(jobs[self.c], self.daemon.jobs[self.c])
+        self.assertIs(jobs[self.c].spool, spool)
+        self.assertIs(jobs[self.a].spool, spool)
+        self.assertEqual(1000, spool.max_size)
+
+    def test_reload_reschedule(self):
+        """ Test moving, adding and removing schedules. """
+        # Given
+        self.cfg[self.b]['cron'] = '30 * * * *'
+        self.cfg.remove_section(self.c)
+        self._write_config()
+
+        # When
+        self.daemon.reload()
+
+        # Then
+        self.assertEqual({'* * * * *': [self.a],
+                          '30 * * * *': [self.b]}, self.daemon.schedules)
+        self.assertEqual(['* * * * *', '30 * * * *'], self._scheduler_jobs())
+        self.assertIs(self.jobs[self.a], self.daemon.jobs[self.a])
+
+    def test_reload_running_job(self):
+        """ Test deferring changes to running jobs until they finished. """
+        # Given
+        self.cfg[self.a]['cron'] = '30 * * * *'
+        self.cfg[self.a]['max_backups'] = '10'
+        self._write_config()
+
+        # When
+        with self.jobs[self.a]._lock: # noqa
+            self.daemon.reload()
+            running_job = self.daemon.jobs[self.a]
+        retry_jobs = self._scheduler_jobs()
+        self.daemon._load_pending() # noqa
+
+        # Then
+        self.assertIn(RELOAD_JOB_ID, retry_jobs)
+        self.assertNotIn(RELOAD_JOB_ID, self._scheduler_jobs())
+        self.assertIs(self.jobs[self.a], running_job)
+        self.assertEqual(10, self.daemon.jobs[self.a].max_backups)
+        self.assertEqual([self.b], self.daemon.schedules['* * * * *'])
+        self.assertEqual([self.a], self.daemon.schedules['30 * * * *'])
+
+    def test_reload_invalid_config(self):
+        """ Test keeping the configuration if the file is invalid. """
+        # Given
+        self.cfg[self.a]['max_backups'] = '10'
+        self.cfg[self.b]['cron'] = '99 * * * *'
+        self._write_config()
+
+        # When
+        with self.assertLogs('zfs_uploader.daemon', 'ERROR'):
+            self.daemon.reload()
+
+        # Then
+        self.assertEqual(self.jobs, self.daemon.jobs)
+        self.assertEqual(['* * * * *', '0 * * * *'], self._scheduler_jobs())
+
+    def test_reload_compact_catalog(self):
+        """ Test compacting the catalog of the reloaded configuration. """
+        # Given
+        old_path = self.cfg['DEFAULT']['catalog_path']
+        new_path = os.path.join(self.directory.name, 'catalog-new.db')
+        self.cfg['DEFAULT']['catalog_path'] = new_path
+        self._write_config()
+        self.daemon.reload()
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+        # When
+        self.daemon._compact_catalog() # noqa
+
+        # Then
+        self.assertTrue(os.path.exists(new_path))
+        self.assertFalse(os.path.exists(old_path))
+
+    def test_default_catalog_path(self):
+        """ Test keeping the catalog next to the configuration file. """
+        # Given
+        del self.cfg['DEFAULT']['catalog_path']
+        self._write_config()
+
+        # When
+        config = Config(self.file_path)
+
+        # Then
+        self.assertEqual(os.path.join(self.directory.name, 'catalog.db'),
+                         config.catalog.path)
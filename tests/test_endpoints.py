@@ -0,0 +1,119 @@
+from collections import Counter
+import unittest
+
+import botocore.session
+from botocore.awsrequest import AWSResponse
+
+from zfs_uploader.endpoints import (ENDPOINT_EJECT_INTERVAL,
+                                    ENDPOINT_MAX_FAILURES, EndpointPool)
+
+A = 'http://gateway-a:9000'
+B = 'http://gateway-b:9000'
+C = 'http://gateway-c:9000'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRaw:
+    def stream(self, **kwargs):
+        yield b''
+
+
+class EndpointPoolTests(unittest.TestCase):
+    def setUp(self):
+        # Given
+        self.clock = FakeClock()
+        self.pool = EndpointPool([A, B, C], clock=self.clock)
+
+    def test_round_robin(self):
+        """ Distribute requests evenly across unmeasured endpoints. """
+        # When
+        urls = [self.pool.choose() for _ in range(6)]
+
+        # Then
+        self.assertEqual([A, B, C, A, B, C], urls)
+
+    def test_latency_weighted(self):
+        """ Send more requests to faster endpoints. """
+        # Given
+        for url, latency in [(A, 1), (B, 2), (C, 2)]:
+            self.pool.record(url, latency)
+
+        # When
+        counts = Counter(self.pool.choose() for _ in range(40))
+
+        # Then
+        self.assertEqual({A: 20, B: 10, C: 10}, counts)
+
+    def test_eject_failing_endpoint(self):
+        """ Skip a failing endpoint until it is readmitted. """
+        # Given
+        with self.assertLogs('zfs_uploader.endpoints', 'WARNING'):
+            for _ in range(ENDPOINT_MAX_FAILURES):
+                self.pool.record(B)
+
+        # When
+        ejected = {self.pool.choose() for _ in range(10)}
+        self.clock.now += ENDPOINT_EJECT_INTERVAL
+        readmitted = {self.pool.choose() for _ in range(10)}
+
+        # Then
+        self.assertEqual({A, C}, ejected)
+        self.assertEqual({A, B, C}, readmitted)
+
+    def test_eject_slow_endpoint(self):
+        """ Eject an endpoint much slower than the others. """
+        # When
+        with self.assertLogs('zfs_uploader.endpoints', 'WARNING'):
+            for _ in range(10):
+                self.pool.record(A, 1)
+                self.pool.record(B, 1)
+                self.pool.record(C, 10)
+
+        # Then
+        self.assertEqual([A, B], self.pool.healthy)
+
+    def test_keep_last_endpoint(self):
+        """ Never eject the last healthy endpoint. """
+        # When
+        for url in [A, B, C]:
+            for _ in range(ENDPOINT_MAX_FAILURES):
+                self.pool.record(url)
+
+        # Then
+        self.assertEqual([C], self.pool.healthy)
+
+    def test_instrument(self):
+        """ Send part uploads to the chosen endpoints. """
+        # Given
+        session = botocore.session.get_session()
+        client = session.create_client(
+            's3', region_name='us-east-1', endpoint_url=A,
+            aws_access_key_id='key', aws_secret_access_key='secret')
+        self.pool.instrument(client)
+        urls = []
+
+        def before_send(request, **kwargs):
+            urls.append(request.url)
+            return AWSResponse(request.url, 200, {'ETag': '"etag"'},
+                               FakeRaw())
+
+        client.meta.events.register('before-send.s3', before_send)
+
+        # When
+        for part_number in [1, 2]:
+            client.upload_part(Bucket='bucket', Key='key', Body=b'data',
+                               PartNumber=part_number, UploadId='id')
+        client.get_object(Bucket='bucket', Key='key')
+
+        # Then
+        self.assertEqual([f'{A}/bucket/key?partNumber=1&uploadId=id',
+                          f'{B}/bucket/key?partNumber=2&uploadId=id',
+                          f'{A}/bucket/key'], urls)
+        self.assertEqual(2, sum(e.samples for e in self.pool._endpoints)) # noqa
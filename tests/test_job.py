@@ -1,11 +1,24 @@
-from unittest import TestCase
+from configparser import ConfigParser
+import os
 import subprocess
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import TestCase
 import warnings
 
+from botocore.exceptions import ClientError
+
+from zfs_uploader.backup_db import BackupDB
 from zfs_uploader.config import Config
+from zfs_uploader.job import _run_by_pool, RestoreError, start_jobs # noqa
+from zfs_uploader.lease import Lease
+from zfs_uploader.maintenance import MaintenanceQueue
+from zfs_uploader.metrics import JOB_FAILURES
+from zfs_uploader.snapshot_db import SnapshotDB
 from zfs_uploader.zfs import (create_filesystem, destroy_filesystem,
-                              destroy_snapshot, load_key, mount_filesystem,
-                              SUBPROCESS_KWARGS)
+                              destroy_snapshot, list_filesystems, load_key,
+                              mount_filesystem, SUBPROCESS_KWARGS)
 
 
 class JobTestsBase:
@@ -271,6 +284,135 @@ class JobTestsBase:
             out = f.read()
         self.assertEqual(self.test_data, out)
 
+    def test_restore_subtree_from_recursive_backup(self):
+        """ Test restore of a descendant from a recursive backup. """
+        if self.encrypted_test:
+            self.skipTest('Descendants of an encryption root can not be '
+                          'renamed out of it.')
+
+        # Given
+        child = f'{self.job.filesystem}/child'
+        out = create_filesystem(child)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+
+        with open(f'/{child}/test_file', 'w') as f:
+            f.write(self.test_data)
+
+        self.job._recursive = True
+        self.job._snapshot_db = SnapshotDB(self.job.filesystem, True)
+        self.job.start()
+
+        with open(f'/{child}/test_file', 'a') as f:
+            f.write('append')
+        self.job.start()
+
+        # When
+        self.job.restore(filesystem=self.filesystem_2, subtree=child)
+
+        # Then
+        test_file = f'/{self.filesystem_2}/test_file'
+        with open(test_file, 'r') as f:
+            out = f.read()
+        self.assertEqual(self.test_data + 'append', out)
+
+    def test_restore_recursive_backup_with_new_descendant(self):
+        """ Test rolling back a recursive backup with a newer descendant. """
+        # Given
+        self.job._recursive = True
+        self.job._snapshot_db = SnapshotDB(self.job.filesystem, True)
+        self.job.start()
+
+        child = f'{self.job.filesystem}/child'
+        out = create_filesystem(child)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+
+        with open(self.test_file, 'a') as f:
+            f.write('append')
+
+        # When
+        self.job.restore()
+
+        # Then
+        with open(self.test_file, 'r') as f:
+            out = f.read()
+        self.assertEqual(self.test_data, out)
+
+    def test_restore_from_intermediate_backups(self):
+        """ Test restore from incremental backups with intermediate
+            snapshots. """
+        # Given
+        self.job._send_intermediate = True
+        self.job.start()
+
+        with open(self.test_file, 'a') as f:
+            f.write('append')
+        self.job._snapshot_db.create_snapshot()
+        self.job.start()
+
+        backups = self.job._backup_db.get_backups()
+        self.assertEqual(backups[0].backup_time, backups[1].dependency)
+        self.assertEqual(2, len(backups[1].snapshots))
+
+        out = destroy_filesystem(self.job.filesystem)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+
+        # When
+        self.job.restore(backups[1].snapshots[0])
+        if self.encrypted_test:
+            out = load_key(self.job.filesystem, 'file:///test_key')
+            self.assertEqual(0, out.returncode, msg=out.stderr)
+
+            out = mount_filesystem(self.job.filesystem)
+            self.assertEqual(0, out.returncode, msg=out.stderr)
+
+        # Then
+        with open(self.test_file, 'r') as f:
+            out = f.read()
+        self.assertEqual(self.test_data + 'append', out)
+
+    def test_verify_backups(self):
+        """ Test verifying full and incremental backups. """
+        # Given
+        self.job.start()
+        self.job.start()
+
+        for backup in self.job._backup_db.get_backups():
+            # When
+            verification = self.job.verify_backup(backup)
+
+            # Then
+            self.assertEqual('passed', verification.status,
+                             msg=verification.error)
+            self.assertEqual(backup.checksum, verification.checksum)
+
+    def test_verify_backup_with_receive(self):
+        """ Test verifying a full backup with zfs receive --dryrun. """
+        # Given
+        self.job.start()
+        backup = self.job._backup_db.get_backups()[0]
+
+        # When
+        verification = self.job.verify_backup(backup, structure='receive')
+
+        # Then
+        self.assertEqual('passed', verification.status,
+                         msg=verification.error)
+        self.assertEqual([self.job.filesystem],
+                         list_filesystems(self.job.filesystem))
+
+    def test_verify_corrupted_backup(self):
+        """ Test verifying a backup that was changed after the upload. """
+        # Given
+        self.job.start()
+        backup = self.job._backup_db.get_backups()[0]
+        self.bucket.Object(backup.s3_key).put(Body=b'corrupted')
+
+        # When
+        verification = self.job.verify_backup(backup)
+
+        # Then
+        self.assertEqual('failed', verification.status)
+
     def test_limit_snapshots(self):
         """ Test the snapshot number limiter. """
         # Given
@@ -333,6 +475,154 @@ class JobTestsBase:
         backups_inc_new = self.job._backup_db.get_backups(backup_type='inc')
         self.assertEqual(backups_inc[1:], backups_inc_new)
 
+    def test_deferred_maintenance(self):
+        """ Test retention deferred to the maintenance queue. """
+        # Given
+        self.job._max_snapshots = 1
+        maintenance = MaintenanceQueue()
+
+        # When
+        for _ in range(3):
+            self.job.start(maintenance=maintenance)
+        maintenance.shutdown()
+
+        # Then
+        snapshots = self.job._snapshot_db.get_snapshots()
+        # the snapshot of the full backup is kept
+        self.assertEqual(2, len(snapshots))
+
+    def test_maintenance_skipped_during_backup(self):
+        """ Test maintenance being skipped while a backup runs. """
+        # Given
+        self.job._max_snapshots = 0
+        self.job.start()
+
+        # When
+        with self.job._lock:
+            maintained = self.job.maintain()
+
+        # Then
+        self.assertFalse(maintained)
+        self.assertEqual(1, len(self.job._snapshot_db.get_snapshots()))
+
+    def test_start_leased_by_other_node(self):
+        """ Test skipping the job while another node holds the lease. """
+        # Given
+        self.job._lease = Lease(self.bucket, self.job.filesystem, 'node-a',
+                                self.job.prefix, 60)
+        other = Lease(self.bucket, self.job.filesystem, 'node-b',
+                      self.job.prefix, 60)
+        self.assertTrue(other.acquire())
+
+        # When
+        self.job.start()
+        other.release()
+        self.job.start()
+
+        # Then
+        self.assertEqual(1, len(self.job._backup_db.get_backups()))
+        self.assertEqual('node-a', self.job.lease.holder)
+
+    def test_acquire_lease_reload_backup_db(self):
+        """ Test reloading backup.db after acquiring the lease again. """
+        # Given
+        self.job._lease = Lease(self.bucket, self.job.filesystem, 'node-a',
+                                self.job.prefix, 60)
+        self.job.start()
+        self.job.release_lease()
+        backup = self.job._backup_db.get_latest_backup()
+        other = BackupDB(self.bucket, self.job.filesystem, self.job.prefix)
+        other.create_backup('20990101_000000', 'inc', backup.s3_key,
+                            backup.backup_time)
+
+        # When
+        acquired = self.job.acquire_lease()
+
+        # Then
+        self.assertTrue(acquired)
+        self.assertEqual([backup.backup_time, '20990101_000000'],
+                         self.job._backup_db.get_backup_times())
+
+    def test_start_jobs_lease_error(self):
+        """ Test skipping a job whose lease can't be acquired. """
+        # Given
+        cfg = ConfigParser()
+        cfg.read('config.cfg')
+        cfg[self.filesystem_2] = {'cron': '* * * * *'}
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file_path = os.path.join(directory.name, 'config.cfg')
+        with open(file_path, 'w') as f:
+            cfg.write(f)
+
+        out = create_filesystem(self.filesystem_2)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+        job_2 = Config(file_path).get_job(self.filesystem_2)
+        job_2._lease = Lease(job_2._s3.Bucket('missing-bucket'), # noqa
+                             self.filesystem_2, 'node-a', duration=60)
+        failures = JOB_FAILURES.get(filesystem=self.filesystem_2)
+
+        # When
+        with self.assertRaises(ClientError):
+            start_jobs([job_2, self.job])
+
+        # Then
+        self.assertEqual(1, len(self.job._backup_db.get_backups()))
+        self.assertEqual([], job_2.snapshot_db.get_snapshots())
+        self.assertEqual(failures + 1,
+                         JOB_FAILURES.get(filesystem=self.filesystem_2))
+
+    def test_start_send_profile_change(self):
+        """ Test starting a full backup when the send profile changes. """
+        # Given
+        self.job.start()
+
+        # When
+        self.job._send_profile = 'large_block'
+        self.job.start()
+        self.job._send_profile = 'compressed'
+        self.job.start()
+
+        # Then
+        backups = self.job._backup_db.get_backups()
+        self.assertEqual(['full', 'full', 'inc'],
+                         [b.backup_type for b in backups])
+        self.assertEqual(['raw', 'large_block', 'compressed'],
+                         [b.send_profile for b in backups])
+
+    def test_start_unknown_send_profile(self):
+        """ Test starting a full backup after an unknown send profile. """
+        # Given
+        self.job.start()
+        full = self.job._backup_db.get_latest_backup(backup_type='full')
+        full._send_profile = 'zstd' # noqa
+
+        # When
+        self.job.start()
+
+        # Then
+        backups = self.job._backup_db.get_backups()
+        self.assertEqual(['full', 'full'],
+                         [b.backup_type for b in backups])
+
+    def test_restore_incompatible_send_profiles(self):
+        """ Test refusing to restore a chain zfs receive would reject. """
+        # Given
+        self.job.start()
+        full = self.job._backup_db.get_backups()[0]
+        backup_time = '20990101_000000'
+        self.job._backup_db.create_backup(backup_time, 'inc', full.s3_key,
+                                          full.backup_time,
+                                          send_profile='plain')
+
+        # When
+        with self.assertRaises(RestoreError):
+            self.job.restore(backup_time)
+
+        # Then
+        self.assertIn(full.backup_time,
+                      self.job._snapshot_db.get_snapshot_names())
+
     def test_limit_backups_one_full(self):
         """ Test the backup limiter when there's only one full backup. """
 
@@ -459,3 +749,30 @@ class JobTestsEncrypted(JobTestsBase, TestCase):
 
         for item in self.bucket.objects.all():
             item.delete()
+
+
+class RunByPoolTests(TestCase):
+    def test_busy_pool(self):
+        """ Test that jobs of a busy pool don't hold workers. """
+        # Given
+        jobs = [SimpleNamespace(filesystem=filesystem) for filesystem in
+                ('pool-a/1', 'pool-a/2', 'pool-b/1')]
+        started = []
+        pool_b_started = threading.Event()
+
+        def fn(job):
+            started.append(job.filesystem)
+            if job.filesystem == 'pool-b/1':
+                pool_b_started.set()
+            elif job.filesystem == 'pool-a/1':
+                self.assertTrue(pool_b_started.wait(5))
+
+        # When
+        futures = _run_by_pool([(job,) for job in jobs], fn, max_workers=2,
+                               pool_limit=1)
+
+        # Then
+        self.assertEqual(['pool-a/1', 'pool-a/2', 'pool-b/1'], list(futures))
+        for future in futures.values():
+            self.assertIsNone(future.exception())
+        self.assertEqual(['pool-a/1', 'pool-b/1', 'pool-a/2'], started)
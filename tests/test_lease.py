@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+import unittest
+import warnings
+
+from zfs_uploader.config import Config
+from zfs_uploader.lease import Lease
+
+
+class LeaseTests(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings("ignore", category=ResourceWarning,
+                                message="unclosed.*<ssl.SSLSocket.*>")
+
+        config = Config('config.cfg')
+        job = next(iter(config.jobs.values()))
+        self.bucket = job.bucket
+
+        # Given
+        self.lease_a = Lease(self.bucket, job.filesystem, 'node-a',
+                             job.prefix, 60)
+        self.lease_b = Lease(self.bucket, job.filesystem, 'node-b',
+                             job.prefix, 60)
+
+    def tearDown(self):
+        for item in self.bucket.objects.all():
+            item.delete()
+
+    def test_acquire(self):
+        """ Test that only one node holds the lease. """
+        # When
+        acquired_a = self.lease_a.acquire()
+        acquired_b = self.lease_b.acquire()
+
+        # Then
+        self.assertTrue(acquired_a)
+        self.assertFalse(acquired_b)
+        self.assertTrue(self.lease_a.held)
+        self.assertFalse(self.lease_b.held)
+        self.assertEqual('node-a', self.lease_b.holder)
+
+    def test_release(self):
+        """ Test acquiring a released lease. """
+        # Given
+        self.lease_a.acquire()
+
+        # When
+        self.lease_a.release()
+
+        # Then
+        self.assertTrue(self.lease_b.acquire())
+        self.assertFalse(self.lease_a.held)
+
+    def test_take_over_expired_lease(self):
+        """ Test taking over an expired lease. """
+        # Given
+        self.lease_a._duration = 1 # noqa
+        self.lease_a.acquire()
+        time.sleep(1.1)
+
+        # When
+        acquired_b = self.lease_b.acquire()
+
+        # Then
+        self.assertTrue(acquired_b)
+        self.assertFalse(self.lease_a.renew())
+        self.assertFalse(self.lease_a.acquire())
+
+    def test_hold(self):
+        """ Test renewing the lease while it's held. """
+        # Given
+        self.lease_a._duration = 1.5 # noqa
+
+        # When
+        self.lease_a.acquire()
+        with self.lease_a.hold():
+            time.sleep(2)
+
+        # Then
+        self.assertTrue(self.lease_a.held)
+        self.assertFalse(self.lease_b.acquire())
+
+    def test_hold_lost(self):
+        """ Test calling on_lost when another node takes over the lease. """
+        # Given
+        self.lease_a._duration = 1.5 # noqa
+        self.lease_a.acquire()
+        lost = threading.Event()
+
+        # When
+        with self.lease_a.hold(on_lost=lost.set):
+            body = json.dumps({'node_id': 'node-b',
+                               'expires': time.time() + 60})
+            self.lease_a._s3_object.put(Body=body.encode('utf-8')) # noqa
+            called = lost.wait(2)
+
+        # Then
+        self.assertTrue(called)
+        self.assertFalse(self.lease_a.held)
+        self.assertFalse(self.lease_a.acquire())
+        self.assertEqual('node-b', self.lease_a.holder)
@@ -0,0 +1,82 @@
+import threading
+import unittest
+
+from zfs_uploader.maintenance import MaintenanceQueue
+
+
+class MaintenanceQueueTests(unittest.TestCase):
+    def setUp(self):
+        # Given
+        self.queue = MaintenanceQueue()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.shutdown()
+
+    def _blocking_task(self):
+        self.calls.append('blocking')
+        self.started.set()
+        self.release.wait(5)
+
+    def test_coalesce(self):
+        """ Run only the latest of the waiting requests. """
+        # Given
+        self.queue.submit('prune', self._blocking_task, 'pool/a')
+        self.started.wait(5)
+
+        # When
+        first = self.queue.submit('prune', lambda: self.calls.append(1),
+                                  'pool/a')
+        second = self.queue.submit('prune', lambda: self.calls.append(2),
+                                   'pool/a')
+        self.release.set()
+        self.queue.shutdown()
+
+        # Then
+        self.assertTrue(first)
+        self.assertFalse(second)
+        self.assertEqual(['blocking', 2], self.calls)
+
+    def test_separate_keys(self):
+        """ Don't coalesce requests of other filesystems or tasks. """
+        # Given
+        self.queue.submit('prune', self._blocking_task, 'pool/a')
+        self.started.wait(5)
+
+        # When
+        self.queue.submit('prune', lambda: self.calls.append('b'), 'pool/b')
+        self.queue.submit('verify', lambda: self.calls.append('v'),
+                          'pool/a')
+        self.release.set()
+        self.queue.shutdown()
+
+        # Then
+        self.assertEqual(['blocking', 'b', 'v'], self.calls)
+
+    def test_failed_task(self):
+        """ Keep running tasks after a task failed. """
+        # Given
+        def fail():
+            raise RuntimeError('failed')
+
+        # When
+        with self.assertLogs('zfs_uploader.maintenance', 'ERROR'):
+            self.queue.submit('prune', fail, 'pool/a')
+            self.queue.submit('prune', lambda: self.calls.append(1),
+                              'pool/b')
+            self.queue.shutdown()
+
+        # Then
+        self.assertEqual([1], self.calls)
+
+    def test_submit_after_shutdown(self):
+        """ Raise error for requests after shutdown. """
+        # When
+        self.queue.shutdown()
+
+        # Then
+        self.assertRaises(RuntimeError, self.queue.submit, 'prune',
+                          lambda: None)
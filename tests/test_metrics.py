@@ -0,0 +1,83 @@
+from urllib.request import urlopen
+import unittest
+
+from zfs_uploader.metrics import (Counter, Gauge, Histogram, Registry,
+                                  start_http_server, _MetricsHandler)
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.filesystem = 'test-pool/test-filesystem'
+
+    def test_render(self):
+        """ Test rendering metrics in the text exposition format. """
+        # Given
+        counter = Counter('test_bytes_total', 'Bytes.', ['filesystem'],
+                          registry=self.registry)
+        gauge = Gauge('test_size_bytes', 'Size.', ['filesystem'],
+                      registry=self.registry)
+
+        # When
+        counter.inc(100, filesystem=self.filesystem)
+        counter.inc(50, filesystem=self.filesystem)
+        gauge.set(42, filesystem=self.filesystem)
+        text = self.registry.render()
+
+        # Then
+        self.assertIn('# TYPE test_bytes_total counter', text)
+        self.assertIn(f'test_bytes_total{{filesystem="{self.filesystem}"}} '
+                      '150', text)
+        self.assertIn(f'test_size_bytes{{filesystem="{self.filesystem}"}} '
+                      '42', text)
+
+    def test_histogram(self):
+        """ Test that histogram buckets are cumulative. """
+        # Given
+        histogram = Histogram('test_duration_seconds', 'Duration.',
+                              ['phase'], buckets=(1, 10),
+                              registry=self.registry)
+
+        # When
+        for value in (0.5, 5, 50):
+            histogram.observe(value, phase='upload')
+        text = self.registry.render()
+
+        # Then
+        self.assertIn('test_duration_seconds_bucket{phase="upload",le="1"} 1',
+                      text)
+        self.assertIn('test_duration_seconds_bucket{phase="upload",le="10"} '
+                      '2', text)
+        self.assertIn('test_duration_seconds_bucket{phase="upload",'
+                      'le="+Inf"} 3', text)
+        self.assertIn('test_duration_seconds_count{phase="upload"} 3', text)
+        self.assertIn('test_duration_seconds_sum{phase="upload"} 55.5', text)
+
+    def test_missing_label(self):
+        """ Test that labels have to match the label names. """
+        # Given
+        counter = Counter('test_total', 'Test.', ['filesystem'],
+                          registry=self.registry)
+
+        # When / Then
+        with self.assertRaises(ValueError):
+            counter.inc()
+
+    def test_http_server(self):
+        """ Test serving metrics over HTTP. """
+        # Given
+        server = start_http_server(0, '127.0.0.1')
+        port = server.server_address[1]
+
+        # When
+        with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            content_type = response.headers['Content-Type']
+            text = response.read().decode('utf-8')
+        server.shutdown()
+        server.server_close()
+
+        # Then
+        self.assertTrue(content_type.startswith('text/plain'))
+        self.assertEqual(_MetricsHandler.registry.render().split('\n')[0],
+                         text.split('\n')[0])
+        self.assertIn('# TYPE zfsup_bytes_sent_total counter', text)
@@ -0,0 +1,129 @@
+from io import StringIO
+import os
+import threading
+import time
+import unittest
+
+from zfs_uploader.metrics import BUFFER_FILL
+from zfs_uploader.progress import ProgressEngine, ProgressView
+from zfs_uploader.stream import RingBuffer
+
+
+class ProgressTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = ProgressEngine(interval=60)
+        self.filesystem = 'test-pool/test-filesystem'
+        self.backup_time = '20210425_201838'
+        self.s3_key = 'test-filesystem/20210425_201838.full'
+
+    def test_concurrent_callbacks(self):
+        """ Test that callbacks from many threads are all counted. """
+        # Given
+        transfer = self.engine.track(self.filesystem, self.backup_time,
+                                     self.s3_key, 20 * 10_000)
+
+        def callback():
+            for _ in range(10_000):
+                transfer.callback(1)
+
+        # When
+        with transfer:
+            threads = [threading.Thread(target=callback)
+                       for _ in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Then
+        self.assertEqual(20 * 10_000, transfer.transferred)
+        self.assertEqual(1, transfer.progress)
+        self.assertTrue(transfer.done)
+        self.assertEqual([], self.engine.transfers)
+
+    def test_speed_and_eta(self):
+        """ Test moving average speed and ETA. """
+        # Given
+        transfer = self.engine.track(self.filesystem, self.backup_time,
+                                     self.s3_key, 1000)
+        self.engine.add(transfer)
+        start = transfer._sample_time # noqa
+
+        # When
+        transfer.callback(100)
+        self.engine.sample(start + 1)
+        transfer.callback(300)
+        self.engine.sample(start + 2)
+
+        # Then
+        self.assertAlmostEqual(0.3 * 300 + 0.7 * 100, transfer.speed)
+        self.assertAlmostEqual(600 / transfer.speed, transfer.eta)
+        transfer.finish()
+
+    def test_stall(self):
+        """ Test that stall callbacks are called once without progress. """
+        # Given
+        transfer = self.engine.track(self.filesystem, self.backup_time,
+                                     self.s3_key, 1000, stall_timeout=10)
+        self.engine.add(transfer)
+        start = transfer._sample_time # noqa
+        calls = []
+        transfer.on_stall(lambda: calls.append(True))
+
+        # When
+        transfer.callback(100)
+        self.engine.sample(start + 5)
+        self.engine.sample(start + 14)
+        stalled_early = transfer.stalled
+        self.engine.sample(start + 15)
+        self.engine.sample(start + 30)
+
+        # Then
+        self.assertFalse(stalled_early)
+        self.assertTrue(transfer.stalled)
+        self.assertEqual(1, len(calls))
+        transfer.finish()
+
+    def test_buffer_fill(self):
+        """ Test exporting the ring buffer fill level. """
+        # Given
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(write_fd, 'wb') as f:
+            f.write(bytes(32 * 1024))
+
+        with os.fdopen(read_fd, 'rb') as f:
+            with RingBuffer(f, buffer_size=64 * 1024,
+                            slot_size=16 * 1024) as buffer:
+                while buffer.buffered < 32 * 1024:
+                    time.sleep(0.01)
+                transfer = self.engine.track(self.filesystem,
+                                             self.backup_time, self.s3_key,
+                                             1000, buffer=buffer)
+
+                # When
+                with transfer:
+                    self.engine.sample()
+
+        # Then
+        self.assertEqual(0.5, BUFFER_FILL.get(filesystem=self.filesystem))
+
+    def test_view(self):
+        """ Test that finished transfers are drawn once. """
+        # Given
+        stream = StringIO()
+        view = ProgressView(stream)
+        self.engine.add_view(view)
+        transfer = self.engine.track(self.filesystem, self.backup_time,
+                                     self.s3_key, 1000, 'restore')
+
+        # When
+        with transfer:
+            transfer.callback(500)
+            self.engine.sample()
+        self.engine.remove_view(view)
+
+        # Then
+        output = stream.getvalue()
+        self.assertIn(f'{self.filesystem}@{self.backup_time}', output)
+        self.assertIn(' 50%', output)
+        self.assertEqual(1, output.count('done in'))
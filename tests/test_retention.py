@@ -0,0 +1,209 @@
+import unittest
+
+from zfs_uploader.backup_db import Backup
+from zfs_uploader.retention import (plan_backups, plan_sharded_backups,
+                                    plan_snapshots, RetentionPolicy)
+
+
+def _backups(*specs):
+    """ Create backups from (backup_time, dependency) tuples. """
+    return [Backup(backup_time, 'inc' if dependency else 'full', 'pool/fs',
+                   f'pool/fs/{backup_time}', dependency)
+            for backup_time, dependency in specs]
+
+
+class PlanBackupsTests(unittest.TestCase):
+    def test_max_backups(self):
+        """ Delete oldest backups without dependants. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210102_000000', '20210101_000000'),
+                           ('20210103_000000', None),
+                           ('20210104_000000', '20210103_000000'))
+
+        # When
+        plan = plan_backups(backups, RetentionPolicy(max_backups=3))
+
+        # Then
+        self.assertEqual(['20210102_000000'], plan.delete)
+        self.assertEqual(['has dependants'],
+                         plan.reasons['20210101_000000'])
+
+    def test_keep_daily(self):
+        """ Keep most recent backup of each day and its dependencies. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210101_120000', '20210101_000000'),
+                           ('20210102_000000', '20210101_000000'),
+                           ('20210102_120000', '20210101_000000'),
+                           ('20210103_000000', '20210101_000000'),
+                           ('20210103_120000', '20210101_000000'))
+
+        # When
+        plan = plan_backups(backups, RetentionPolicy(keep_daily=2))
+
+        # Then
+        self.assertEqual(['20210101_000000', '20210102_120000',
+                          '20210103_120000'], plan.keep)
+        self.assertEqual(['dependency'], plan.reasons['20210101_000000'])
+        self.assertEqual(['daily'], plan.reasons['20210103_120000'])
+
+    def test_keep_multiple_periods(self):
+        """ Keep backups selected by any rule. """
+        # Given
+        backups = _backups(('20210105_000000', None),
+                           ('20210120_000000', None),
+                           ('20210215_000000', None),
+                           ('20210301_000000', None),
+                           ('20210301_010000', None))
+
+        # When
+        plan = plan_backups(backups, RetentionPolicy(keep_hourly=1,
+                                                     keep_monthly=3))
+
+        # Then
+        self.assertEqual(['20210120_000000', '20210215_000000',
+                          '20210301_010000'], plan.keep)
+        self.assertEqual(['hourly', 'monthly'],
+                         plan.reasons['20210301_010000'])
+
+    def test_dependency_chain(self):
+        """ Keep the whole chain of a kept backup. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210102_000000', '20210101_000000'),
+                           ('20210103_000000', '20210102_000000'),
+                           ('20210104_000000', None))
+
+        # When
+        plan = plan_backups(backups, RetentionPolicy(keep_daily=0))
+        plan_protected = plan_backups(
+            backups, RetentionPolicy(keep_daily=0),
+            protected=['20210103_000000'])
+
+        # Then
+        self.assertEqual([], plan.keep)
+        self.assertEqual(['20210101_000000', '20210102_000000',
+                          '20210103_000000'], plan_protected.keep)
+
+    def test_max_backups_caps_rules(self):
+        """ Cap backups kept by rules with max_backups. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210102_000000', None),
+                           ('20210103_000000', None))
+
+        # When
+        plan = plan_backups(backups, RetentionPolicy(max_backups=2,
+                                                     keep_daily=7))
+
+        # Then
+        self.assertEqual(['20210101_000000'], plan.delete)
+
+    def test_bad_rule(self):
+        """ Raise error for negative rules. """
+        # When / Then
+        self.assertRaises(ValueError, RetentionPolicy, keep_weekly=-1)
+
+
+class PlanShardedBackupsTests(unittest.TestCase):
+    def setUp(self):
+        self.loaded = set()
+
+    def _plan(self, backups, policy):
+        shards = {}
+        for backup in backups:
+            shard = shards.setdefault(backup.backup_time[:6],
+                                      {'count': 0, 'last_full': None})
+            shard['count'] += 1
+            if backup.backup_type == 'full':
+                shard['last_full'] = backup.backup_time
+
+        def get_backups(months):
+            self.loaded.update(months)
+            return [b for b in backups if b.backup_time[:6] in months]
+
+        return plan_sharded_backups(shards, get_backups, policy)
+
+    def test_max_backups_loads_oldest_shards(self):
+        """ Only download the oldest shard without period rules. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210102_000000', '20210101_000000'),
+                           ('20210103_000000', None),
+                           ('20210201_000000', None),
+                           ('20210202_000000', '20210201_000000'),
+                           ('20210301_000000', None),
+                           ('20210302_000000', '20210301_000000'))
+        policy = RetentionPolicy(max_backups=6)
+
+        # When
+        plan = self._plan(backups, policy)
+
+        # Then
+        self.assertEqual(['20210102_000000'], plan.delete)
+        self.assertEqual(plan_backups(backups, policy).delete, plan.delete)
+        self.assertEqual({'202101'}, self.loaded)
+
+    def test_max_backups_dependants_in_other_shard(self):
+        """ Download the next shard if a backup may have dependants. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210102_000000', '20210101_000000'),
+                           ('20210201_000000', '20210101_000000'),
+                           ('20210301_000000', None))
+        policy = RetentionPolicy(max_backups=2)
+
+        # When
+        plan = self._plan(backups, policy)
+
+        # Then
+        self.assertEqual(['20210102_000000', '20210201_000000'], plan.delete)
+        self.assertEqual(plan_backups(backups, policy).delete, plan.delete)
+        self.assertEqual({'202101', '202102'}, self.loaded)
+
+    def test_max_backups_not_reached(self):
+        """ Don't download any shard below max_backups. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210201_000000', None))
+
+        # When
+        plan = self._plan(backups, RetentionPolicy(max_backups=2))
+
+        # Then
+        self.assertEqual([], plan.delete)
+        self.assertEqual(set(), self.loaded)
+
+    def test_keep_rules_skip_single_full_backups(self):
+        """ Don't download shards holding a single full backup. """
+        # Given
+        backups = _backups(('20210101_000000', None),
+                           ('20210201_000000', None),
+                           ('20210301_000000', None),
+                           ('20210301_120000', '20210301_000000'))
+        policy = RetentionPolicy(keep_daily=1)
+
+        # When
+        plan = self._plan(backups, policy)
+
+        # Then
+        self.assertEqual(['20210101_000000', '20210201_000000'], plan.delete)
+        self.assertEqual(plan_backups(backups, policy).delete, plan.delete)
+        self.assertEqual({'202103'}, self.loaded)
+
+
+class PlanSnapshotsTests(unittest.TestCase):
+    def test_plan_snapshots(self):
+        """ Delete oldest snapshots except protected ones. """
+        # Given
+        names = ['20210101_000000', '20210102_000000', '20210103_000000',
+                 '20210104_000000']
+
+        # When
+        plan = plan_snapshots(names, 2, protected=['20210101_000000'])
+
+        # Then
+        self.assertEqual(['20210102_000000'], plan.delete)
+        self.assertEqual(['20210101_000000', '20210103_000000',
+                          '20210104_000000'], plan.keep)
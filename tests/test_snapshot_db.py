@@ -1,9 +1,10 @@
+import subprocess
 import unittest
 import warnings
 
 from zfs_uploader.config import Config
-from zfs_uploader.snapshot_db import SnapshotDB
-from zfs_uploader.zfs import create_filesystem, destroy_filesystem
+from zfs_uploader.snapshot_db import create_snapshots, SnapshotDB
+from zfs_uploader.zfs import create_filesystem, destroy_filesystem, ZFSError
 
 
 class SnapshotDBTests(unittest.TestCase):
@@ -64,3 +65,47 @@ class SnapshotDBTests(unittest.TestCase):
 
         snapshot_db_new = SnapshotDB(self.filesystem)
         self.assertNotIn(snapshot, snapshot_db_new.get_snapshots())
+
+    def test_create_snapshots(self):
+        """ Test creating snapshots of multiple filesystems at once. """
+        # Given
+        child = f'{self.filesystem}/child'
+        out = create_filesystem(child)
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+
+        snapshot_db = SnapshotDB(self.filesystem)
+        snapshot_db_child = SnapshotDB(child)
+
+        # When
+        snapshots = create_snapshots([snapshot_db, snapshot_db_child])
+
+        # Then
+        snapshot = snapshots[self.filesystem]
+        snapshot_child = snapshots[child]
+        self.assertEqual(snapshot.name, snapshot_child.name)
+        self.assertEqual([snapshot], snapshot_db.get_snapshots())
+        self.assertEqual([snapshot_child], snapshot_db_child.get_snapshots())
+
+    def test_delete_snapshots_held(self):
+        """ Test deleting snapshots when one of them is held. """
+        # Given
+        snapshot_db = SnapshotDB(self.filesystem)
+        names = [snapshot_db.create_snapshot().name for _ in range(3)]
+        held = f'{self.filesystem}@{names[1]}'
+        out = subprocess.run(['zfs', 'hold', 'test', held],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             encoding='utf-8')
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+
+        # When
+        try:
+            with self.assertRaisesRegex(ZFSError, names[1]):
+                snapshot_db.delete_snapshots(names)
+        finally:
+            subprocess.run(['zfs', 'release', 'test', held])
+
+        # Then
+        self.assertEqual([names[1]], snapshot_db.get_snapshot_names())
+
+        snapshot_db_new = SnapshotDB(self.filesystem)
+        self.assertEqual([names[1]], snapshot_db_new.get_snapshot_names())
@@ -0,0 +1,161 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+from s3transfer.upload import UploadSeekableInputManager
+
+from zfs_uploader.spool import DownloadFile, Spool
+from zfs_uploader.stream import ChecksumReader
+
+
+class SpoolTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filesystem = 'test-pool/test-filesystem'
+        self.test_data = str(list(range(100_000))).encode('utf-8')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_while_writing(self):
+        """ Test reading a spool file while the stream is written. """
+        # Given
+        spool = Spool(self.directory.name)
+        spool_file = spool.reserve(self.filesystem, '20210425_201838.full',
+                                   len(self.test_data),
+                                   {'backup_time': '20210425_201838'})
+
+        # When
+        with subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE) as p:
+            spool_file.start(p.stdout)
+            p.stdin.write(self.test_data)
+            p.stdin.close()
+
+            with spool_file.open() as f:
+                first = f.read(1000)
+                rest = f.read()
+            spool_file.join()
+
+        # Then
+        self.assertEqual(self.test_data, first + rest)
+        self.assertFalse(f.seekable())
+
+    def test_get_spool_files(self):
+        """ Test that only complete spool files are returned. """
+        # Given
+        spool = Spool(self.directory.name)
+        metadata = {'backup_time': '20210425_201838'}
+
+        for name, complete in (('20210425_201838.full', True),
+                               ('20210425_201839.inc', False)):
+            spool_file = spool.reserve(self.filesystem, name,
+                                       len(self.test_data), dict(metadata))
+            with subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE) as p:
+                spool_file.start(p.stdout)
+                p.stdin.write(self.test_data)
+                p.stdin.close()
+                spool_file.join()
+            if complete:
+                spool_file.complete()
+
+        # When
+        spool_files = spool.get_spool_files(self.filesystem)
+
+        # Then
+        self.assertEqual(1, len(spool_files))
+        self.assertEqual('20210425_201838.full',
+                         os.path.basename(spool_files[0].path))
+        self.assertTrue(spool_files[0].metadata['complete'])
+
+    def test_resume_upload_seekable(self):
+        """ Test that a complete spool file is uploaded in parallel parts. """
+        # Given
+        spool = Spool(self.directory.name)
+        spool_file = spool.reserve(self.filesystem, '20210425_201838.full',
+                                   len(self.test_data),
+                                   {'backup_time': '20210425_201838'})
+        with subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE) as p:
+            spool_file.start(p.stdout)
+            p.stdin.write(self.test_data)
+            p.stdin.close()
+            spool_file.join()
+        spool_file.complete()
+
+        # When
+        with open(spool.get_spool_files(self.filesystem)[0].path,
+                  'rb') as f:
+            reader = ChecksumReader(f)
+            seekable = UploadSeekableInputManager.is_compatible(reader)
+
+        # Then
+        self.assertTrue(seekable)
+
+    def test_max_size(self):
+        """ Test that a stream larger than the max size is not spooled. """
+        # Given
+        spool = Spool(self.directory.name, max_size=1000)
+
+        # When
+        spool_file = spool.reserve(self.filesystem, '20210425_201838.full',
+                                   1001, {})
+
+        # Then
+        self.assertIsNone(spool_file)
+
+    def test_resume_download(self):
+        """ Test that a download continues with the missing parts. """
+        # Given
+        spool = Spool(self.directory.name)
+        metadata = {'size': len(self.test_data), 'etag': '"abc"',
+                    'part_size': 1000}
+        download_file = spool.reserve_download(self.filesystem,
+                                               '20210425_201838.full',
+                                               metadata)
+        with download_file:
+            for index, start, end in download_file.missing_parts[:3]:
+                download_file.write(start, self.test_data[start:end + 1])
+                download_file.complete_part(index)
+
+        # When
+        download_file = spool.reserve_download(self.filesystem,
+                                               '20210425_201838.full',
+                                               metadata)
+        missing_parts = download_file.missing_parts
+        with download_file:
+            for index, start, end in missing_parts:
+                download_file.write(start, self.test_data[start:end + 1])
+                download_file.complete_part(index)
+
+        # Then
+        self.assertEqual(3000, len(self.test_data) - sum(
+            end - start + 1 for _, start, end in missing_parts))
+        self.assertTrue(download_file.complete)
+        with open(download_file.path, 'rb') as f:
+            self.assertEqual(self.test_data, f.read())
+
+    def test_download_changed_object(self):
+        """ Test that parts of a changed object are discarded. """
+        # Given
+        spool = Spool(self.directory.name)
+        metadata = {'size': len(self.test_data), 'etag': '"abc"',
+                    'part_size': 1000}
+        download_file = spool.reserve_download(self.filesystem,
+                                               '20210425_201838.full',
+                                               metadata)
+        with download_file:
+            download_file.write(0, self.test_data[:1000])
+            download_file.complete_part(0)
+
+        # When
+        metadata['etag'] = '"def"'
+        download_file = spool.reserve_download(self.filesystem,
+                                               '20210425_201838.full',
+                                               metadata)
+
+        # Then
+        self.assertIsInstance(download_file, DownloadFile)
+        self.assertEqual(0, download_file.downloaded)
@@ -0,0 +1,46 @@
+import subprocess
+import sys
+import time
+import unittest
+
+HEAVY_MODULES = ('apscheduler', 'boto3', 'botocore', 's3transfer')
+
+
+def _run(code):
+    return subprocess.run([sys.executable, '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          encoding='utf-8')
+
+
+def _min_time(args, runs=3):
+    elapsed = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+        elapsed.append(time.monotonic() - start)
+    return min(elapsed)
+
+
+class StartupTests(unittest.TestCase):
+    def test_no_heavy_imports(self):
+        """ Test that the CLI doesn't import boto3 or APScheduler. """
+        # When
+        out = _run('import sys\n'
+                   'import zfs_uploader.__main__\n'
+                   f'print(sorted(m for m in sys.modules '
+                   f'if m.split(".")[0] in {HEAVY_MODULES!r}))')
+
+        # Then
+        self.assertEqual(0, out.returncode, msg=out.stderr)
+        self.assertEqual('[]', out.stdout.strip())
+
+    def test_help_startup_time(self):
+        """ Test that `zfsup --help` starts close to a bare click import. """
+        # Given
+        baseline = _min_time([sys.executable, '-c', 'import click'])
+
+        # When
+        elapsed = _min_time([sys.executable, '-m', 'zfs_uploader', '--help'])
+
+        # Then
+        self.assertLess(elapsed, baseline + 0.5)
@@ -0,0 +1,152 @@
+import hashlib
+import io
+import struct
+import subprocess
+import threading
+import unittest
+
+from zfs_uploader.stream import (ChecksumReader, DMU_BACKUP_MAGIC, DRR_BEGIN,
+                                 DRR_END, DRR_RECORD_SIZE, RingBuffer,
+                                 SendStreamVerifier, set_pipe_size)
+
+
+class RingBufferTests(unittest.TestCase):
+    def setUp(self):
+        self.test_data = str(list(range(100_000))).encode('utf-8')
+
+    def test_read_parts(self):
+        """ Test reading fixed size parts through the ring buffer. """
+        # Given
+        part_size = 100_000
+
+        # When
+        with subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE) as p:
+            with RingBuffer(p.stdout, buffer_size=64 * 1024,
+                            slot_size=16 * 1024) as buffer:
+                writer = threading.Thread(target=_write,
+                                          args=(p.stdin, self.test_data))
+                writer.start()
+
+                parts = []
+                while True:
+                    part = buffer.read(part_size)
+                    if not part:
+                        break
+                    parts.append(part)
+                writer.join()
+
+        # Then
+        self.assertEqual(self.test_data, b''.join(parts))
+        for part in parts[:-1]:
+            self.assertEqual(part_size, len(part))
+        self.assertEqual(0, buffer.buffered)
+
+    def test_set_pipe_size(self):
+        """ Test enlarging the pipe buffer. """
+        # Given
+        with subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE) as p:
+            # When
+            size = set_pipe_size(p.stdout, 256 * 1024)
+            p.stdin.close()
+
+        # Then
+        self.assertEqual(256 * 1024, size)
+
+
+class ChecksumReaderTests(unittest.TestCase):
+    def test_read(self):
+        """ Test computing the digest of the data read. """
+        # Given
+        data = str(list(range(100_000))).encode('utf-8')
+        reader = ChecksumReader(io.BytesIO(data))
+
+        # When
+        parts = []
+        while True:
+            part = reader.read(4096)
+            if not part:
+                break
+            parts.append(part)
+
+        # Then
+        self.assertEqual(data, b''.join(parts))
+        self.assertEqual(len(data), reader.size)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), reader.hexdigest())
+
+    def test_seek(self):
+        """ Test that data read again after seeking is hashed once. """
+        # Given
+        data = str(list(range(100_000))).encode('utf-8')
+        reader = ChecksumReader(io.BytesIO(data))
+
+        # When
+        reader.seek(0, io.SEEK_END)
+        size = reader.tell()
+        reader.seek(0)
+        first = reader.read(4096)
+        reader.seek(0)
+        parts = [reader.read(8192)]
+        while parts[-1]:
+            parts.append(reader.read(8192))
+
+        # Then
+        self.assertTrue(reader.seekable())
+        self.assertEqual(len(data), size)
+        self.assertEqual(data[:4096], first)
+        self.assertEqual(data, b''.join(parts))
+        self.assertEqual(hashlib.sha256(data).hexdigest(), reader.hexdigest())
+
+
+class SendStreamVerifierTests(unittest.TestCase):
+    def setUp(self):
+        begin = struct.pack('<IIQ', DRR_BEGIN, 0, DMU_BACKUP_MAGIC)
+        end = struct.pack('<II', DRR_END, 0)
+        self.stream = (begin.ljust(DRR_RECORD_SIZE, b'\0') +
+                       b'\1' * 100_000 +
+                       end.ljust(DRR_RECORD_SIZE, b'\0'))
+
+    def test_write(self):
+        """ Test passing a complete stream through. """
+        # Given
+        f = io.BytesIO()
+        verifier = SendStreamVerifier(f)
+
+        # When
+        for i in range(0, len(self.stream), 1000):
+            verifier.write(self.stream[i:i + 1000])
+
+        # Then
+        verifier.check_structure()
+        self.assertEqual(self.stream, f.getvalue())
+        self.assertEqual(len(self.stream), verifier.size)
+        self.assertEqual(hashlib.sha256(self.stream).hexdigest(),
+                         verifier.hexdigest())
+
+    def test_truncated_stream(self):
+        """ Test detecting a stream without end record. """
+        # Given
+        verifier = SendStreamVerifier()
+
+        # When
+        verifier.write(self.stream[:-DRR_RECORD_SIZE])
+
+        # Then
+        self.assertRaises(ValueError, verifier.check_structure)
+
+    def test_invalid_stream(self):
+        """ Test detecting a stream without begin record. """
+        # Given
+        verifier = SendStreamVerifier()
+
+        # When
+        verifier.write(self.stream[DRR_RECORD_SIZE:])
+
+        # Then
+        self.assertRaises(ValueError, verifier.check_structure)
+
+
+def _write(f, data):
+    f.write(data)
+    f.close()
@@ -0,0 +1,83 @@
+import io
+import unittest
+
+from zfs_uploader.throttle import RateLimiter, ThrottledWriter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTests(unittest.TestCase):
+    def setUp(self):
+        # Given
+        self.clock = FakeClock()
+        self.rate_limiter = RateLimiter(100, clock=self.clock,
+                                        sleep=self.clock.sleep)
+
+    def test_acquire_burst(self):
+        """ Take one second worth of bytes without waiting. """
+        # When
+        wait = self.rate_limiter.acquire(100)
+
+        # Then
+        self.assertEqual(0, wait)
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_acquire_wait(self):
+        """ Wait until debt is paid off. """
+        # Given
+        self.rate_limiter.acquire(100)
+
+        # When
+        wait = self.rate_limiter.acquire(50)
+
+        # Then
+        self.assertAlmostEqual(0.5, wait)
+        self.assertEqual([wait], self.clock.sleeps)
+
+    def test_acquire_refill(self):
+        """ Refill tokens over time up to the burst size. """
+        # Given
+        self.rate_limiter.acquire(100)
+        self.clock.now += 10
+
+        # When
+        first = self.rate_limiter.acquire(100)
+        second = self.rate_limiter.acquire(100)
+
+        # Then
+        self.assertEqual(0, first)
+        self.assertAlmostEqual(1, second)
+
+    def test_bad_rate(self):
+        """ Raise error for non-positive rate. """
+        # When / Then
+        self.assertRaises(ValueError, RateLimiter, 0)
+
+
+class ThrottledWriterTests(unittest.TestCase):
+    def test_write(self):
+        """ Write data after acquiring its size. """
+        # Given
+        clock = FakeClock()
+        rate_limiter = RateLimiter(100, clock=clock, sleep=clock.sleep)
+        f = io.BytesIO()
+        writer = ThrottledWriter(f, rate_limiter)
+
+        # When
+        writer.write(b'a' * 150)
+        writer.write(b'b' * 50)
+
+        # Then
+        self.assertEqual(b'a' * 150 + b'b' * 50, f.getvalue())
+        self.assertAlmostEqual(1, clock.now)
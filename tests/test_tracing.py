@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+import unittest
+
+from zfs_uploader.tracing import (add_exporter, add_subprocess,
+                                  JSONExporter, remove_exporter, span)
+
+
+class TracingTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, 'spans.jsonl')
+        self.exporter = JSONExporter(self.file_path)
+        add_exporter(self.exporter)
+
+    def tearDown(self):
+        remove_exporter(self.exporter)
+        self.directory.cleanup()
+
+    def test_nested_spans(self):
+        """ Test that bytes and subprocesses are added to parent spans. """
+        # When
+        with span('job', filesystem='test-pool') as job:
+            with span('upload') as upload:
+                add_subprocess()
+                upload.add_bytes(100)
+            add_subprocess()
+
+        # Then
+        self.assertEqual(job.trace_id, upload.trace_id)
+        self.assertEqual(job, upload.parent)
+        self.assertEqual(100, job.bytes)
+        self.assertEqual(2, job.subprocesses)
+        self.assertEqual(1, upload.subprocesses)
+
+    def test_json_records(self):
+        """ Test that finished spans are written as JSON lines. """
+        # When
+        with self.assertRaises(ValueError):
+            with span('job', filesystem='test-pool'):
+                with span('check'):
+                    raise ValueError('Backup upload failed.')
+
+        # Then
+        with open(self.file_path) as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual(['check', 'job'], [r['name'] for r in records])
+        self.assertEqual(records[1]['span_id'], records[0]['parent_id'])
+        self.assertEqual('test-pool', records[1]['attributes']['filesystem'])
+        self.assertIn('Backup upload failed.', records[0]['error'])
+        self.assertGreaterEqual(records[0]['end'], records[0]['start'])
@@ -1,5 +1,6 @@
 import configparser
 import os
+import tempfile
 
 config = configparser.ConfigParser()
 
@@ -9,7 +10,9 @@ config['DEFAULT'] = {
     'access_key': os.environ['AWS_ACCESS_KEY_ID'],
     'secret_key': os.environ['AWS_SECRET_ACCESS_KEY'],
     'endpoint': os.environ['ENDPOINT'],
-    'storage_class': 'STANDARD'
+    'storage_class': 'STANDARD',
+    'catalog_path': os.path.join(tempfile.gettempdir(), 'zfs_uploader_test',
+                                 'catalog.db')
 }
 config['test-pool/test-filesystem'] = {
     'cron': '* * * * *',
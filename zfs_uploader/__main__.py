@@ -1,16 +1,26 @@
+from datetime import datetime, timedelta
+from fnmatch import fnmatch
+import json
 import logging
 import os
 import sys
 from logging.handlers import RotatingFileHandler
 
 import click
-from apscheduler.executors.pool import ThreadPoolExecutor
-from apscheduler.schedulers.background import BlockingScheduler
 
-from zfs_uploader import __version__
-from zfs_uploader.config import Config
+# modules that import boto3 or apscheduler are imported by the commands
+# that need them so that `zfsup --help` and `zfsup version` start fast
+from zfs_uploader import __version__, DATETIME_FORMAT
+from zfs_uploader.bench import (CONCURRENCIES, measure_s3, measure_send,
+                                PART_SIZES, recommend, S3_TEST_SIZE)
+from zfs_uploader.progress import PROGRESS, ProgressView
+from zfs_uploader.throttle import RateLimiter
+from zfs_uploader.tracing import (add_exporter, JSONExporter,
+                                  OpenTelemetryExporter, shutdown)
+from zfs_uploader.zfs import get_snapshot_send_size
 
 LOG_FORMAT = 'time=%(asctime)s.%(msecs)03d level=%(levelname)s %(message)s'
+MB = 1024 * 1024
 
 
 @click.group()
@@ -20,8 +30,13 @@ LOG_FORMAT = 'time=%(asctime)s.%(msecs)03d level=%(levelname)s %(message)s'
 @click.option('--log-path', default='zfs_uploader.log',
               help='Log file path.',
               show_default=True)
+@click.option('--trace-path',
+              help='Append job phase spans as JSON lines to this file.')
+@click.option('--otlp-endpoint',
+              help='Export job phase spans to an OpenTelemetry collector. '
+                   'Example: http://localhost:4317')
 @click.pass_context
-def cli(ctx, config_path, log_path):
+def cli(ctx, config_path, log_path, trace_path, otlp_endpoint):
     logger = logging.getLogger('zfs_uploader')
     logger.setLevel(logging.INFO)
     formatter = logging.Formatter(LOG_FORMAT, datefmt='%Y-%m-%dT%H:%M:%S')
@@ -37,91 +52,197 @@ def cli(ctx, config_path, log_path):
         print('No configuration file found.')
         sys.exit(1)
 
+    if trace_path:
+        add_exporter(JSONExporter(trace_path))
+    if otlp_endpoint:
+        try:
+            add_exporter(OpenTelemetryExporter(otlp_endpoint))
+        except ImportError as e:
+            print(e)
+            sys.exit(1)
+    ctx.call_on_close(shutdown)
+
     ctx.obj = {
         'config_path': config_path,
-        'logger': logger
+        'logger': logger,
+        'console_handler': ch
     }
 
 
 @cli.command()
+@click.option('--metrics-port', type=int,
+              help='Serve Prometheus metrics at /metrics on this port.')
+@click.option('--runtime', type=click.Choice(['threads', 'asyncio']),
+              default='threads', show_default=True,
+              help='Run jobs in a thread pool or on one asyncio event loop.')
 @click.pass_context
-def backup(ctx):
+def backup(ctx, metrics_port, runtime):
     """ Start backup job scheduler or run the tasks serially if
         cron is not provided in the config file.
     """
+    from zfs_uploader.config import Config
+    from zfs_uploader.daemon import Daemon
+    from zfs_uploader.maintenance import MaintenanceQueue
+    from zfs_uploader.metrics import start_http_server
+
     config_path = ctx.obj['config_path']
     logger = ctx.obj['logger']
 
     config = Config(config_path)
-    scheduler = BlockingScheduler(
-        executors={'default': ThreadPoolExecutor(max_workers=1)},
-        job_defaults={'misfire_grace_time': None}
-    )
-
-    for job in config.jobs.values():
-        if job.cron:
-            logger.info(f'filesystem={job.filesystem} '
-                        f'cron="{job.cron}" '
-                        'msg="Adding job."')
-            scheduler.add_job(job.start, 'cron', **job.cron, coalesce=True)
-        else:
-            logger.info(f'filesystem={job.filesystem}'
-                        'msg="Running job."')
-            job.start()
 
+    if metrics_port:
+        start_http_server(metrics_port)
+        logger.info(f'port={metrics_port} msg="Serving metrics."')
+
+    if runtime == 'asyncio':
+        _backup_asyncio(config)
+        return
+
+    # retention, verification and catalog compaction never hold the
+    # scheduler worker
+    maintenance = MaintenanceQueue(config.max_maintenance_jobs)
+    daemon = Daemon(config, maintenance)
     try:
-        if len(scheduler.get_jobs()) > 0:
-            scheduler.start()
+        daemon.start()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        maintenance.shutdown()
+        # other nodes take over right away instead of after the lease expired
+        for job in daemon.jobs.values():
+            job.release_lease()
+
+
+def _backup_asyncio(config):
+    """ Run all jobs on one asyncio event loop. """
+    from zfs_uploader.aio import AsyncRuntime
+    from zfs_uploader.maintenance import MaintenanceQueue
+
+    maintenance = MaintenanceQueue(config.max_maintenance_jobs)
+    try:
+        runtime = AsyncRuntime(list(config.jobs.values()), config.max_sends,
+                               config.max_parts, maintenance, config.catalog)
+    except ImportError as e:
+        print(e)
+        sys.exit(1)
+
+    try:
+        runtime.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        maintenance.shutdown()
+        # other nodes take over right away instead of after the lease expired
+        for job in config.jobs.values():
+            job.release_lease()
 
 
 @cli.command('list')
-@click.argument('filesystem', required=False)
+@click.option('--since',
+              help='Only list backups at or after this time. '
+                   'Format: %Y%m%d_%H%M%S')
+@click.option('--until',
+              help='Only list backups at or before this time. '
+                   'Format: %Y%m%d_%H%M%S')
+@click.option('--type', 'backup_type', type=click.Choice(['full', 'inc']),
+              help='Only list backups of this type.')
+@click.option('--min-size', type=int,
+              help='Only list backups of at least this many bytes.')
+@click.option('--max-size', type=int,
+              help='Only list backups of at most this many bytes.')
+@click.option('--stale', type=float,
+              help='List filesystems without a backup in the last STALE '
+                   'hours instead.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print JSON instead of a table.')
+@click.option('--refresh', is_flag=True,
+              help='Update the catalog from all backup.db files that '
+                   'changed.')
+@click.argument('patterns', nargs=-1)
 @click.pass_context
-def list_backups(ctx, filesystem):
-    """ List backups. """
+def list_backups(ctx, since, until, backup_type, min_size, max_size, stale,
+                 as_json, refresh, patterns):
+    """ List backups.
+
+    Lists the backups of all filesystems in the config file or the
+    filesystems matching any of the shell-style patterns. Backups are read
+    from the local catalog. Filesystems that are not in the catalog yet are
+    added first.
+
+    """
+    from zfs_uploader.catalog import sync_catalog
+    from zfs_uploader.config import Config
+
     config_path = ctx.obj['config_path']
     logger = ctx.obj['logger']
 
     logger.setLevel('CRITICAL')
 
     config = Config(config_path)
+    filesystems = [filesystem for filesystem in config.filesystems
+                   if not patterns or any(fnmatch(filesystem, pattern)
+                                          for pattern in patterns)]
 
-    if filesystem:
-        job = config.jobs.get(filesystem)
-        jobs = {filesystem: job}
-
-        if job is None:
-            print('Filesystem does not exist in config file.')
-            sys.exit(1)
+    if not filesystems:
+        print('No filesystems match.')
+        sys.exit(1)
 
+    catalog = config.catalog
+    if not refresh:
+        synced = set(catalog.get_filesystems())
+        outdated = [f for f in filesystems if f not in synced]
     else:
-        jobs = config.jobs
+        outdated = filesystems
+    if outdated:
+        sync_catalog(catalog, [config.get_job(f) for f in outdated])
+
+    if stale is not None:
+        cutoff = (datetime.now() -
+                  timedelta(hours=stale)).strftime(DATETIME_FORMAT)
+        last_backup_times = catalog.get_last_backup_times(filesystems)
+        stale_filesystems = [
+            {'filesystem': filesystem, 'last_backup_time': backup_time}
+            for filesystem, backup_time in last_backup_times.items()
+            if backup_time is None or backup_time < cutoff]
+
+        if as_json:
+            print(json.dumps(stale_filesystems, indent=2))
+        else:
+            for f in stale_filesystems:
+                print(f'{f["filesystem"]} {f["last_backup_time"]}')
+        return
 
-        if jobs is None:
-            print('No filesystems exist in config file.')
-            sys.exit(1)
+    backups = catalog.get_backups(filesystems, since, until, backup_type,
+                                  min_size, max_size)
+    if as_json:
+        print(json.dumps(backups, indent=2))
+        return
 
-    for filesystem, job in jobs.items():
+    backups_by_filesystem = {}
+    for b in backups:
+        backups_by_filesystem.setdefault(b['filesystem'], []).append(b)
+
+    for filesystem in filesystems:
         print(f'{filesystem}:\n')
         print('{0:<16} {1:<16} {2:<5} {3:<14}'.format('time', 'dependency',
                                                       'type', 'size (bytes)'))
         print('-'*52)
-        for b in job.backup_db.get_backups():
-            dependency = b.dependency or str(b.dependency)
-            backup_size = b.backup_size or str(b.backup_size)
-            print(f'{b.backup_time:<16} {dependency:<16} '
-                  f'{b.backup_type:<5} {backup_size:<14}')
+        for b in backups_by_filesystem.get(filesystem, []):
+            dependency = b['dependency'] or str(b['dependency'])
+            backup_size = b['backup_size'] or str(b['backup_size'])
+            print(f'{b["backup_time"]:<16} {dependency:<16} '
+                  f'{b["backup_type"]:<5} {backup_size:<14}')
         print('\n')
 
 
 @cli.command()
 @click.option('--destination', help='Destination filesystem.')
+@click.option('--subtree', help='Descendant filesystem to restore from a '
+                                'recursive backup.')
 @click.argument('filesystem')
 @click.argument('backup-time', required=False)
 @click.pass_context
-def restore(ctx, destination, filesystem, backup_time):
+def restore(ctx, destination, subtree, filesystem, backup_time):
     """ Restore from backup.
 
     Defaults to most recent backup if backup-time is not specified.
@@ -130,21 +251,293 @@ def restore(ctx, destination, filesystem, backup_time):
     and data that were written after the backup will be destroyed. Set
     `destination` in order to restore to a new file system.
 
+    Set `subtree` in order to restore a descendant filesystem from a
+    recursive backup. The subtree is restored to `destination` or to its
+    original name and the destination must not exist.
+
+    A live progress view is shown if stderr is a terminal.
+
     """
+    from zfs_uploader.config import Config
+
     config_path = ctx.obj['config_path']
 
     config = Config(config_path)
-    job = config.jobs.get(filesystem)
+    job = config.get_job(filesystem)
 
     if job is None:
         print('Filesystem does not exist.')
         sys.exit(1)
 
-    job.restore(backup_time, destination)
+    view = None
+    if sys.stderr.isatty():
+        # keep progress log lines from interleaving with the live view
+        ctx.obj['console_handler'].setLevel(logging.WARNING)
+        view = ProgressView(sys.stderr)
+        PROGRESS.add_view(view)
+
+    try:
+        job.restore(backup_time, destination, subtree)
+    finally:
+        if view:
+            PROGRESS.remove_view(view)
 
     print('Restore successful.')
 
 
+@cli.command('restore-all')
+@click.option('--backup-time',
+              help='Restore the most recent backup or snapshot at or before '
+                   'this time. Format: %Y%m%d_%H%M%S')
+@click.option('--max-workers', type=int,
+              help='Maximum number of filesystems restored in parallel. '
+                   'Defaults to max_parallel_jobs.')
+@click.option('--max-bandwidth', type=float,
+              help='Download bandwidth limit shared by all restores in MB/s.')
+@click.option('--pool-limit', type=int,
+              help='Maximum number of filesystems restored in parallel per '
+                   'pool.')
+@click.option('--order', type=click.Choice(['priority', 'smallest']),
+              default='priority', show_default=True,
+              help='Restore by descending restore_priority and then smallest '
+                   'first, or smallest first.')
+@click.argument('patterns', nargs=-1)
+@click.pass_context
+def restore_all(ctx, backup_time, max_workers, max_bandwidth, pool_limit,
+                order, patterns):
+    """ Restore many filesystems in parallel.
+
+    Restores all filesystems in the config file or the filesystems matching
+    any of the shell-style patterns. Example: `pool/data/*`
+
+    WARNING: Filesystems are restored in place. Snapshots and data that were
+    written after the restored backup will be destroyed.
+
+    """
+    from zfs_uploader.config import Config
+    from zfs_uploader.job import restore_jobs
+
+    config_path = ctx.obj['config_path']
+
+    config = Config(config_path)
+    jobs = [config.get_job(filesystem) for filesystem in config.filesystems
+            if not patterns or any(fnmatch(filesystem, pattern)
+                                   for pattern in patterns)]
+
+    if not jobs:
+        print('No filesystems match.')
+        sys.exit(1)
+
+    rate_limiter = None
+    if max_bandwidth:
+        rate_limiter = RateLimiter(max_bandwidth * MB)
+
+    view = None
+    if sys.stderr.isatty():
+        ctx.obj['console_handler'].setLevel(logging.WARNING)
+        view = ProgressView(sys.stderr)
+        PROGRESS.add_view(view)
+
+    try:
+        restored = restore_jobs(jobs, backup_time,
+                                max_workers or config.max_parallel_jobs,
+                                rate_limiter, pool_limit, order)
+    finally:
+        if view:
+            PROGRESS.remove_view(view)
+
+    print(f'Restored {len(restored)} filesystems.')
+
+
+@cli.command()
+@click.option('--backup-time',
+              help='Only verify the backups needed for restoring the most '
+                   'recent backup or snapshot at or before this time. '
+                   'Format: %Y%m%d_%H%M%S')
+@click.option('--structure', type=click.Choice(['none', 'parse', 'receive']),
+              default='parse', show_default=True,
+              help='Check the stream framing (parse) or pass the stream to '
+                   'zfs receive --dryrun (receive).')
+@click.option('--max-workers', type=int,
+              help='Maximum number of backups verified in parallel. '
+                   'Defaults to max_parallel_jobs.')
+@click.option('--max-bandwidth', type=float,
+              help='Download bandwidth limit shared by all verifications in '
+                   'MB/s.')
+@click.argument('patterns', nargs=-1)
+@click.pass_context
+def verify(ctx, backup_time, structure, max_workers, max_bandwidth,
+           patterns):
+    """ Verify backups without restoring them.
+
+    Downloads the backups of all filesystems in the config file or the
+    filesystems matching any of the shell-style patterns and checks their
+    size, checksum and structure. Results are recorded in `backup.db`.
+
+    """
+    from zfs_uploader.config import Config
+    from zfs_uploader.job import verify_jobs
+
+    config_path = ctx.obj['config_path']
+
+    config = Config(config_path)
+    jobs = [config.get_job(filesystem) for filesystem in config.filesystems
+            if not patterns or any(fnmatch(filesystem, pattern)
+                                   for pattern in patterns)]
+
+    if not jobs:
+        print('No filesystems match.')
+        sys.exit(1)
+
+    rate_limiter = None
+    if max_bandwidth:
+        rate_limiter = RateLimiter(max_bandwidth * MB)
+
+    view = None
+    if sys.stderr.isatty():
+        ctx.obj['console_handler'].setLevel(logging.WARNING)
+        view = ProgressView(sys.stderr)
+        PROGRESS.add_view(view)
+
+    try:
+        verifications = verify_jobs(jobs, backup_time,
+                                    max_workers or config.max_parallel_jobs,
+                                    rate_limiter, structure)
+    finally:
+        if view:
+            PROGRESS.remove_view(view)
+
+    for v in verifications:
+        line = f'{v.filesystem}@{v.backup_time} {v.status}'
+        print(line + (f' {v.error}' if v.error else ''))
+
+    failed = [v for v in verifications if v.status != 'passed']
+    print(f'Verified {len(verifications)} backups. {len(failed)} failed.')
+    if failed:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--dry-run', is_flag=True,
+              help='Show what would be deleted without deleting anything.')
+@click.argument('patterns', nargs=-1)
+@click.pass_context
+def prune(ctx, dry_run, patterns):
+    """ Apply snapshot and backup retention.
+
+    Applies max_snapshots, max_backups and the keep_hourly, keep_daily,
+    keep_weekly and keep_monthly rules to all filesystems in the config
+    file or the filesystems matching any of the shell-style patterns.
+
+    """
+    from zfs_uploader.config import Config
+
+    config_path = ctx.obj['config_path']
+
+    config = Config(config_path)
+    jobs = [config.get_job(filesystem) for filesystem in config.filesystems
+            if not patterns or any(fnmatch(filesystem, pattern)
+                                   for pattern in patterns)]
+
+    if not jobs:
+        print('No filesystems match.')
+        sys.exit(1)
+
+    action = 'would delete' if dry_run else 'deleted'
+    for job in jobs:
+        snapshot_plan, backup_plan = job.prune(dry_run)
+
+        if snapshot_plan:
+            for name in snapshot_plan.delete:
+                print(f'{job.filesystem}@{name} snapshot {action}')
+
+        if backup_plan and dry_run:
+            for name in backup_plan.keep:
+                reasons = ', '.join(backup_plan.reasons[name])
+                print(f'{job.filesystem}@{name} backup keep ({reasons})')
+        if backup_plan:
+            for name in backup_plan.delete:
+                print(f'{job.filesystem}@{name} backup {action}')
+
+
+@cli.command()
+@click.option('--size', type=int, default=S3_TEST_SIZE // MB,
+              help='Size of the temporary S3 test objects in MiB.',
+              show_default=True)
+@click.option('--part-sizes',
+              default=','.join(str(p // MB) for p in PART_SIZES),
+              help='Comma separated part sizes in MiB.', show_default=True)
+@click.option('--concurrency',
+              default=','.join(str(c) for c in CONCURRENCIES),
+              help='Comma separated concurrency levels.', show_default=True)
+@click.option('--skip-send', is_flag=True,
+              help='Skip measuring zfs send throughput.')
+@click.argument('filesystem')
+@click.pass_context
+def bench(ctx, size, part_sizes, concurrency, skip_send, filesystem):
+    """ Measure send and S3 throughput and recommend settings.
+
+    `zfs send` throughput is measured by reading the most recent snapshot of
+    the filesystem and discarding the stream. S3 PUT and GET throughput is
+    measured with temporary objects for every part size and concurrency.
+
+    """
+    from zfs_uploader.config import Config
+
+    config_path = ctx.obj['config_path']
+
+    config = Config(config_path)
+    job = config.get_job(filesystem)
+
+    if job is None:
+        print('Filesystem does not exist.')
+        sys.exit(1)
+
+    try:
+        part_sizes = [int(p) * MB for p in part_sizes.split(',')]
+        concurrencies = [int(c) for c in concurrency.split(',')]
+    except ValueError:
+        print('Part sizes and concurrency must be comma separated integers.')
+        sys.exit(1)
+
+    send_speed = None
+    send_size = None
+    snapshots = job.snapshot_db.get_snapshot_names()
+    if skip_send:
+        pass
+    elif not snapshots:
+        print('No snapshots to send. Skipping zfs send measurement.\n')
+    else:
+        send_size = int(get_snapshot_send_size(filesystem, snapshots[-1],
+                                               job.recursive,
+                                               job.send_profile))
+        send_speed = measure_send(filesystem, snapshots[-1], job.recursive,
+                                  send_profile=job.send_profile)
+
+    results = measure_s3(job.bucket, filesystem, job.prefix, size * MB,
+                         part_sizes, concurrencies)
+
+    print(f'{filesystem}:\n')
+    if send_speed is not None:
+        print(f'zfs send: {send_speed / MB:.1f} MB/s\n')
+
+    print('{0:<12} {1:<12} {2:<12} {3:<12}'.format(
+        'part (MiB)', 'concurrency', 'PUT (MB/s)', 'GET (MB/s)'))
+    print('-'*51)
+    for r in results:
+        print(f'{r.part_size // MB:<12} {r.concurrency:<12} '
+              f'{r.upload_speed / MB:<12.1f} {r.download_speed / MB:<12.1f}')
+    print('')
+
+    rec = recommend(send_speed, results, send_size, job.max_multipart_parts)
+    print(f'Bottleneck: {rec.bottleneck}')
+    print(f'Expected backup speed: {rec.expected_speed / MB:.1f} MB/s\n')
+    print('Recommended config:\n')
+    print(f'[{filesystem}]')
+    for k, v in rec.settings.items():
+        print(f'{k} = {v}')
+
+
 @cli.command(help='Print version.')
 def version():
     print(__version__)
@@ -0,0 +1,476 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from datetime import datetime
+import functools
+import hashlib
+import logging
+import signal
+import threading
+import time
+
+from apscheduler.triggers.cron import CronTrigger
+
+from zfs_uploader.endpoints import get_endpoint_pool
+from zfs_uploader.job import _get_transfer_config, S3_MAX_ATTEMPTS
+from zfs_uploader.metrics import (JOB_FAILURES, PARTS_IN_FLIGHT,
+                                  PHASE_DURATION, QUEUE_WAIT)
+from zfs_uploader.progress import PROGRESS
+from zfs_uploader.snapshot_db import create_snapshots
+from zfs_uploader.tracing import span
+from zfs_uploader.utils import derive_s3_key
+from zfs_uploader.zfs import (get_snapshot_send_size,
+                              get_snapshot_send_size_inc,
+                              open_snapshot_stream_async,
+                              open_snapshot_stream_inc_async, ZFSError)
+
+ASYNC_MAX_SENDS = 16
+ASYNC_MAX_PARTS = 64
+
+
+class AsyncRuntime:
+    """ Run scheduled backup jobs on one asyncio event loop.
+
+    `zfs send` pipes and S3 part uploads run on the event loop with an
+    aiobotocore client per set of credentials. Short `zfs` commands and
+    `backup.db` requests run in a thread pool with one thread per send.
+    Memory is bounded by the number of parts in flight.
+    """
+
+    @property
+    def max_sends(self):
+        """ Maximum number of jobs sending at the same time. """
+        return self._max_sends
+
+    @property
+    def max_parts(self):
+        """ Maximum number of S3 parts in flight across all jobs. """
+        return self._max_parts
+
+    def __init__(self, jobs, max_sends=None, max_parts=None,
+                 maintenance=None, catalog=None):
+        """ Create AsyncRuntime object.
+
+        Parameters
+        ----------
+        jobs : list(ZFSjob)
+        max_sends : int, default: 16
+            Maximum number of jobs sending at the same time.
+        max_parts : int, default: 64
+            Maximum number of S3 parts in flight across all jobs.
+        maintenance : MaintenanceQueue, optional
+            Queue that retention, verification and catalog compaction are
+            deferred to. Retention runs right after the upload if not
+            provided.
+        catalog : Catalog, optional
+            Catalog compacted after each scheduled run.
+
+        Raises
+        ------
+        ImportError
+            If aiobotocore is not installed.
+
+        """
+        try:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+        except ImportError:
+            raise ImportError('The asyncio runtime requires the '
+                              'aiobotocore package.')
+
+        self._jobs = jobs
+        self._max_sends = max_sends or ASYNC_MAX_SENDS
+        self._max_parts = max_parts or ASYNC_MAX_PARTS
+        self._maintenance = maintenance
+        self._catalog = catalog
+        self._aio_config = AioConfig
+        self._session = get_session()
+        self._logger = logging.getLogger(__name__)
+
+        self._clients = {}
+        self._client_contexts = []
+        self._clients_lock = None
+        self._executor = None
+        self._sends = None
+        self._parts = None
+
+    def run(self):
+        """ Run unscheduled jobs once and scheduled jobs until stopped. """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._main())
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    async def _main(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._max_sends, thread_name_prefix='aio')
+        self._sends = asyncio.Semaphore(self._max_sends)
+        self._parts = asyncio.Semaphore(self._max_parts)
+        self._clients_lock = asyncio.Lock()
+
+        # jobs that share a schedule are snapshotted together
+        job_groups = {}
+        tasks = []
+        for job in self._jobs:
+            if job.cron:
+                self._logger.info(f'filesystem={job.filesystem} '
+                                  f'cron="{job.cron}" '
+                                  'msg="Adding job."')
+                cron_key = tuple(sorted(job.cron.items()))
+                job_groups.setdefault(cron_key, []).append(job)
+            else:
+                self._logger.info(f'filesystem={job.filesystem} '
+                                  'msg="Running job."')
+                tasks.append(self._run_group([job], time.time()))
+
+        for cron_key, jobs in job_groups.items():
+            tasks.append(self._schedule(jobs, CronTrigger(**dict(cron_key))))
+
+        # SIGHUP would otherwise stop the process, e.g. on systemctl reload
+        loop = asyncio.get_event_loop()
+        sighup = hasattr(signal, 'SIGHUP') and \
+            threading.current_thread() is threading.main_thread()
+        if sighup:
+            loop.add_signal_handler(signal.SIGHUP, self._on_sighup)
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if sighup:
+                loop.remove_signal_handler(signal.SIGHUP)
+            for context in self._client_contexts:
+                await context.__aexit__(None, None, None)
+            self._executor.shutdown(wait=True)
+
+    def _on_sighup(self):
+        self._logger.error('msg="Reloading the configuration file is not '
+                           'supported by the asyncio runtime. Restart in '
+                           'order to apply changes."')
+
+    async def _schedule(self, jobs, trigger):
+        """ Run job group at every fire time of the trigger. """
+        previous = None
+        while True:
+            now = datetime.now(trigger.timezone)
+            fire_time, previous = get_next_fire_time(trigger, previous, now)
+            if fire_time is None:
+                return
+
+            await asyncio.sleep(max((fire_time - now).total_seconds(), 0))
+            await self._run_group(jobs, fire_time.timestamp())
+
+    async def _run_group(self, jobs, scheduled_time):
+        """ Snapshot jobs together and back them up concurrently. """
+        filesystems = [job.filesystem for job in jobs]
+        try:
+            # filesystems leased by other nodes are skipped
+            leased = await asyncio.gather(
+                *(self._in_thread(job.acquire_lease) for job in jobs),
+                return_exceptions=True)
+            for job, result in zip(jobs, leased):
+                if isinstance(result, Exception):
+                    JOB_FAILURES.inc(filesystem=job.filesystem)
+                    self._logger.error(f'filesystem={job.filesystem} '
+                                       'msg="Failed to acquire lease." '
+                                       f'error="{result}"')
+            jobs = [job for job, ok in zip(jobs, leased) if ok is True]
+            filesystems = [job.filesystem for job in jobs]
+            if not jobs:
+                return
+
+            with span('snapshot', filesystems=filesystems) as s:
+                snapshots = await self._in_thread(
+                    create_snapshots, [job.snapshot_db for job in jobs])
+            for filesystem in filesystems:
+                PHASE_DURATION.observe(s.duration, filesystem=filesystem,
+                                       phase='snapshot')
+
+            results = await asyncio.gather(
+                *(self._start_job(job, snapshots[job.filesystem],
+                                  scheduled_time) for job in jobs),
+                return_exceptions=True)
+        except Exception as e:
+            self._logger.error(f'filesystems="{",".join(filesystems)}" '
+                               f'msg="Snapshot failed." error="{e}"')
+            return
+
+        for filesystem, result in zip(filesystems, results):
+            if isinstance(result, BaseException):
+                self._logger.error(f'filesystem={filesystem} '
+                                   f'msg="Job failed." error="{result}"')
+
+        if self._maintenance is not None and self._catalog is not None:
+            self._maintenance.submit(
+                'compact_catalog',
+                functools.partial(self._catalog.compact,
+                                  [job.filesystem for job in self._jobs]))
+
+    async def _start_job(self, job, snapshot, scheduled_time):
+        """ Back up a snapshot with the semantics of `ZFSjob.start`. """
+        async with self._sends:
+            QUEUE_WAIT.observe(max(time.time() - scheduled_time, 0),
+                               filesystem=job.filesystem)
+
+            if job.spool:
+                # spooled uploads read from local disk with the thread code
+                await self._in_thread(job.start, snapshot, self._maintenance)
+                return
+
+            await self._in_thread(job.acquire_backup_lock)
+            try:
+                with job.run_backup():
+                    await self._backup(job, snapshot)
+            finally:
+                job.release_backup_lock()
+
+            if self._maintenance is not None:
+                self._maintenance.submit('maintain', job.maintain,
+                                         job.filesystem)
+            else:
+                await self._in_thread(job.prune)
+
+    async def _backup(self, job, snapshot):
+        """ Upload full or incremental backup of a snapshot. """
+        base = await self._in_thread(job.get_backup_source)
+        backup_time = snapshot.name
+        filesystem = snapshot.filesystem
+        backup_type = 'full' if base is None else 'inc'
+
+        with job.trace_phase('send_size'):
+            if base is None:
+                send_size = await self._in_thread(
+                    get_snapshot_send_size, filesystem, backup_time,
+                    job.recursive, job.send_profile)
+            else:
+                send_size = await self._in_thread(
+                    get_snapshot_send_size_inc, filesystem, base,
+                    backup_time, job.recursive, job.send_intermediate,
+                    job.send_profile)
+        send_size = int(send_size)
+
+        snapshots = None
+        if base is not None and job.send_intermediate:
+            snapshots = await self._in_thread(
+                job.snapshot_db.get_snapshot_names_between, base,
+                backup_time)
+
+        s3_key = derive_s3_key(f'{backup_time}.{backup_type}', filesystem,
+                               job.prefix)
+        name = 'full' if base is None else 'incremental'
+
+        self._logger.info(f'filesystem={filesystem} '
+                          f'snapshot_name={backup_time} '
+                          f's3_key={s3_key} '
+                          f'msg="Starting {name} backup."')
+
+        client = await self._get_client(job)
+        with job.trace_phase('upload', s3_key=s3_key, send_size=send_size,
+                             spooled=False):
+            if base is None:
+                process = await open_snapshot_stream_async(
+                    filesystem, backup_time, job.recursive, job.send_profile)
+            else:
+                process = await open_snapshot_stream_inc_async(
+                    filesystem, base, backup_time, job.recursive,
+                    job.send_intermediate, job.send_profile)
+            checksum = await self._upload_stream(
+                job, client, process, s3_key, send_size, backup_time)
+
+        await self._in_thread(job.record_backup, backup_time, backup_type,
+                              s3_key, checksum, base, snapshots)
+
+        self._logger.info(f'filesystem={filesystem} '
+                          f'snapshot_name={backup_time} '
+                          f's3_key={s3_key} '
+                          f'msg="Finished {name} backup."')
+
+    async def _upload_stream(self, job, client, process, s3_key, send_size,
+                             backup_time):
+        """ Upload `zfs send` output and return its SHA-256 digest.
+
+        The stream is only completed if `zfs send` succeeded. Stalled
+        uploads are cancelled by the progress engine and uploads are
+        cancelled if the lease is lost.
+        """
+        loop = asyncio.get_event_loop()
+        task = asyncio.current_task()
+        stderr = asyncio.ensure_future(process.stderr.read())
+
+        with PROGRESS.track(job.filesystem, backup_time, s3_key, send_size,
+                            stall_timeout=job.stall_timeout) as transfer:
+            def cancel():
+                loop.call_soon_threadsafe(task.cancel)
+
+            try:
+                with job.watch_transfer(transfer, cancel):
+                    return await self._upload_parts(job, client, process,
+                                                    s3_key, send_size,
+                                                    transfer, stderr)
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                stderr.cancel()
+
+    async def _upload_parts(self, job, client, process, s3_key, send_size,
+                            transfer, stderr):
+        bucket_name = job.bucket.name
+        part_size = _get_transfer_config(send_size, job.max_multipart_parts,
+                                         job.max_concurrency,
+                                         job.min_part_size).multipart_chunksize
+        digest = hashlib.sha256()
+
+        async def check_send():
+            if await process.wait():
+                raise ZFSError((await stderr).decode('utf-8'))
+
+        # a part is only read once it has a slot, which bounds memory
+        async with self._parts:
+            data = await read_part(process.stdout, part_size)
+            if len(data) < part_size:
+                digest.update(data)
+                await check_send()
+                await client.put_object(Bucket=bucket_name, Key=s3_key,
+                                        Body=data,
+                                        StorageClass=job.storage_class)
+                transfer.callback(len(data))
+                return digest.hexdigest()
+
+        response = await client.create_multipart_upload(
+            Bucket=bucket_name, Key=s3_key, StorageClass=job.storage_class)
+        upload_id = response['UploadId']
+
+        etags = {}
+        tasks = set()
+        try:
+            part_number = 1
+            while True:
+                digest.update(data)
+                await self._parts.acquire()
+                task = asyncio.ensure_future(self._upload_part(
+                    job, client, s3_key, upload_id, part_number, data,
+                    transfer, etags))
+                # the slot is released even if the task never started
+                task.add_done_callback(lambda t: self._parts.release())
+                tasks.add(task)
+                part_number += 1
+
+                # raise errors of finished parts early
+                for t in [t for t in tasks if t.done()]:
+                    tasks.discard(t)
+                    t.result()
+
+                async with self._parts:
+                    data = await read_part(process.stdout, part_size)
+                if not data:
+                    break
+
+            await asyncio.gather(*tasks)
+            await check_send()
+            await client.complete_multipart_upload(
+                Bucket=bucket_name, Key=s3_key, UploadId=upload_id,
+                MultipartUpload={'Parts': [
+                    {'ETag': etags[n], 'PartNumber': n}
+                    for n in sorted(etags)]})
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.shield(client.abort_multipart_upload(
+                Bucket=bucket_name, Key=s3_key, UploadId=upload_id))
+            raise
+
+        return digest.hexdigest()
+
+    async def _upload_part(self, job, client, s3_key, upload_id,
+                           part_number, data, transfer, etags):
+        PARTS_IN_FLIGHT.inc(filesystem=job.filesystem)
+        try:
+            response = await client.upload_part(
+                Bucket=job.bucket.name, Key=s3_key, UploadId=upload_id,
+                PartNumber=part_number, Body=data)
+        finally:
+            PARTS_IN_FLIGHT.dec(filesystem=job.filesystem)
+        etags[part_number] = response['ETag']
+        transfer.callback(len(data))
+
+    async def _get_client(self, job):
+        """ Get S3 client shared by all jobs with the same credentials. """
+        key = (job.region, tuple(job.endpoints), job.access_key,
+               job.secret_key, job.request_timeout)
+        async with self._clients_lock:
+            client = self._clients.get(key)
+            if client is None:
+                # standard retry mode uses exponential backoff with jitter
+                config = self._aio_config(
+                    connect_timeout=job.request_timeout,
+                    read_timeout=job.request_timeout,
+                    retries={'max_attempts': S3_MAX_ATTEMPTS,
+                             'mode': 'standard'},
+                    max_pool_connections=self._max_parts)
+                context = self._session.create_client(
+                    's3', region_name=job.region, endpoint_url=job.endpoint,
+                    aws_access_key_id=job.access_key,
+                    aws_secret_access_key=job.secret_key, config=config)
+                client = await context.__aenter__()
+                if len(job.endpoints) > 1:
+                    get_endpoint_pool(job.endpoints).instrument(client)
+                self._clients[key] = client
+                self._client_contexts.append(context)
+        return client
+
+    async def _in_thread(self, fn, *args):
+        """ Run blocking call in the thread pool keeping the span. """
+        fn = functools.partial(contextvars.copy_context().run, fn)
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, functools.partial(fn, *args))
+
+
+async def read_part(stream, size):
+    """ Read up to size bytes. Less bytes are only returned at the end.
+
+    Parameters
+    ----------
+    stream : asyncio.StreamReader
+    size : int
+
+    Returns
+    -------
+    bytes
+
+    """
+    try:
+        return await stream.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+def get_next_fire_time(trigger, previous, now):
+    """ Get next fire time of a trigger.
+
+    Fire times missed while the previous run was still running are
+    coalesced into one run that starts right away.
+
+    Parameters
+    ----------
+    trigger : apscheduler.triggers.base.BaseTrigger
+    previous : datetime
+        Fire time of the previous run. None for the first run.
+    now : datetime
+
+    Returns
+    -------
+    tuple(datetime, datetime)
+        Next fire time and the value of `previous` for the following call.
+        The fire time is None if the trigger won't fire again.
+
+    """
+    fire_time = trigger.get_next_fire_time(previous, now)
+    if fire_time is None:
+        return None, previous
+    if fire_time <= now:
+        # skip the remaining missed fire times
+        return fire_time, now
+    return fire_time, fire_time
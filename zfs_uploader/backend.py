@@ -0,0 +1,387 @@
+from itertools import groupby
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from zfs_uploader import zfs
+
+KB = 1024
+MB = KB * KB
+CHANNEL_PROGRAM_INSTRUCTION_LIMIT = 100_000_000
+CHANNEL_PROGRAM_MEMORY_LIMIT = 100 * MB
+
+LIST_SNAPSHOTS_PROGRAM = '''
+local argv = (...)["argv"]
+local snapshots = {}
+for _, filesystem in ipairs(argv) do
+    if zfs.exists(filesystem) then
+        for snapshot in zfs.list.snapshots(filesystem) do
+            snapshots[snapshot] = {
+                used = zfs.get_prop(snapshot, "used"),
+                referenced = zfs.get_prop(snapshot, "referenced"),
+                createtxg = zfs.get_prop(snapshot, "createtxg")
+            }
+        end
+    end
+end
+return snapshots
+'''
+
+LIST_FILESYSTEMS_PROGRAM = '''
+local argv = (...)["argv"]
+local filesystems = {}
+local function walk(filesystem)
+    filesystems[filesystem] = true
+    for child in zfs.list.children(filesystem) do
+        walk(child)
+    end
+end
+if zfs.exists(argv[1]) then
+    walk(argv[1])
+end
+return filesystems
+'''
+
+# argv: action, recursive flag, comma separated filesystems, snapshot names
+SYNC_SNAPSHOTS_PROGRAM = '''
+local argv = (...)["argv"]
+local action, recursive = argv[1], argv[2] == "1"
+local targets = {}
+local function add(filesystem, name)
+    local snapshot = filesystem .. "@" .. name
+    if action == "snapshot" or zfs.exists(snapshot) then
+        targets[#targets + 1] = snapshot
+    end
+    if recursive then
+        for child in zfs.list.children(filesystem) do
+            add(child, name)
+        end
+    end
+end
+for filesystem in string.gmatch(argv[3], "[^,]+") do
+    for i = 4, #argv do
+        add(filesystem, argv[i])
+    end
+end
+
+-- check everything first so that the program changes all or nothing
+local errors = {}
+local failed = false
+for _, snapshot in ipairs(targets) do
+    local err
+    if action == "snapshot" then
+        err = zfs.check.snapshot(snapshot)
+    else
+        err = zfs.check.destroy(snapshot)
+    end
+    if err ~= 0 then
+        errors[snapshot] = err
+        failed = true
+    end
+end
+if failed then
+    return errors
+end
+
+for _, snapshot in ipairs(targets) do
+    local err
+    if action == "snapshot" then
+        err = zfs.sync.snapshot(snapshot)
+    else
+        err = zfs.sync.destroy(snapshot)
+    end
+    if err ~= 0 then
+        errors[snapshot] = err
+    end
+end
+return errors
+'''
+
+
+class ZFSBackend:
+    """ Baseclass for ZFS backends.
+
+    Backends implement listing, creating and destroying snapshots. Send and
+    receive streams always use the `zfs` CLI.
+    """
+    name = None
+
+    def list_snapshots(self, filesystems=None):
+        """ List snapshots.
+
+        Parameters
+        ----------
+        filesystems : list(str), optional
+            Only list snapshots of these filesystems. Lists all snapshots if
+            not provided.
+
+        Returns
+        -------
+        dict
+            Snapshot properties `USED` and `REFER` keyed by
+            `filesystem@name`. Ordered by creation.
+
+        """
+        raise NotImplementedError
+
+    def list_filesystems(self, filesystem):
+        """ List filesystem and descendant filesystems.
+
+        Returns
+        -------
+        list(str)
+            Empty if the filesystem does not exist.
+
+        """
+        raise NotImplementedError
+
+    def create_snapshots(self, filesystems, name, recursive=False):
+        """ Create snapshot of multiple filesystems atomically.
+
+        Raises
+        ------
+        ZFSError
+
+        """
+        raise NotImplementedError
+
+    def destroy_snapshots(self, filesystem, names, recursive=False):
+        """ Destroy multiple snapshots of a filesystem.
+
+        Raises
+        ------
+        ZFSError
+
+        """
+        raise NotImplementedError
+
+
+class CLIBackend(ZFSBackend):
+    """ Backend running one `zfs` command per operation. """
+    name = 'cli'
+
+    def list_snapshots(self, filesystems=None):
+        return zfs.list_snapshots(filesystems)
+
+    def list_filesystems(self, filesystem):
+        return zfs.list_filesystems(filesystem)
+
+    def create_snapshots(self, filesystems, name, recursive=False):
+        out = zfs.create_snapshots(filesystems, name, recursive)
+        if out.returncode:
+            raise zfs.ZFSError(out.stderr)
+
+    def destroy_snapshots(self, filesystem, names, recursive=False):
+        if not names:
+            return
+        out = zfs.destroy_snapshots(filesystem, names, recursive)
+        if out.returncode:
+            raise zfs.ZFSError(out.stderr)
+
+
+class LibZFSCoreBackend(ZFSBackend):
+    """ Backend creating and destroying snapshots in-process.
+
+    Uses the `libzfs_core` Python bindings (pyzfs). libzfs_core has no
+    listing API so snapshots are listed with the fallback backend.
+    """
+    name = 'libzfs_core'
+
+    def __init__(self, fallback=None):
+        """ Create LibZFSCoreBackend object.
+
+        Parameters
+        ----------
+        fallback : ZFSBackend, optional
+            Backend used for listing. Defaults to the CLI backend.
+
+        Raises
+        ------
+        ImportError
+            If pyzfs is not installed.
+
+        """
+        import libzfs_core
+        import libzfs_core.exceptions
+
+        self._lzc = libzfs_core
+        self._fallback = fallback or CLIBackend()
+
+    def list_snapshots(self, filesystems=None):
+        return self._fallback.list_snapshots(filesystems)
+
+    def list_filesystems(self, filesystem):
+        return self._fallback.list_filesystems(filesystem)
+
+    def create_snapshots(self, filesystems, name, recursive=False):
+        targets = self._get_targets(filesystems, name, recursive)
+        # all snapshots of one call have to be in the same pool
+        for _, snapshots in groupby(sorted(targets), key=_get_pool):
+            try:
+                self._lzc.lzc_snapshot(list(snapshots))
+            except self._lzc.exceptions.ZFSError as e:
+                raise zfs.ZFSError(_format_lzc_error(e)) from None
+
+    def destroy_snapshots(self, filesystem, names, recursive=False):
+        # snapshots that don't exist are ignored by libzfs_core
+        targets = self._get_targets([filesystem], names, recursive)
+        if not targets:
+            return
+        try:
+            self._lzc.lzc_destroy_snaps(targets, defer=False)
+        except self._lzc.exceptions.ZFSError as e:
+            raise zfs.ZFSError(_format_lzc_error(e)) from None
+
+    def _get_filesystems(self, filesystems, recursive):
+        if not recursive:
+            return list(filesystems)
+        return [name for filesystem in filesystems
+                for name in self.list_filesystems(filesystem)]
+
+    def _get_targets(self, filesystems, names, recursive):
+        if isinstance(names, str):
+            names = [names]
+        return [f'{filesystem}@{name}'.encode('utf-8')
+                for filesystem in self._get_filesystems(filesystems,
+                                                        recursive)
+                for name in names]
+
+
+class ChannelProgramBackend(ZFSBackend):
+    """ Backend batching operations with `zfs program` channel programs.
+
+    A channel program lists, creates or destroys any number of snapshots of
+    a pool with one `zfs` command. Snapshots created or destroyed by one
+    program are changed atomically within one transaction group. Requires
+    root.
+    """
+    name = 'channel_program'
+
+    def __init__(self):
+        """ Create ChannelProgramBackend object. """
+        self._scripts = {}
+        self._lock = threading.Lock()
+
+    def list_snapshots(self, filesystems=None):
+        if not filesystems:
+            return zfs.list_snapshots()
+
+        snapshots = []
+        for pool, names in _group_by_pool(filesystems):
+            result = self._run(pool, LIST_SNAPSHOTS_PROGRAM, names,
+                               sync=False)
+            snapshots.extend(result.items())
+
+        snapshots.sort(key=lambda item: int(item[1]['createtxg']))
+        return {name: {'USED': str(props['used']),
+                       'REFER': str(props['referenced'])}
+                for name, props in snapshots}
+
+    def list_filesystems(self, filesystem):
+        result = self._run(_get_pool(filesystem), LIST_FILESYSTEMS_PROGRAM,
+                           [filesystem], sync=False)
+        return sorted(result)
+
+    def create_snapshots(self, filesystems, name, recursive=False):
+        self._sync_snapshots('snapshot', filesystems, [name], recursive)
+
+    def destroy_snapshots(self, filesystem, names, recursive=False):
+        if names:
+            self._sync_snapshots('destroy', [filesystem], names, recursive)
+
+    def _sync_snapshots(self, action, filesystems, names, recursive):
+        for pool, pool_filesystems in _group_by_pool(filesystems):
+            args = [action, '1' if recursive else '0',
+                    ','.join(pool_filesystems)] + list(names)
+            errors = self._run(pool, SYNC_SNAPSHOTS_PROGRAM, args)
+            if errors:
+                raise zfs.ZFSError(
+                    f'Channel program failed to {action} snapshots: ' +
+                    ', '.join(f'{snapshot} ({os.strerror(int(err))})'
+                              for snapshot, err in sorted(errors.items())))
+
+    def _run(self, pool, program, args, sync=True):
+        out = zfs.run_channel_program(
+            pool, self._get_script(program), args, sync,
+            instruction_limit=CHANNEL_PROGRAM_INSTRUCTION_LIMIT,
+            memory_limit=CHANNEL_PROGRAM_MEMORY_LIMIT)
+        # standard output is empty if the channel program failed
+        if out.returncode or not out.stdout:
+            raise zfs.ZFSError(out.stderr)
+
+        return json.loads(out.stdout).get('return') or {}
+
+    def _get_script(self, program):
+        with self._lock:
+            path = self._scripts.get(program)
+            if path is None:
+                fd, path = tempfile.mkstemp(prefix='zfsup_', suffix='.lua')
+                with os.fdopen(fd, 'w') as f:
+                    f.write(program)
+                self._scripts[program] = path
+            return path
+
+
+BACKENDS = {
+    CLIBackend.name: CLIBackend,
+    LibZFSCoreBackend.name: LibZFSCoreBackend,
+    ChannelProgramBackend.name: ChannelProgramBackend
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    """ Get shared backend instance.
+
+    Falls back to the CLI backend if the backend's dependencies are not
+    installed.
+
+    Parameters
+    ----------
+    name : str, default: cli
+        Supported backends are `cli`, `libzfs_core` and `channel_program`.
+
+    Returns
+    -------
+    ZFSBackend
+
+    """
+    name = name or CLIBackend.name
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown ZFS backend {name}. Supported backends '
+                         f'are {", ".join(BACKENDS)}.')
+
+    with _backends_lock:
+        backend = _backends.get(name)
+        if backend is None:
+            try:
+                backend = BACKENDS[name]()
+            except ImportError as e:
+                logging.getLogger(__name__).warning(
+                    f'zfs_backend={name} msg="Backend is not available. '
+                    f'Falling back to the CLI backend." error="{e}"')
+                backend = _backends.get(CLIBackend.name) or CLIBackend()
+            _backends[name] = backend
+        return backend
+
+
+def _get_pool(name):
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    return name.split('/')[0].split('@')[0]
+
+
+def _group_by_pool(filesystems):
+    return [(pool, list(names)) for pool, names in
+            groupby(sorted(filesystems), key=_get_pool)]
+
+
+def _format_lzc_error(error):
+    errors = getattr(error, 'errors', None)
+    if errors:
+        return '; '.join(str(e) for e in errors)
+    return str(error)
@@ -1,11 +1,29 @@
-from datetime import datetime
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import inspect
 import json
+import logging
+import threading
+import uuid
 
-from botocore.exceptions import ClientError # noqa
+from botocore.exceptions import BotoCoreError, ClientError # noqa
 
 from zfs_uploader import BACKUP_DB_FILE, DATETIME_FORMAT
-from zfs_uploader.utils import derive_s3_key
+from zfs_uploader.metrics import BACKUP_DB_SIZE
+from zfs_uploader.tracing import span
+from zfs_uploader.utils import derive_s3_key, is_write_conflict
+
+# attempts of a change that conflicts with changes of other nodes
+BACKUP_DB_MAX_ATTEMPTS = 5
+# layout of a backup.db head index pointing to monthly shards
+SHARD_LAYOUT = 'monthly'
+SHARD_MAX_WORKERS = 16
+# seconds until a shard no head index references is deleted
+SHARD_ORPHAN_AGE = 86400
+
+
+class BackupDBConflictError(Exception):
+    """ `backup.db` was changed by another node. """
 
 
 class BackupDB:
@@ -16,11 +34,26 @@ class BackupDB:
         """ ZFS filesystem. """
         return self._filesystem
 
-    def __init__(self, bucket, filesystem, s3_prefix=None):
+    @property
+    def sharded(self):
+        """ True if `backup.db` is split into monthly shards. """
+        with self._lock:
+            self._load_head()
+            return self._shards is not None
+
+    def __init__(self, bucket, filesystem, s3_prefix=None, catalog=None,
+                 shard=False):
         """ Create BackupDB object.
 
         BackupDB is used for storing Backup objects. It does not upload
-        backups but serves as a database for backup records.
+        backups but serves as a database for backup records. The
+        `backup.db` file is downloaded on first use.
+
+        A sharded `backup.db` is a small head index pointing to one shard
+        per month. Shards are only downloaded when their backups are needed
+        and only the shards of changed backups are uploaded. Shards are
+        never overwritten. A changed shard is uploaded under a new key that
+        is then swapped into the head index with a conditional write.
 
         Parameters
         ----------
@@ -30,19 +63,47 @@ class BackupDB:
             ZFS filesystem.
         s3_prefix: str, optional
             The s3 prefix to prepend to the backup.db file.
+        catalog : Catalog, optional
+            Catalog updated whenever `backup.db` is downloaded or uploaded.
+        shard : bool, default: False
+            Split `backup.db` into monthly shards the next time it is
+            uploaded. A sharded `backup.db` stays sharded.
 
         """
         self._filesystem = filesystem
-        self._backups = {}
+        self._s3_prefix = s3_prefix
+        self._shard = shard
+        self._client = bucket.meta.client
+        self._bucket_name = bucket.name
+        # backups of the loaded shards, None until backup.db was downloaded
+        self._records = None
+        # ETag of the downloaded or uploaded backup.db, None if there is none
+        self._etag = None
+        # shards of the head index keyed by month, None if not sharded
+        self._shards = None
+        self._loaded = set()
+        # shard contents keyed by shard key, shards are never overwritten
+        self._shard_bodies = {}
+        self._catalog = catalog
+        self._logger = logging.getLogger(__name__)
+        # serializes changes of backup jobs and maintenance tasks
+        self._lock = threading.RLock()
 
         s3_key = derive_s3_key(BACKUP_DB_FILE, self.filesystem, s3_prefix)
         self._s3_object = bucket.Object(s3_key)
 
+    @property
+    def _backups(self):
         # initialize from backup.db file if it exists
-        self.download()
+        with self._lock:
+            self._load_head()
+            self._load_months()
+        return self._records
 
     def create_backup(self, backup_time, backup_type, s3_key,
-                      dependency=None, backup_size=None):
+                      dependency=None, backup_size=None, recursive=False,
+                      snapshots=None, checksum=None, storage_class=None,
+                      send_profile=None):
         """ Create backup object and upload `backup.db` file.
 
         Parameters
@@ -58,20 +119,36 @@ class BackupDB:
             storing the dependent full backup for an incremental backup.
         backup_size : int, optional
             Backup size in bytes.
+        recursive : bool, default: False
+            Backup is a replication stream of the filesystem and its
+            descendants.
+        snapshots : list(str), optional
+            Names of the snapshots contained in the backup. Defaults to the
+            backup time.
+        checksum : str, optional
+            SHA-256 digest of the uploaded stream.
+        storage_class : str, optional
+            S3 storage class of the backup.
+        send_profile : str, optional
+            Send profile of the backup stream.
 
         """
-        if backup_time in self._backups:
-            raise ValueError('Backup already exists.')
+        def change(backups):
+            if backup_time in backups:
+                raise ValueError('Backup already exists.')
 
-        if dependency and dependency not in self._backups:
-            raise ValueError('Depending on backup does not exist.')
+            if dependency and dependency not in backups:
+                raise ValueError('Depending on backup does not exist.')
 
-        self._backups.update({
-            backup_time: Backup(backup_time, backup_type, self._filesystem,
-                                s3_key, dependency, backup_size)
-        })
+            backups.update({
+                backup_time: Backup(backup_time, backup_type,
+                                    self._filesystem, s3_key, dependency,
+                                    backup_size, recursive, snapshots,
+                                    checksum, storage_class=storage_class,
+                                    send_profile=send_profile)
+            })
 
-        self.upload()
+        self._update(change, [backup_time], [dependency])
 
     def delete_backup(self, backup_time):
         """ Delete backup and upload `backup.db`.
@@ -85,9 +162,51 @@ class BackupDB:
         if _validate_backup_time(backup_time) is False:
             raise ValueError('backup_time is wrong format')
 
-        del self._backups[backup_time]
+        self.delete_backups([backup_time])
+
+    def delete_backups(self, backup_times):
+        """ Delete multiple backups and upload `backup.db` once.
+
+        Parameters
+        ----------
+        backup_times : list(str)
+            Backup times in %Y%m%d_%H%M%S format.
+
+        """
+        for backup_time in backup_times:
+            if _validate_backup_time(backup_time) is False:
+                raise ValueError('backup_time is wrong format')
+
+        with self._lock:
+            self._load_backup_times(backup_times)
+            for backup_time in backup_times:
+                if backup_time not in self._records:
+                    raise KeyError('Backup does not exist.')
+
+            def change(backups):
+                # backups deleted by another node are already gone
+                for backup_time in backup_times:
+                    backups.pop(backup_time, None)
 
-        self.upload()
+            self._update(change, backup_times)
+
+    def set_verifications(self, verifications):
+        """ Record verification results and upload `backup.db`.
+
+        Results of backups that no longer exist are ignored.
+
+        Parameters
+        ----------
+        verifications : list(Verification)
+
+        """
+        def change(backups):
+            for verification in verifications:
+                backup = backups.get(verification.backup_time)
+                if backup is not None:
+                    backup._verification = verification # noqa
+
+        self._update(change, [v.backup_time for v in verifications])
 
     def get_backup(self, backup_time):
         """ Get backup using backup time.
@@ -105,18 +224,109 @@ class BackupDB:
         if _validate_backup_time(backup_time) is False:
             raise ValueError('backup_time is wrong format')
 
+        with self._lock:
+            self._load_backup_times([backup_time])
+            records = self._records
         try:
-            return self._backups[backup_time]
+            return records[backup_time]
         except KeyError:
             raise KeyError('Backup does not exist.') from None
 
-    def get_backups(self, backup_type=None):
+    def get_backup_containing(self, snapshot_name):
+        """ Get backup that contains a snapshot.
+
+        Parameters
+        ----------
+        snapshot_name : str
+            Snapshot name.
+
+        Returns
+        -------
+        Backup
+
+        """
+        for backup in self.get_backups():
+            if snapshot_name in backup.snapshots:
+                return backup
+
+        raise KeyError('Backup does not exist.')
+
+    def get_restore_point(self, backup_time=None):
+        """ Get most recent backup or snapshot at or before a time.
+
+        Parameters
+        ----------
+        backup_time : str, optional
+            Point in time in %Y%m%d_%H%M%S format. Defaults to now.
+
+        Returns
+        -------
+        str
+            Backup time or name of a snapshot contained in a backup. None
+            is returned if there is no backup at or before the time.
+
+        """
+        names = set()
+        for backup in self.get_backups():
+            names.update(backup.snapshots)
+
+        names = sorted(name for name in names
+                       if backup_time is None or name <= backup_time)
+        return names[-1] if names else None
+
+    def get_restore_size(self, backup_time):
+        """ Get number of bytes downloaded for restoring a backup.
+
+        Parameters
+        ----------
+        backup_time : str
+            Backup time or name of a snapshot contained in a backup.
+
+        Returns
+        -------
+        int
+
+        """
+        if backup_time not in self._backups:
+            backup_time = self.get_backup_containing(backup_time).backup_time
+
+        return sum(int(b.backup_size or 0)
+                   for b in self.get_chain(backup_time))
+
+    def get_chain(self, backup_time):
+        """ Get backups needed for restoring a backup.
+
+        Parameters
+        ----------
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+
+        Returns
+        -------
+        list(Backup)
+            Full backup first followed by the incremental backups leading
+            up to and including the backup.
+
+        """
+        chain = [self.get_backup(backup_time)]
+        while chain[0].dependency:
+            chain.insert(0, self.get_backup(chain[0].dependency))
+
+        return chain
+
+    def get_backups(self, backup_type=None, since=None, months=None):
         """ Get sorted list of backups.
 
         Parameters
         ----------
         backup_type : str, optional
             Supported backup types are `full` and `inc`.
+        since : str, optional
+            Only get backups at or after this time in %Y%m%d_%H%M%S format.
+            Older shards are not downloaded.
+        months : list(str), optional
+            Only get backups of these months in %Y%m format. Other shards
+            are not downloaded.
 
         Returns
         -------
@@ -124,22 +334,95 @@ class BackupDB:
             Sorted list of backups. Most recent backup is last.
 
         """
-        backup_times = sorted(self._backups)
+        if since is None and months is None:
+            records = self._backups
+        else:
+            with self._lock:
+                self._load_head()
+                if self._shards is not None:
+                    self._load_months([
+                        month for month in self._shards
+                        if (since is None or month >= _get_month(since)) and
+                        (months is None or month in months)])
+                records = self._records
+        backup_times = sorted(
+            time for time in records
+            if (since is None or time >= since) and
+            (months is None or _get_month(time) in months))
 
         if backup_type in ['full', 'inc']:
             backups = []
             for time in backup_times:
-                backup = self._backups[time]
+                backup = records[time]
 
                 if backup.backup_type == backup_type:
                     backups.append(backup)
         elif backup_type is None:
-            backups = [self._backups[time] for time in backup_times]
+            backups = [records[time] for time in backup_times]
         else:
             raise ValueError('backup_type must be `full` or `inc`')
 
         return backups
 
+    def get_shards(self):
+        """ Get the head index of a sharded `backup.db`.
+
+        Returns
+        -------
+        dict
+            Number of backups (`count`) and most recent full backup time
+            (`last_full`) keyed by month in %Y%m format. None is returned if
+            `backup.db` is not sharded.
+
+        """
+        with self._lock:
+            self._load_head()
+            if self._shards is None:
+                return None
+            return {month: {'count': shard['count'],
+                            'last_full': shard['last_full']}
+                    for month, shard in self._shards.items()}
+
+    def get_latest_backup(self, backup_type=None):
+        """ Get most recent backup.
+
+        Only the shards from the most recent backup on are downloaded.
+
+        Parameters
+        ----------
+        backup_type : str, optional
+            Supported backup types are `full` and `inc`.
+
+        Returns
+        -------
+        Backup
+            None is returned if there is no backup.
+
+        """
+        if backup_type not in ['full', 'inc', None]:
+            raise ValueError('backup_type must be `full` or `inc`')
+
+        with self._lock:
+            self._load_head()
+            if self._shards is None:
+                months = [None]
+            elif backup_type == 'full':
+                # the head index knows the most recent full backup of each
+                # shard
+                months = sorted((month for month, shard in
+                                 self._shards.items() if shard['last_full']),
+                                reverse=True)[:1]
+            else:
+                months = sorted(self._shards, reverse=True)
+
+            for month in months:
+                backups = self.get_backups(backup_type, since=(
+                    None if month is None else f'{month}01_000000'))
+                if backups:
+                    return backups[-1]
+
+        return None
+
     def get_backup_times(self, backup_type=None):
         """ Get sorted list of backup times.
 
@@ -167,23 +450,383 @@ class BackupDB:
         else:
             raise ValueError('backup_type must be `full` or `inc`')
 
-    def download(self):
-        """ Download backup.db file. """
+    def get_etag(self):
+        """ Get ETag of the `backup.db` file in S3.
+
+        Returns
+        -------
+        str
+            None is returned if there is no `backup.db` file.
+
+        """
         try:
-            with BytesIO() as f:
-                self._s3_object.download_fileobj(f)
-                f.seek(0)
-                self._backups = json.load(f, object_hook=_json_object_hook)
+            self._s3_object.load()
         except ClientError:
-            pass
+            return None
+        return self._s3_object.e_tag
+
+    def download(self):
+        """ Download backup.db file.
+
+        All shards are downloaded in parallel.
+        """
+        with self._lock:
+            self._download()
+            self._load_months()
+
+    def reload(self):
+        """ Download `backup.db` again the next time it is read.
+
+        Backups cached by this object may be stale once another node
+        changed `backup.db`, e.g. while it held the lease on the filesystem.
+        """
+        with self._lock:
+            self._records = None
+
+    def upload(self, backup_times=None):
+        """ Upload backup.db file.
+
+        The upload is conditional on `backup.db` not having changed since it
+        was downloaded or uploaded.
 
-    def upload(self):
-        """ Upload backup.db file. """
-        with BytesIO() as f:
-            json_str = json.dumps(self._backups, default=_json_default)
-            f.write(json_str.encode('utf-8'))
-            f.seek(0)
-            self._s3_object.upload_fileobj(f)
+        Parameters
+        ----------
+        backup_times : list(str), optional
+            Times of the changed backups. Only their shards are uploaded.
+            Defaults to all downloaded shards.
+
+        Raises
+        ------
+        BackupDBConflictError
+            If another node changed `backup.db` in the meantime.
+
+        """
+        with self._lock:
+            self._load_head()
+            with span('backup_db_upload', filesystem=self._filesystem) as s:
+                if self._shards is None and not self._shard:
+                    body = json.dumps(self._records,
+                                      default=_json_default).encode('utf-8')
+                    BACKUP_DB_SIZE.set(len(body), filesystem=self._filesystem)
+                    s.add_bytes(len(body))
+                    self._put_head(body)
+                else:
+                    if self._shards is None:
+                        # backup.db is split into shards on first upload
+                        months = {_get_month(t) for t in self._records}
+                    elif backup_times is None:
+                        months = set(self._loaded)
+                    else:
+                        months = {_get_month(t) for t in backup_times}
+                    s.add_bytes(self._upload_shards(months))
+
+            self._update_catalog()
+
+    def delete_orphaned_shards(self, min_age=SHARD_ORPHAN_AGE):
+        """ Delete shards that the head index doesn't reference.
+
+        Shards are kept if uploading the head index failed in a way that
+        leaves it unknown whether the head was written. Recent shards are
+        kept since another node may be about to write a head index that
+        references them.
+
+        Parameters
+        ----------
+        min_age : int, default: 86400
+            Seconds since a shard was uploaded until it is deleted.
+
+        Returns
+        -------
+        list(str)
+            S3 keys of the deleted shards.
+
+        """
+        with self._lock:
+            self._load_head()
+            if self._shards is None:
+                return []
+
+            live = self._get_live_shards()
+            if live is None:
+                return []
+
+            prefix = derive_s3_key(f'{BACKUP_DB_FILE}.', self._filesystem,
+                                   self._s3_prefix)
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age)
+            orphans = []
+            paginator = self._client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self._bucket_name,
+                                           Prefix=prefix):
+                for item in page.get('Contents', []):
+                    if item['Key'] not in live and \
+                            item['LastModified'] < cutoff:
+                        orphans.append(item['Key'])
+
+            for key in orphans:
+                self._logger.info(f'filesystem={self._filesystem} '
+                                  f's3_key={key} '
+                                  'msg="Deleting orphaned shard."')
+            self._delete_shards(orphans)
+            return orphans
+
+    def _update(self, change, backup_times, dependencies=()):
+        """ Apply a change to the backups and upload `backup.db`.
+
+        If another node changed `backup.db` in the meantime it is downloaded
+        again and the change is applied to the latest backups.
+
+        Parameters
+        ----------
+        change : callable
+            Called with the backups of the loaded shards.
+        backup_times : list(str)
+            Times of the changed backups.
+        dependencies : list(str), optional
+            Times of other backups the change reads.
+
+        """
+        with self._lock:
+            for attempt in range(1, BACKUP_DB_MAX_ATTEMPTS + 1):
+                self._load_backup_times(list(backup_times) +
+                                        [t for t in dependencies if t])
+                change(self._records)
+                try:
+                    self.upload(backup_times)
+                    return
+                except BackupDBConflictError:
+                    if attempt == BACKUP_DB_MAX_ATTEMPTS:
+                        raise
+                    self._logger.warning(f'filesystem={self._filesystem} '
+                                         f'attempt={attempt} '
+                                         'msg="backup.db changed by another '
+                                         'node. Retrying."')
+                    self._download()
+
+    def _load_head(self):
+        if self._records is None:
+            self._download()
+
+    def _load_backup_times(self, backup_times):
+        """ Download the shards of backups. """
+        self._load_head()
+        if self._shards is not None:
+            self._load_months({_get_month(t) for t in backup_times})
+
+    def _load_months(self, months=None):
+        """ Download shards in parallel.
+
+        Parameters
+        ----------
+        months : list(str), optional
+            Months of the shards in %Y%m format. Defaults to all shards.
+
+        """
+        for attempt in range(1, BACKUP_DB_MAX_ATTEMPTS + 1):
+            if self._shards is None:
+                return
+
+            keys = {month: self._shards[month]['key'] for month in
+                    (self._shards if months is None else months)
+                    if month in self._shards and month not in self._loaded}
+            if not keys:
+                return
+
+            try:
+                bodies = self._get_shards(list(keys.values()))
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey' or \
+                        attempt == BACKUP_DB_MAX_ATTEMPTS:
+                    raise
+                # another node replaced the shard after the head was read
+                self._download()
+                continue
+
+            for month, key in keys.items():
+                self._records.update(
+                    json.loads(bodies[key], object_hook=_json_object_hook))
+                self._loaded.add(month)
+
+            if self._loaded >= set(self._shards):
+                self._update_catalog()
+            return
+
+    def _get_shards(self, keys):
+        missing = [key for key in keys if key not in self._shard_bodies]
+
+        def get(key):
+            response = self._client.get_object(Bucket=self._bucket_name,
+                                               Key=key)
+            return key, response['Body'].read()
+
+        if missing:
+            with span('backup_db_shards', filesystem=self._filesystem,
+                      shards=len(missing)) as s, \
+                    ThreadPoolExecutor(max_workers=SHARD_MAX_WORKERS) as e:
+                for key, body in e.map(get, missing):
+                    s.add_bytes(len(body))
+                    self._shard_bodies[key] = body
+
+        return {key: self._shard_bodies[key] for key in keys}
+
+    def _upload_shards(self, months):
+        """ Upload changed shards and swap them into the head index.
+
+        Returns
+        -------
+        int
+            Number of bytes uploaded.
+
+        """
+        shards = dict(self._shards or {})
+        replaced = []
+        bodies = {}
+        for month in months:
+            records = {t: b for t, b in self._records.items()
+                       if _get_month(t) == month}
+            shard = shards.pop(month, None)
+            if shard is not None:
+                replaced.append(shard['key'])
+            if not records:
+                continue
+
+            object_name = f'{BACKUP_DB_FILE}.{month}.{uuid.uuid4().hex[:8]}'
+            key = derive_s3_key(object_name, self._filesystem,
+                                self._s3_prefix)
+            bodies[key] = json.dumps(records,
+                                     default=_json_default).encode('utf-8')
+            full_times = [t for t, b in records.items()
+                          if b.backup_type == 'full']
+            shards[month] = {'key': key, 'count': len(records),
+                             'last_full': max(full_times, default=None)}
+
+        def put(key):
+            self._client.put_object(Bucket=self._bucket_name, Key=key,
+                                    Body=bodies[key])
+
+        head = json.dumps({'layout': SHARD_LAYOUT, 'shards': shards},
+                          sort_keys=True).encode('utf-8')
+        try:
+            with ThreadPoolExecutor(max_workers=SHARD_MAX_WORKERS) as executor:
+                list(executor.map(put, bodies))
+        except Exception:
+            self._delete_shards(bodies)
+            raise
+
+        try:
+            self._put_head(head)
+        except Exception:
+            # the head may have been written even though the request failed,
+            # e.g. a retry after a timeout fails with a conflict
+            live = self._get_live_shards()
+            if live is None:
+                self._logger.warning(f'filesystem={self._filesystem} '
+                                     'msg="Unable to read backup.db. '
+                                     'Keeping new shards."')
+            else:
+                self._delete_shards([key for key in bodies
+                                     if key not in live])
+            raise
+
+        self._shard_bodies.update(bodies)
+        self._shards = shards
+        self._loaded.update(months)
+        self._delete_shards(replaced)
+
+        size = len(head) + sum(len(body) for body in bodies.values())
+        BACKUP_DB_SIZE.set(len(head) + sum(len(self._shard_bodies.get(
+            shard['key'], b'')) for shard in shards.values()),
+            filesystem=self._filesystem)
+        return size
+
+    def _delete_shards(self, keys):
+        """ Delete shards that are no longer in the head index. """
+        for key in keys:
+            self._shard_bodies.pop(key, None)
+            try:
+                self._client.delete_object(Bucket=self._bucket_name, Key=key)
+            except ClientError as e:
+                self._logger.warning(f'filesystem={self._filesystem} '
+                                     f's3_key={key} '
+                                     'msg="Failed to delete shard." '
+                                     f'error="{e}"')
+
+    def _get_live_shards(self):
+        """ Get the shard keys of the head index in S3.
+
+        Returns
+        -------
+        set(str)
+            None is returned if the head index can't be read.
+
+        """
+        try:
+            body = self._s3_object.get()['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return set()
+            return None
+        except BotoCoreError:
+            return None
+
+        data = json.loads(body)
+        if data.get('layout') != SHARD_LAYOUT:
+            return set()
+        return {shard['key'] for shard in data['shards'].values()}
+
+    def _put_head(self, body):
+        """ Upload `backup.db` if it didn't change since it was read. """
+        if self._etag is None:
+            kwargs = {'IfNoneMatch': '*'}
+        else:
+            kwargs = {'IfMatch': self._etag}
+
+        try:
+            response = self._s3_object.put(Body=body, **kwargs)
+        except ClientError as e:
+            if is_write_conflict(e):
+                raise BackupDBConflictError(
+                    'backup.db was changed by another node.') from e
+            if e.response['Error']['Code'] != 'NotImplemented':
+                raise
+            # S3 compatible services without conditional writes
+            self._logger.warning(f'filesystem={self._filesystem} '
+                                 'msg="Conditional writes are not '
+                                 'supported. Overwriting backup.db."')
+            response = self._s3_object.put(Body=body)
+        self._etag = response.get('ETag')
+
+    def _update_catalog(self):
+        """ Update the catalog once all shards are loaded. """
+        if self._catalog and (self._shards is None or
+                              self._loaded >= set(self._shards)):
+            self._catalog.update_filesystem(self._filesystem,
+                                            self._records.values(),
+                                            self._etag)
+
+    def _download(self):
+        """ Download `backup.db` or the head index of a sharded one. """
+        self._records = {}
+        self._etag = None
+        self._shards = None
+        self._loaded = set()
+        try:
+            response = self._s3_object.get()
+        except ClientError:
+            return
+
+        self._etag = response.get('ETag')
+        body = response['Body'].read()
+        BACKUP_DB_SIZE.set(len(body), filesystem=self._filesystem)
+        data = json.loads(body, object_hook=_json_object_hook)
+
+        if data.get('layout') == SHARD_LAYOUT:
+            self._shards = data['shards']
+            keys = {shard['key'] for shard in self._shards.values()}
+            self._shard_bodies = {key: body for key, body in
+                                  self._shard_bodies.items() if key in keys}
+        else:
+            self._records = data
+            self._update_catalog()
 
 
 class Backup:
@@ -224,8 +867,41 @@ class Backup:
         """ Backup size in bytes. """
         return self._backup_size
 
+    @property
+    def recursive(self):
+        """ Backup includes descendant filesystems. """
+        return self._recursive
+
+    @property
+    def snapshots(self):
+        """ Names of the snapshots contained in the backup. """
+        return self._snapshots or [self._backup_time]
+
+    @property
+    def checksum(self):
+        """ SHA-256 digest of the uploaded stream. """
+        return self._checksum
+
+    @property
+    def verification(self):
+        """ Most recent verification result. """
+        return self._verification
+
+    @property
+    def storage_class(self):
+        """ S3 storage class. """
+        return self._storage_class
+
+    @property
+    def send_profile(self):
+        """ Send profile of the backup stream. """
+        # older versions always sent raw streams
+        return self._send_profile or 'raw'
+
     def __init__(self, backup_time, backup_type, filesystem, s3_key,
-                 dependency=None, backup_size=None):
+                 dependency=None, backup_size=None, recursive=False,
+                 snapshots=None, checksum=None, verification=None,
+                 storage_class=None, send_profile=None):
         """ Create Backup object.
 
         Parameters
@@ -243,6 +919,23 @@ class Backup:
             storing the dependent full backup for an incremental backup.
         backup_size : int, optional
             Backup size in bytes.
+        recursive : bool, default: False
+            Backup is a replication stream of the filesystem and its
+            descendants.
+        snapshots : list(str), optional
+            Names of the snapshots contained in the backup. Defaults to the
+            backup time.
+        checksum : str, optional
+            SHA-256 digest of the uploaded stream. Not recorded for backups
+            uploaded by older versions.
+        verification : Verification, optional
+            Most recent verification result.
+        storage_class : str, optional
+            S3 storage class. Not recorded for backups uploaded by older
+            versions.
+        send_profile : str, optional
+            Send profile of the backup stream. Not recorded for backups
+            uploaded by older versions, which are raw streams.
 
         """
         if _validate_backup_time(backup_time):
@@ -264,6 +957,12 @@ class Backup:
         self._dependency = dependency
 
         self._backup_size = backup_size
+        self._recursive = recursive
+        self._snapshots = snapshots
+        self._checksum = checksum
+        self._verification = verification
+        self._storage_class = storage_class
+        self._send_profile = send_profile
 
     def __eq__(self, other):
         return all((self._backup_time == other._backup_time, # noqa
@@ -271,7 +970,10 @@ class Backup:
                     self._filesystem == other._filesystem, # noqa
                     self._s3_key == other._s3_key, # noqa
                     self._dependency == other._dependency, # noqa
-                    self._backup_size == other._backup_size # noqa
+                    self._backup_size == other._backup_size, # noqa
+                    self._recursive == other._recursive, # noqa
+                    self.snapshots == other.snapshots,
+                    self._checksum == other._checksum # noqa
                     ))
 
     def __hash__(self):
@@ -280,13 +982,101 @@ class Backup:
                      self._filesystem,
                      self._s3_key,
                      self._dependency,
-                     self._backup_size
+                     self._backup_size,
+                     self._recursive,
+                     tuple(self.snapshots),
+                     self._checksum
                      ))
 
 
+class Verification:
+    """ Result of verifying a backup. """
+
+    @property
+    def backup_time(self):
+        """ Backup time of the verified backup. """
+        return self._backup_time
+
+    @property
+    def filesystem(self):
+        """ ZFS filesystem. """
+        return self._filesystem
+
+    @property
+    def verify_time(self):
+        """ Verification time. """
+        return self._verify_time
+
+    @property
+    def status(self):
+        """ Either `passed`, `failed` or `error`.
+
+        `error` means that the backup could not be checked, e.g. because of
+        a network error.
+        """
+        return self._status
+
+    @property
+    def structure(self):
+        """ Structure check. Either `none`, `parse` or `receive`. """
+        return self._structure
+
+    @property
+    def size(self):
+        """ Number of bytes downloaded. """
+        return self._size
+
+    @property
+    def checksum(self):
+        """ SHA-256 digest of the downloaded stream. """
+        return self._checksum
+
+    @property
+    def error(self):
+        """ Reason for a failed verification. """
+        return self._error
+
+    def __init__(self, backup_time, filesystem, verify_time, status,
+                 structure='none', size=None, checksum=None, error=None):
+        """ Create Verification object.
+
+        Parameters
+        ----------
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+        filesystem : str
+            ZFS filesystem.
+        verify_time : str
+            Verification time in %Y%m%d_%H%M%S format.
+        status : str
+            Supported statuses are `passed`, `failed` and `error`.
+        structure : str, default: none
+            Structure check. Supported checks are `none`, `parse` and
+            `receive`.
+        size : int, optional
+            Number of bytes downloaded.
+        checksum : str, optional
+            SHA-256 digest of the downloaded stream.
+        error : str, optional
+            Reason for a failed verification.
+
+        """
+        if status not in ['passed', 'failed', 'error']:
+            raise ValueError('status must be `passed`, `failed` or `error`')
+
+        self._backup_time = backup_time
+        self._filesystem = filesystem
+        self._verify_time = verify_time
+        self._status = status
+        self._structure = structure
+        self._size = size
+        self._checksum = checksum
+        self._error = error
+
+
 def _json_default(obj):
     if isinstance(obj, Backup):
-        return {
+        dct = {
             '_type': 'Backup',
             'backup_time': obj._backup_time, # noqa
             'backup_type': obj._backup_type, # noqa
@@ -295,18 +1085,55 @@ def _json_default(obj):
             'dependency': obj._dependency, # noqa
             'backup_size': obj._backup_size # noqa
         }
+        optional = {
+            'recursive': obj._recursive, # noqa
+            'snapshots': obj._snapshots, # noqa
+            'checksum': obj._checksum, # noqa
+            'verification': obj._verification, # noqa
+            'storage_class': obj._storage_class, # noqa
+            'send_profile': obj._send_profile # noqa
+        }
+    elif isinstance(obj, Verification):
+        dct = {
+            '_type': 'Verification',
+            'backup_time': obj._backup_time, # noqa
+            'filesystem': obj._filesystem, # noqa
+            'verify_time': obj._verify_time, # noqa
+            'status': obj._status # noqa
+        }
+        optional = {
+            'structure': obj._structure, # noqa
+            'size': obj._size, # noqa
+            'checksum': obj._checksum, # noqa
+            'error': obj._error # noqa
+        }
+    else:
+        raise TypeError(f'{type(obj).__name__} is not JSON serializable')
 
+    # optional keys are only written if set so that older versions, which
+    # don't accept them, can read records that don't use them
+    parameters = inspect.signature(type(obj)).parameters
+    dct.update((key, value) for key, value in optional.items()
+               if value != parameters[key].default)
+    return dct
 
-def _json_object_hook(dct):
-    obj_type = dct.get('_type')
-    if obj_type == 'Backup':
-        dct_copy = dct.copy()
-        del dct_copy['_type']
 
-        return Backup(**dct_copy)
-    else:
+def _json_object_hook(dct):
+    types = {'Backup': Backup, 'Verification': Verification}
+    obj_type = types.get(dct.get('_type'))
+    if obj_type is None:
         return dct
 
+    # keys written by newer versions are ignored
+    parameters = inspect.signature(obj_type).parameters
+    return obj_type(**{key: value for key, value in dct.items()
+                       if key in parameters})
+
+
+def _get_month(backup_time):
+    """ Get the shard month of a backup time. """
+    return backup_time[:6]
+
 
 def _validate_backup_time(backup_time):
     try:
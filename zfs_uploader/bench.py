@@ -0,0 +1,292 @@
+import logging
+import os
+import time
+import uuid
+
+from zfs_uploader.utils import derive_s3_key
+from zfs_uploader.zfs import open_snapshot_stream
+
+KB = 1024
+MB = KB * KB
+BLOCK_SIZE = MB
+SEND_MAX_BYTES = 1024 * MB
+SEND_MAX_SECONDS = 30
+S3_TEST_SIZE = 128 * MB
+PART_SIZES = (8 * MB, 16 * MB, 32 * MB, 64 * MB)
+CONCURRENCIES = (4, 10, 20, 40)
+# settings within this fraction of the best upload speed are equally good
+SPEED_TOLERANCE = 0.05
+
+
+class S3Result:
+    """ S3 throughput of one part size and concurrency. """
+
+    @property
+    def part_size(self):
+        """ Multipart part size in bytes. """
+        return self._part_size
+
+    @property
+    def concurrency(self):
+        """ Number of concurrent part transfers. """
+        return self._concurrency
+
+    @property
+    def upload_speed(self):
+        """ PUT throughput in bytes/s. """
+        return self._upload_speed
+
+    @property
+    def download_speed(self):
+        """ GET throughput in bytes/s. """
+        return self._download_speed
+
+    def __init__(self, part_size, concurrency, upload_speed, download_speed):
+        """ Create S3Result object.
+
+        Parameters
+        ----------
+        part_size : int
+            Multipart part size in bytes.
+        concurrency : int
+            Number of concurrent part transfers.
+        upload_speed : float
+            PUT throughput in bytes/s.
+        download_speed : float
+            GET throughput in bytes/s.
+
+        """
+        self._part_size = part_size
+        self._concurrency = concurrency
+        self._upload_speed = upload_speed
+        self._download_speed = download_speed
+
+
+class Recommendation:
+    """ Bottleneck and recommended config values for a job. """
+
+    @property
+    def bottleneck(self):
+        """ Slowest stage. Either `zfs send` or `S3 upload`. """
+        return self._bottleneck
+
+    @property
+    def settings(self):
+        """ Recommended config values keyed by config option. """
+        return self._settings
+
+    @property
+    def expected_speed(self):
+        """ Expected backup throughput in bytes/s. """
+        return self._expected_speed
+
+    def __init__(self, bottleneck, settings, expected_speed):
+        """ Create Recommendation object.
+
+        Parameters
+        ----------
+        bottleneck : str
+            Slowest stage.
+        settings : dict
+            Recommended config values keyed by config option.
+        expected_speed : float
+            Expected backup throughput in bytes/s.
+
+        """
+        self._bottleneck = bottleneck
+        self._settings = settings
+        self._expected_speed = expected_speed
+
+
+def measure_send(filesystem, snapshot_name, recursive=False,
+                 max_bytes=SEND_MAX_BYTES, max_seconds=SEND_MAX_SECONDS,
+                 send_profile=None):
+    """ Measure `zfs send` read throughput.
+
+    The send stream is read and discarded until either limit is reached.
+
+    Parameters
+    ----------
+    filesystem : str
+        ZFS filesystem.
+    snapshot_name : str
+        Snapshot to send.
+    recursive : bool, default: False
+        Send a replication stream of the filesystem and its descendants.
+    max_bytes : int, default: 1 GiB
+        Stop after reading this many bytes.
+    max_seconds : float, default: 30
+        Stop after this many seconds.
+    send_profile : str, default: raw
+        `zfs send` flags to measure.
+
+    Returns
+    -------
+    float
+        Send throughput in bytes/s.
+
+    """
+    logger = logging.getLogger(__name__)
+    logger.info(f'filesystem={filesystem} snapshot_name={snapshot_name} '
+                'msg="Measuring send throughput."')
+
+    read = 0
+    start = time.monotonic()
+    with open_snapshot_stream(filesystem, snapshot_name, 'r', recursive,
+                              send_profile=send_profile) as f:
+        try:
+            while read < max_bytes:
+                data = f.stdout.read(BLOCK_SIZE)
+                if not data:
+                    break
+                read += len(data)
+                if time.monotonic() - start >= max_seconds:
+                    break
+            elapsed = time.monotonic() - start
+        finally:
+            # stop the send if a limit was reached
+            if f.poll() is None:
+                f.kill()
+            f.stdout.close()
+            stderr = f.stderr.read().decode('utf-8')
+
+        if f.wait() > 0 and not read:
+            raise RuntimeError(f'zfs send failed: {stderr}')
+
+    return read / elapsed if elapsed > 0 else 0
+
+
+def measure_s3(bucket, filesystem, prefix=None, size=S3_TEST_SIZE,
+               part_sizes=PART_SIZES, concurrencies=CONCURRENCIES):
+    """ Measure S3 PUT and GET throughput.
+
+    A temporary object is uploaded and downloaded for every combination of
+    part size and concurrency. Temporary objects are deleted afterwards.
+
+    Parameters
+    ----------
+    bucket : Bucket
+        S3 bucket resource.
+    filesystem : str
+        ZFS filesystem. Used for the temporary object key.
+    prefix : str, optional
+        Prefix of the temporary object key.
+    size : int, default: 128 MiB
+        Size of the temporary objects in bytes.
+    part_sizes : list(int)
+        Multipart part sizes in bytes.
+    concurrencies : list(int)
+        Numbers of concurrent part transfers.
+
+    Returns
+    -------
+    list(S3Result)
+
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    logger = logging.getLogger(__name__)
+    results = []
+
+    for part_size in part_sizes:
+        for concurrency in concurrencies:
+            s3_key = derive_s3_key(f'zfsup_bench_{uuid.uuid4().hex}',
+                                   filesystem, prefix)
+            config = TransferConfig(multipart_threshold=part_size,
+                                    multipart_chunksize=part_size,
+                                    max_concurrency=concurrency)
+            logger.info(f'filesystem={filesystem} s3_key={s3_key} '
+                        f'part_size={part_size} concurrency={concurrency} '
+                        'msg="Measuring S3 throughput."')
+            try:
+                start = time.monotonic()
+                bucket.upload_fileobj(_BenchReader(size), s3_key,
+                                      Config=config)
+                upload_speed = size / (time.monotonic() - start)
+
+                start = time.monotonic()
+                bucket.download_fileobj(s3_key, _NullWriter(),
+                                        Config=config)
+                download_speed = size / (time.monotonic() - start)
+            finally:
+                bucket.Object(s3_key).delete()
+
+            results.append(S3Result(part_size, concurrency, upload_speed,
+                                    download_speed))
+
+    return results
+
+
+def recommend(send_speed, results, send_size=None, max_multipart_parts=10000):
+    """ Find bottleneck and recommend config values.
+
+    The fastest upload setting is recommended. Lower concurrency and then
+    smaller parts are preferred among settings that are about as fast since
+    they use less memory.
+
+    Parameters
+    ----------
+    send_speed : float, optional
+        Send throughput in bytes/s. The send stage is ignored if None.
+    results : list(S3Result)
+        S3 throughput results.
+    send_size : int, optional
+        Full backup send size in bytes. Used for checking the part count.
+    max_multipart_parts : int, default: 10000
+        Maximum number of parts of a multipart upload.
+
+    Returns
+    -------
+    Recommendation
+
+    """
+    best_speed = max(r.upload_speed for r in results)
+    candidates = [r for r in results
+                  if r.upload_speed >= best_speed * (1 - SPEED_TOLERANCE)]
+    best = min(candidates, key=lambda r: (r.concurrency, r.part_size))
+
+    settings = {
+        'max_concurrency': best.concurrency,
+        'min_part_size': best.part_size,
+        # hold all parts in flight so that zfs send is not blocked
+        'buffer_size': max(best.part_size * best.concurrency, 64 * MB)
+    }
+
+    if send_size:
+        # same headroom as the part size calculation of the uploader
+        parts = -(-send_size // best.part_size) + 100
+        if parts > max_multipart_parts:
+            settings['max_multipart_parts'] = min(parts, 10000)
+
+    if send_speed is not None and send_speed < best.upload_speed:
+        bottleneck = 'zfs send'
+        expected_speed = send_speed
+    else:
+        bottleneck = 'S3 upload'
+        expected_speed = best.upload_speed
+
+    return Recommendation(bottleneck, settings, expected_speed)
+
+
+class _BenchReader:
+    """ Readable stream of size bytes. Not seekable, like a send stream. """
+
+    def __init__(self, size):
+        self._remaining = size
+        self._block = os.urandom(BLOCK_SIZE)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining
+        size = min(size, self._remaining)
+        self._remaining -= size
+
+        data = self._block * (size // BLOCK_SIZE)
+        return data + self._block[:size % BLOCK_SIZE]
+
+
+class _NullWriter:
+    """ Writable stream discarding all data. """
+
+    def write(self, data):
+        return len(data)
@@ -0,0 +1,334 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+CATALOG_FILE = 'catalog.db'
+# stay below the SQLite limit of host parameters per statement
+MAX_PARAMETERS = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS filesystems (
+    filesystem TEXT PRIMARY KEY,
+    etag TEXT,
+    synced REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS backups (
+    filesystem TEXT NOT NULL,
+    backup_time TEXT NOT NULL,
+    backup_type TEXT NOT NULL,
+    dependency TEXT,
+    s3_key TEXT NOT NULL,
+    backup_size INTEGER,
+    storage_class TEXT,
+    recursive INTEGER NOT NULL,
+    checksum TEXT,
+    verify_status TEXT,
+    verify_time TEXT,
+    PRIMARY KEY (filesystem, backup_time)
+);
+CREATE INDEX IF NOT EXISTS backups_backup_time
+    ON backups (backup_time);
+CREATE INDEX IF NOT EXISTS backups_backup_type
+    ON backups (backup_type, backup_time);
+'''
+
+COLUMNS = ('filesystem', 'backup_time', 'backup_type', 'dependency',
+           's3_key', 'backup_size', 'storage_class', 'recursive', 'checksum',
+           'verify_status', 'verify_time')
+
+
+class Catalog:
+    """ Local SQLite index of the backups of all filesystems.
+
+    The catalog mirrors the `backup.db` file of each filesystem. It is
+    updated whenever a `backup.db` file is downloaded or uploaded and
+    answers queries without any S3 requests.
+    """
+
+    @property
+    def path(self):
+        """ Catalog file path. """
+        return self._path
+
+    def __init__(self, path=None):
+        """ Create Catalog object.
+
+        The catalog file and its tables are created if they don't exist.
+
+        Parameters
+        ----------
+        path : str, default: catalog.db
+            Catalog file path.
+
+        """
+        self._path = path or CATALOG_FILE
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._connect() as conn:
+            # readers don't block the writer of another process
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    def update_filesystem(self, filesystem, backups, etag=None):
+        """ Replace the backups of a filesystem.
+
+        Parameters
+        ----------
+        filesystem : str
+            ZFS filesystem.
+        backups : list(Backup)
+            All backups of the filesystem.
+        etag : str, optional
+            ETag of the `backup.db` file the backups were read from.
+
+        """
+        rows = [_backup_to_row(filesystem, b) for b in backups]
+
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM backups WHERE filesystem = ?',
+                         (filesystem,))
+            conn.executemany(
+                f'INSERT INTO backups ({", ".join(COLUMNS)}) '
+                f'VALUES ({", ".join("?" * len(COLUMNS))})', rows)
+            conn.execute('INSERT OR REPLACE INTO filesystems '
+                         '(filesystem, etag, synced) VALUES (?, ?, ?)',
+                         (filesystem, etag, time.time()))
+
+    def remove_filesystem(self, filesystem):
+        """ Remove a filesystem and its backups. """
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM backups WHERE filesystem = ?',
+                         (filesystem,))
+            conn.execute('DELETE FROM filesystems WHERE filesystem = ?',
+                         (filesystem,))
+
+    def get_etag(self, filesystem):
+        """ Get ETag of the `backup.db` file of the last update.
+
+        Returns
+        -------
+        str
+            None is returned if the filesystem was never synced.
+
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT etag FROM filesystems '
+                               'WHERE filesystem = ?',
+                               (filesystem,)).fetchone()
+        return row[0] if row else None
+
+    def get_filesystems(self):
+        """ Get sorted list of synced filesystems. """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT filesystem FROM filesystems '
+                                'ORDER BY filesystem').fetchall()
+        return [row[0] for row in rows]
+
+    def get_backups(self, filesystems=None, since=None, until=None,
+                    backup_type=None, min_size=None, max_size=None):
+        """ Query backups.
+
+        Parameters
+        ----------
+        filesystems : list(str), optional
+            Only return backups of these filesystems.
+        since : str, optional
+            Only return backups at or after this time. Format:
+            %Y%m%d_%H%M%S
+        until : str, optional
+            Only return backups at or before this time. Format:
+            %Y%m%d_%H%M%S
+        backup_type : str, optional
+            Supported backup types are `full` and `inc`.
+        min_size : int, optional
+            Only return backups of at least this many bytes.
+        max_size : int, optional
+            Only return backups of at most this many bytes.
+
+        Returns
+        -------
+        list(dict)
+            Backups sorted by filesystem and backup time.
+
+        """
+        conditions = []
+        params = []
+        for condition, value in (('backup_time >= ?', since),
+                                 ('backup_time <= ?', until),
+                                 ('backup_type = ?', backup_type),
+                                 ('backup_size >= ?', min_size),
+                                 ('backup_size <= ?', max_size)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+
+        rows = []
+        with self._connect() as conn:
+            for chunk_conditions, chunk_params in _filesystem_chunks(
+                    filesystems, conditions, params):
+                where = ' AND '.join(chunk_conditions) or '1'
+                rows.extend(conn.execute(
+                    f'SELECT {", ".join(COLUMNS)} FROM backups '
+                    f'WHERE {where}', chunk_params).fetchall())
+
+        rows.sort(key=lambda row: (row[0], row[1]))
+        return [_row_to_dict(row) for row in rows]
+
+    def get_last_backup_times(self, filesystems=None):
+        """ Get most recent backup time of each synced filesystem.
+
+        Parameters
+        ----------
+        filesystems : list(str), optional
+            Only return these filesystems.
+
+        Returns
+        -------
+        dict
+            Backup times keyed by filesystem. None for filesystems without
+            backups.
+
+        """
+        rows = []
+        with self._connect() as conn:
+            for conditions, params in _filesystem_chunks(
+                    filesystems, [], [], column='f.filesystem'):
+                where = ' AND '.join(conditions) or '1'
+                rows.extend(conn.execute(
+                    'SELECT f.filesystem, MAX(b.backup_time) '
+                    'FROM filesystems f LEFT JOIN backups b '
+                    'ON b.filesystem = f.filesystem '
+                    f'WHERE {where} GROUP BY f.filesystem',
+                    params).fetchall())
+
+        return dict(sorted(rows))
+
+    def compact(self, filesystems=None):
+        """ Remove unknown filesystems and reclaim unused space.
+
+        The write-ahead log is checkpointed and the file is vacuumed once
+        more than a quarter of its pages are free.
+
+        Parameters
+        ----------
+        filesystems : list(str), optional
+            Filesystems to keep. All filesystems are kept if not set.
+
+        """
+        if filesystems is not None:
+            known = set(filesystems)
+            for filesystem in self.get_filesystems():
+                if filesystem not in known:
+                    self.remove_filesystem(filesystem)
+
+        with self._lock, self._connect() as conn:
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            pages = conn.execute('PRAGMA page_count').fetchone()[0]
+            if free_pages * 4 > pages:
+                conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def _connect(self):
+        return _Connection(self._path)
+
+
+class _Connection:
+    """ Connection committing on success and always closing. """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=30)
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self._conn.close()
+
+
+def sync_catalog(catalog, jobs, max_workers=None):
+    """ Update catalog from the `backup.db` files of jobs.
+
+    Only `backup.db` files that changed since the last update are
+    downloaded. Checking for changes takes one HEAD request per job.
+
+    Parameters
+    ----------
+    catalog : Catalog
+
+    jobs : list(ZFSjob)
+
+    max_workers : int, optional
+        Maximum number of jobs checked in parallel.
+
+    Returns
+    -------
+    list(str)
+        Filesystems that were updated.
+
+    """
+    logger = logging.getLogger(__name__)
+
+    def sync(job):
+        etag = job.backup_db.get_etag()
+        if etag is not None and etag == catalog.get_etag(job.filesystem):
+            return False
+
+        logger.info(f'filesystem={job.filesystem} '
+                    'msg="Updating catalog."')
+        if etag is None:
+            catalog.update_filesystem(job.filesystem, [])
+        else:
+            # the download updates the catalog
+            job.backup_db.download()
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(sync, jobs))
+
+    return [job.filesystem for job, updated in zip(jobs, results)
+            if updated]
+
+
+def _backup_to_row(filesystem, backup):
+    verification = backup.verification
+    return (filesystem, backup.backup_time, backup.backup_type,
+            backup.dependency, backup.s3_key,
+            int(backup.backup_size) if backup.backup_size is not None
+            else None,
+            backup.storage_class, int(bool(backup.recursive)),
+            backup.checksum,
+            verification.status if verification else None,
+            verification.verify_time if verification else None)
+
+
+def _row_to_dict(row):
+    backup = dict(zip(COLUMNS, row))
+    backup['recursive'] = bool(backup['recursive'])
+    return backup
+
+
+def _filesystem_chunks(filesystems, conditions, params,
+                       column='filesystem'):
+    """ Yield conditions and parameters per chunk of filesystems. """
+    if filesystems is None:
+        yield conditions, params
+        return
+
+    filesystems = list(filesystems)
+    for i in range(0, len(filesystems), MAX_PARAMETERS):
+        chunk = filesystems[i:i + MAX_PARAMETERS]
+        yield (conditions + [f'{column} IN ({", ".join("?" * len(chunk))})'],
+               params + chunk)
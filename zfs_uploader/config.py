@@ -3,16 +3,61 @@ import logging
 import os
 import sys
 
+from zfs_uploader.backend import get_backend
+from zfs_uploader.catalog import Catalog, CATALOG_FILE
 from zfs_uploader.job import ZFSjob
+from zfs_uploader.spool import get_spool
+
+# DEFAULT options that apply to the whole process instead of single jobs
+PROCESS_OPTIONS = ('catalog_path', 'max_maintenance_jobs', 'max_parallel_jobs',
+                   'max_parts', 'max_sends')
 
 
 class Config:
     """ Wrapper for configuration file. """
 
+    @property
+    def file_path(self):
+        """ Path of the configuration file. """
+        return self._file_path
+
     @property
     def jobs(self):
-        """ ZFS backup jobs. """
-        return self._jobs
+        """ ZFS backup jobs keyed by filesystem. """
+        return {filesystem: self.get_job(filesystem)
+                for filesystem in self.filesystems}
+
+    @property
+    def filesystems(self):
+        """ Filesystems in the config file. """
+        return [k for k in self._cfg if k != 'DEFAULT']
+
+    @property
+    def catalog(self):
+        """ Local catalog of all backups. """
+        if self._catalog is None:
+            self._catalog = Catalog(self._catalog_path)
+        return self._catalog
+
+    @property
+    def max_parallel_jobs(self):
+        """ Maximum number of jobs sharing a schedule that run in parallel. """
+        return self._max_parallel_jobs
+
+    @property
+    def max_sends(self):
+        """ Maximum number of jobs sending at once in the asyncio runtime. """
+        return self._max_sends
+
+    @property
+    def max_parts(self):
+        """ Maximum number of S3 parts in flight in the asyncio runtime. """
+        return self._max_parts
+
+    @property
+    def max_maintenance_jobs(self):
+        """ Maximum number of maintenance tasks that run in parallel. """
+        return self._max_maintenance_jobs
 
     def __init__(self, file_path=None):
         """ Construct Config object from file.
@@ -33,57 +78,179 @@ class Config:
             self._logger.critical('No configuration file found.')
             sys.exit(1)
 
+        self._file_path = file_path
         self._cfg = ConfigParser()
         self._cfg.read(file_path)
 
         default = self._cfg['DEFAULT']
+        self._max_parallel_jobs = default.getint('max_parallel_jobs') or 4
+        self._max_maintenance_jobs = (default.getint('max_maintenance_jobs')
+                                      or 1)
+        self._max_sends = default.getint('max_sends')
+        self._max_parts = default.getint('max_parts')
+        # relative catalog paths are relative to the configuration file
+        self._catalog_path = os.path.join(
+            os.path.dirname(os.path.abspath(file_path)),
+            default.get('catalog_path') or CATALOG_FILE)
+        self._catalog = None
         self._jobs = {}
-        for k, v in self._cfg.items():
-            if k != 'DEFAULT':
-                bucket_name = (v.get('bucket_name') or
-                               default.get('bucket_name'))
-                access_key = v.get('access_key') or default.get('access_key')
-                secret_key = v.get('secret_key') or default.get('secret_key')
-                filesystem = k
-
-                if not all((bucket_name, access_key, secret_key)):
-                    self._logger.critical(f'file_path={file_path} '
-                                          f'filesystem={filesystem}'
-                                          'msg="bucket_name, access_key or '
-                                          'secret_key is missing from config."'
-                                          )
-                    sys.exit(1)
-
-                cron_dict = None
-                cron = v.get('cron') or default.get('cron')
-                if cron:
-                    cron_dict = _create_cron_dict(cron)
-
-                self._jobs[k] = (
-                    ZFSjob(
-                        bucket_name,
-                        access_key,
-                        secret_key,
-                        filesystem,
-                        prefix=v.get('prefix') or default.get('prefix'),
-                        region=v.get('region') or default.get('region'),
-                        endpoint=v.get('endpoint') or default.get('endpoint'),
-                        cron=cron_dict,
-                        max_snapshots=(v.getint('max_snapshots') or
-                                       default.getint('max_snapshots')),
-                        max_backups=(
-                                v.getint('max_backups') or
-                                default.getint('max_backups')),
-                        max_incremental_backups_per_full=(
-                                v.getint('max_incremental_backups_per_full') or
-                                default.getint('max_incremental_backups_per_full')), # noqa
-                        storage_class=(v.get('storage_class') or
-                                       default.get('storage_class')),
-                        max_multipart_parts=(
-                                v.getint('max_multipart_parts') or
-                                default.getint('max_multipart_parts'))
-                    )
-                )
+        self._spools = {}
+
+    def get_job(self, filesystem):
+        """ Get backup job of a filesystem.
+
+        Jobs are created on first use.
+
+        Parameters
+        ----------
+        filesystem : str
+            ZFS filesystem.
+
+        Returns
+        -------
+        ZFSjob
+            None is returned if the filesystem is not in the config file.
+
+        """
+        if filesystem not in self.filesystems:
+            return None
+
+        job = self._jobs.get(filesystem)
+        if job is None:
+            job = self._create_job(filesystem)
+            self._jobs[filesystem] = job
+        return job
+
+    def get_job_settings(self, filesystem):
+        """ Get the options of a job.
+
+        Jobs with equal settings are equal. Used for finding the jobs that
+        changed when the configuration file is reloaded.
+
+        Parameters
+        ----------
+        filesystem : str
+            ZFS filesystem.
+
+        Returns
+        -------
+        dict
+            Options of the job and the DEFAULT section. None is returned if
+            the filesystem is not in the config file.
+
+        """
+        if filesystem not in self.filesystems:
+            return None
+
+        return {k: v for k, v in self._cfg[filesystem].items()
+                if k not in PROCESS_OPTIONS}
+
+    def _create_job(self, k):
+        default = self._cfg['DEFAULT']
+        v = self._cfg[k]
+        bucket_name = (v.get('bucket_name') or
+                       default.get('bucket_name'))
+        access_key = v.get('access_key') or default.get('access_key')
+        secret_key = v.get('secret_key') or default.get('secret_key')
+        filesystem = k
+
+        if not all((bucket_name, access_key, secret_key)):
+            self._logger.critical(f'file_path={self._file_path} '
+                                  f'filesystem={filesystem}'
+                                  'msg="bucket_name, access_key or '
+                                  'secret_key is missing from config."'
+                                  )
+            sys.exit(1)
+
+        backend_name = (v.get('zfs_backend') or
+                        default.get('zfs_backend'))
+        try:
+            backend = get_backend(backend_name)
+        except ValueError as e:
+            self._logger.critical(f'file_path={self._file_path} '
+                                  f'filesystem={filesystem} '
+                                  f'msg="{e}"')
+            sys.exit(1)
+
+        cron_dict = None
+        cron = v.get('cron') or default.get('cron')
+        if cron:
+            cron_dict = _create_cron_dict(cron)
+
+        spool = None
+        spool_dir = v.get('spool_dir') or default.get('spool_dir')
+        if spool_dir:
+            spool = self._spools.get(spool_dir)
+            if spool is None:
+                spool = get_spool(
+                    spool_dir,
+                    max_size=(v.getint('spool_max_size') or
+                              default.getint('spool_max_size')))
+                self._spools[spool_dir] = spool
+
+        return ZFSjob(
+            bucket_name,
+            access_key,
+            secret_key,
+            filesystem,
+            prefix=v.get('prefix') or default.get('prefix'),
+            region=v.get('region') or default.get('region'),
+            endpoint=_get_endpoints(v.get('endpoint') or
+                                    default.get('endpoint')),
+            cron=cron_dict,
+            max_snapshots=(v.getint('max_snapshots') or
+                           default.getint('max_snapshots')),
+            max_backups=(
+                    v.getint('max_backups') or
+                    default.getint('max_backups')),
+            max_incremental_backups_per_full=(
+                    v.getint('max_incremental_backups_per_full') or
+                    default.getint('max_incremental_backups_per_full')), # noqa
+            keep_hourly=(v.getint('keep_hourly') or
+                         default.getint('keep_hourly')),
+            keep_daily=(v.getint('keep_daily') or
+                        default.getint('keep_daily')),
+            keep_weekly=(v.getint('keep_weekly') or
+                         default.getint('keep_weekly')),
+            keep_monthly=(v.getint('keep_monthly') or
+                          default.getint('keep_monthly')),
+            storage_class=(v.get('storage_class') or
+                           default.get('storage_class')),
+            max_multipart_parts=(
+                    v.getint('max_multipart_parts') or
+                    default.getint('max_multipart_parts')),
+            spool=spool,
+            buffer_size=(v.getint('buffer_size') or
+                         default.getint('buffer_size')),
+            recursive=v.getboolean('recursive', fallback=False),
+            send_intermediate=v.getboolean('send_intermediate',
+                                           fallback=False),
+            backend=backend,
+            max_concurrency=(v.getint('max_concurrency') or
+                             default.getint('max_concurrency')),
+            min_part_size=(v.getint('min_part_size') or
+                           default.getint('min_part_size')),
+            request_timeout=(v.getint('request_timeout') or
+                             default.getint('request_timeout')),
+            stall_timeout=(v.getint('stall_timeout') or
+                           default.getint('stall_timeout')),
+            restore_priority=(
+                    v.getint('restore_priority') or
+                    default.getint('restore_priority')),
+            catalog=self.catalog,
+            verify_backups=v.getboolean('verify_backups', fallback=False),
+            node_id=v.get('node_id') or default.get('node_id'),
+            lease_duration=(v.getint('lease_duration') or
+                            default.getint('lease_duration')),
+            shard_backup_db=v.getboolean('shard_backup_db', fallback=False),
+            send_profile=v.get('send_profile') or default.get('send_profile')
+        )
+
+
+def _get_endpoints(value):
+    if value is None:
+        return None
+    return value.replace(',', ' ').split()
 
 
 def _create_cron_dict(cron):
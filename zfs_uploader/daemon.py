@@ -0,0 +1,291 @@
+from datetime import datetime, timedelta
+import logging
+import signal
+import threading
+
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.background import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+from zfs_uploader.config import Config
+from zfs_uploader.job import start_jobs
+
+# seconds until changes deferred by running maintenance are applied
+RELOAD_RETRY_INTERVAL = 60
+# scheduler job applying deferred changes
+RELOAD_JOB_ID = 'reload'
+CRON_FIELDS = ('minute', 'hour', 'day', 'month', 'day_of_week')
+
+
+class Daemon:
+    """ Backup job scheduler.
+
+    Jobs sharing a cron schedule are snapshotted together. The configuration
+    file is reloaded on SIGHUP. Only jobs whose options changed are
+    replaced and changes to running jobs are deferred until they finished.
+    """
+
+    @property
+    def jobs(self):
+        """ Jobs keyed by filesystem. """
+        with self._lock:
+            return dict(self._jobs)
+
+    @property
+    def schedules(self):
+        """ Filesystems of each cron schedule. """
+        with self._lock:
+            return {schedule: [job.filesystem for job in s.jobs]
+                    for schedule, s in self._schedules.items()}
+
+    @property
+    def scheduler(self):
+        """ APScheduler scheduler running the jobs. """
+        return self._scheduler
+
+    def __init__(self, config, maintenance):
+        """ Create Daemon object.
+
+        Parameters
+        ----------
+        config : Config
+            Initial configuration.
+        maintenance : MaintenanceQueue
+            Queue that retention, verification and catalog compaction are
+            deferred to.
+
+        """
+        self._config = config
+        self._maintenance = maintenance
+        self._max_parallel_jobs = config.max_parallel_jobs
+        self._scheduler = BlockingScheduler(
+            executors={'default': ThreadPoolExecutor(max_workers=1)},
+            job_defaults={'misfire_grace_time': None}
+        )
+        self._logger = logging.getLogger(__name__)
+
+        self._jobs = {}
+        self._settings = {}
+        self._schedules = {}
+        # filesystems of the schedule that is running
+        self._running = set()
+        # configuration waiting for running jobs to finish
+        self._pending = None
+        self._lock = threading.RLock()
+
+    def start(self):
+        """ Run jobs without a schedule and start the scheduler.
+
+        Blocks until the process is stopped. Returns right away if no job
+        has a schedule.
+        """
+        with self._lock:
+            unscheduled = self._apply(self._config)
+
+        for job in unscheduled:
+            self._logger.info(f'filesystem={job.filesystem} '
+                              'msg="Running job."')
+            job.start()
+
+        if not self._schedules:
+            return
+
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._on_sighup)
+        self._scheduler.start()
+
+    def reload(self):
+        """ Reload the configuration file.
+
+        The current configuration is kept if the file is invalid.
+        """
+        file_path = self._config.file_path
+        self._logger.info(f'file_path={file_path} '
+                          'msg="Reloading configuration file."')
+        try:
+            config = Config(file_path)
+            with self._lock:
+                self._load(config)
+        except (Exception, SystemExit) as e:
+            self._logger.error(f'file_path={file_path} '
+                               'msg="Keeping current configuration." '
+                               f'error="{e}"')
+
+    def _on_sighup(self, signum, frame):
+        # the scheduler isn't reentrant so it's never called from the
+        # signal handler
+        threading.Thread(target=self.reload, name='reload',
+                         daemon=True).start()
+
+    def _load(self, config):
+        for job in self._apply(config):
+            self._logger.info(f'filesystem={job.filesystem} '
+                              'msg="Running job."')
+            self._scheduler.add_job(
+                job.start, kwargs={'maintenance': self._maintenance},
+                name=job.filesystem)
+
+    def _load_pending(self):
+        with self._lock:
+            if self._pending is not None:
+                self._load(self._pending)
+
+    def _apply(self, config):
+        """ Add, replace and remove jobs and schedules.
+
+        Must be called with the lock held. Nothing is changed if a job or
+        schedule is invalid.
+
+        Returns
+        -------
+        list(ZFSjob)
+            Added or changed jobs without a schedule.
+
+        """
+        jobs = {}
+        settings = {}
+        deferred = []
+        for filesystem in config.filesystems:
+            job_settings = config.get_job_settings(filesystem)
+            job = self._jobs.get(filesystem)
+            if job_settings == self._settings.get(filesystem):
+                jobs[filesystem] = job
+                settings[filesystem] = job_settings
+            elif job is not None and self._is_running(job):
+                deferred.append(filesystem)
+            else:
+                jobs[filesystem] = config.get_job(filesystem)
+                settings[filesystem] = job_settings
+
+        for filesystem, job in self._jobs.items():
+            if filesystem not in jobs and self._is_running(job):
+                if filesystem not in deferred:
+                    deferred.append(filesystem)
+                jobs[filesystem] = job
+                settings[filesystem] = self._settings[filesystem]
+
+        schedule_jobs = {}
+        for job in jobs.values():
+            if job.cron:
+                schedule_jobs.setdefault(_get_schedule(job.cron),
+                                         []).append(job)
+        schedules = {}
+        for schedule, group in schedule_jobs.items():
+            schedules[schedule] = (self._schedules.get(schedule) or
+                                   _Schedule(CronTrigger(**group[0].cron)))
+
+        for filesystem, job in jobs.items():
+            old_job = self._jobs.get(filesystem)
+            if old_job is None:
+                self._logger.info(f'filesystem={filesystem} '
+                                  f'cron="{job.cron}" msg="Adding job."')
+            elif job is not old_job:
+                self._logger.info(f'filesystem={filesystem} '
+                                  f'cron="{job.cron}" msg="Updating job."')
+        for filesystem in self._jobs:
+            if filesystem not in jobs:
+                self._logger.info(f'filesystem={filesystem} '
+                                  'msg="Removing job."')
+        for filesystem in deferred:
+            self._logger.info(f'filesystem={filesystem} '
+                              'msg="Job running. Deferring changes."')
+
+        for schedule in self._schedules:
+            if schedule not in schedules:
+                self._scheduler.remove_job(schedule)
+        for schedule, s in schedules.items():
+            s.jobs = schedule_jobs[schedule]
+            if schedule not in self._schedules:
+                self._scheduler.add_job(self._run_schedule, s.trigger,
+                                        args=[schedule], id=schedule,
+                                        name=schedule, coalesce=True)
+
+        unscheduled = [job for filesystem, job in jobs.items()
+                       if not job.cron and
+                       job is not self._jobs.get(filesystem)]
+
+        self._jobs = jobs
+        self._settings = settings
+        self._schedules = schedules
+        self._max_parallel_jobs = config.max_parallel_jobs
+        self._config = config
+        self._pending = config if deferred else None
+
+        if deferred:
+            # running maintenance doesn't notify the daemon when it finished
+            self._scheduler.add_job(
+                self._load_pending, 'date',
+                run_date=(datetime.now() +
+                          timedelta(seconds=RELOAD_RETRY_INTERVAL)),
+                id=RELOAD_JOB_ID, name='reload', replace_existing=True)
+        else:
+            try:
+                self._scheduler.remove_job(RELOAD_JOB_ID)
+            except JobLookupError:
+                pass
+
+        return unscheduled
+
+    def _is_running(self, job):
+        return job.filesystem in self._running or job.running
+
+    def _run_schedule(self, schedule):
+        self._load_pending()
+        with self._lock:
+            s = self._schedules.get(schedule)
+            if s is None:
+                return
+            jobs = list(s.jobs)
+            scheduled_time = s.pop_scheduled_time()
+            max_workers = self._max_parallel_jobs
+            self._running.update(job.filesystem for job in jobs)
+
+        try:
+            start_jobs(jobs, max_workers, scheduled_time, self._maintenance)
+        finally:
+            with self._lock:
+                self._running.difference_update(job.filesystem
+                                                for job in jobs)
+            self._maintenance.submit('compact_catalog',
+                                     self._compact_catalog)
+            self._load_pending()
+
+    def _compact_catalog(self):
+        with self._lock:
+            catalog = self._config.catalog
+        catalog.compact(list(self.jobs))
+
+
+class _Schedule:
+    """ Jobs sharing a cron schedule.
+
+    Keeps track of the scheduled start time so that the queue wait includes
+    runs delayed by a previous run of the scheduler.
+    """
+
+    def __init__(self, trigger):
+        self.jobs = []
+        self.trigger = trigger
+        self._next_fire_time = self._get_next_fire_time()
+
+    def pop_scheduled_time(self):
+        """ Get the scheduled start time of the current run.
+
+        Returns
+        -------
+        float
+            Unix time.
+
+        """
+        scheduled_time = self._next_fire_time.timestamp()
+        self._next_fire_time = self._get_next_fire_time()
+        return scheduled_time
+
+    def _get_next_fire_time(self):
+        now = datetime.now(self.trigger.timezone)
+        return self.trigger.get_next_fire_time(None, now)
+
+
+def _get_schedule(cron):
+    return ' '.join(cron[field] for field in CRON_FIELDS)
@@ -0,0 +1,261 @@
+import logging
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from zfs_uploader.metrics import ENDPOINT_HEALTHY
+
+# consecutive failed requests after which an endpoint is ejected
+ENDPOINT_MAX_FAILURES = 3
+# ratio to the median latency of the other endpoints that counts as slow
+ENDPOINT_SLOW_FACTOR = 3
+# requests measured before an endpoint can be ejected for being slow
+ENDPOINT_MIN_SAMPLES = 5
+# seconds an ejected endpoint is skipped, doubled each time it fails again
+ENDPOINT_EJECT_INTERVAL = 30
+ENDPOINT_MAX_EJECT_INTERVAL = 600
+# weight of the most recent request in the moving average latency
+ENDPOINT_LATENCY_WEIGHT = 0.2
+
+_CONTEXT_KEY = 'zfs_uploader_endpoint'
+_PART_OPERATIONS = ('UploadPart', 'GetObject')
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class EndpointPool:
+    """ Gateways of one clustered object store.
+
+    Part uploads and ranged downloads are distributed across the endpoints
+    by smooth weighted round-robin. The weight of an endpoint is the
+    inverse of its moving average request latency. Endpoints that fail
+    repeatedly or are much slower than the others are ejected for a while
+    and then readmitted on probation. The last healthy endpoint is never
+    ejected.
+    """
+
+    @property
+    def endpoints(self):
+        """ Endpoint URLs. The first endpoint is the primary endpoint. """
+        return [endpoint.url for endpoint in self._endpoints]
+
+    @property
+    def healthy(self):
+        """ Endpoint URLs that are not ejected. """
+        with self._lock:
+            now = self._clock()
+            return [endpoint.url for endpoint in self._endpoints
+                    if endpoint.ejected_until <= now]
+
+    def __init__(self, endpoints, clock=time.monotonic):
+        """ Create EndpointPool object.
+
+        Parameters
+        ----------
+        endpoints : list(str)
+            Endpoint URLs of the same object store. Other requests are sent
+            to the first endpoint.
+        clock : callable, default: time.monotonic
+
+        """
+        if not endpoints:
+            raise ValueError('At least one endpoint is required.')
+
+        self._endpoints = [_Endpoint(url) for url in endpoints]
+        self._primary = urlsplit(endpoints[0])
+        self._clock = clock
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+        for endpoint in self._endpoints:
+            ENDPOINT_HEALTHY.set(1, endpoint=endpoint.url)
+
+    def choose(self):
+        """ Choose the endpoint of the next request.
+
+        Returns
+        -------
+        str
+            Endpoint URL.
+
+        """
+        with self._lock:
+            now = self._clock()
+            candidates = [endpoint for endpoint in self._endpoints
+                          if endpoint.ejected_until <= now]
+            if not candidates:
+                candidates = [min(self._endpoints,
+                                  key=lambda e: e.ejected_until)]
+
+            # unmeasured endpoints get the average weight
+            latencies = [e.latency for e in candidates if e.latency]
+            default = statistics.mean(latencies) if latencies else 1
+
+            total = 0
+            chosen = None
+            for endpoint in candidates:
+                weight = 1 / (endpoint.latency or default)
+                endpoint.current_weight += weight
+                total += weight
+                if chosen is None or \
+                        endpoint.current_weight > chosen.current_weight:
+                    chosen = endpoint
+            chosen.current_weight -= total
+
+            if chosen.ejected:
+                chosen.ejected = False
+                chosen.probation = True
+                ENDPOINT_HEALTHY.set(1, endpoint=chosen.url)
+                self._logger.info(f'endpoint={chosen.url} '
+                                  'msg="Readmitting endpoint."')
+
+            return chosen.url
+
+    def record(self, url, latency=None):
+        """ Record the outcome of a request.
+
+        Parameters
+        ----------
+        url : str
+            Endpoint URL.
+        latency : float, optional
+            Seconds the request took. None if the request failed.
+
+        """
+        with self._lock:
+            endpoint = next(e for e in self._endpoints if e.url == url)
+            if latency is None:
+                endpoint.failures += 1
+                if endpoint.probation or \
+                        endpoint.failures >= ENDPOINT_MAX_FAILURES:
+                    self._eject(endpoint, f'failures={endpoint.failures} '
+                                          'msg="Ejecting failing endpoint."')
+                return
+
+            endpoint.failures = 0
+            endpoint.probation = False
+            endpoint.eject_interval = ENDPOINT_EJECT_INTERVAL
+            endpoint.samples += 1
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += ENDPOINT_LATENCY_WEIGHT * (
+                        latency - endpoint.latency)
+
+            others = [e.latency for e in self._endpoints
+                      if e is not endpoint and e.latency and not e.ejected]
+            if endpoint.samples >= ENDPOINT_MIN_SAMPLES and others and \
+                    endpoint.latency > (ENDPOINT_SLOW_FACTOR *
+                                        statistics.median(others)):
+                self._eject(endpoint, f'latency={endpoint.latency:.3f} '
+                                      'msg="Ejecting slow endpoint."')
+
+    def instrument(self, client):
+        """ Distribute the part requests of an S3 client.
+
+        The endpoint is chosen again for each retry of a request.
+
+        Parameters
+        ----------
+        client : botocore.client.S3
+            S3 client created with the primary endpoint.
+
+        """
+        events = client.meta.events
+        for operation in _PART_OPERATIONS:
+            events.register(f'before-sign.s3.{operation}', self._before_sign)
+            events.register(f'response-received.s3.{operation}',
+                            self._response_received)
+
+    def _eject(self, endpoint, message):
+        """ Eject endpoint unless it is the last healthy endpoint. """
+        now = self._clock()
+        if not any(e.ejected_until <= now for e in self._endpoints
+                   if e is not endpoint):
+            return
+
+        endpoint.ejected = True
+        endpoint.ejected_until = now + endpoint.eject_interval
+        endpoint.eject_interval = min(2 * endpoint.eject_interval,
+                                      ENDPOINT_MAX_EJECT_INTERVAL)
+        endpoint.failures = 0
+        endpoint.probation = False
+        # readmitted endpoints are measured again
+        endpoint.latency = None
+        endpoint.samples = 0
+        ENDPOINT_HEALTHY.set(0, endpoint=endpoint.url)
+        self._logger.warning(f'endpoint={endpoint.url} {message}')
+
+    def _before_sign(self, request, **kwargs):
+        # downloads of whole objects like backup.db use the primary endpoint
+        if request.method == 'GET' and 'Range' not in request.headers:
+            return
+
+        url = self.choose()
+        request.url = _rewrite_url(request.url, self._primary, urlsplit(url))
+        request.context[_CONTEXT_KEY] = (url, self._clock())
+
+    def _response_received(self, context, exception, response_dict,
+                           **kwargs):
+        value = context.pop(_CONTEXT_KEY, None)
+        if value is None:
+            return
+
+        url, start = value
+        if exception is not None or response_dict['status_code'] >= 500:
+            self.record(url)
+        else:
+            self.record(url, self._clock() - start)
+
+
+def get_endpoint_pool(endpoints):
+    """ Get endpoint pool shared by all jobs using the same endpoints.
+
+    Parameters
+    ----------
+    endpoints : list(str)
+        Endpoint URLs.
+
+    Returns
+    -------
+    EndpointPool
+
+    """
+    key = tuple(endpoints)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = EndpointPool(endpoints)
+        return pool
+
+
+class _Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.samples = 0
+        self.failures = 0
+        self.current_weight = 0
+        self.ejected = False
+        self.ejected_until = 0
+        self.eject_interval = ENDPOINT_EJECT_INTERVAL
+        self.probation = False
+
+
+def _rewrite_url(url, primary, endpoint):
+    """ Send a request for the primary endpoint to another endpoint.
+
+    Virtual hosted-style bucket names in front of the host are kept.
+    """
+    parts = urlsplit(url)
+    netloc = parts.netloc
+    if netloc == primary.netloc:
+        netloc = endpoint.netloc
+    elif netloc.endswith('.' + primary.netloc):
+        netloc = netloc[:-len(primary.netloc)] + endpoint.netloc
+    else:
+        return url
+
+    return urlunsplit((endpoint.scheme, netloc, parts.path, parts.query,
+                       parts.fragment))
@@ -1,24 +1,64 @@
+from concurrent.futures import (as_completed, FIRST_COMPLETED,
+                                ThreadPoolExecutor, wait)
+from contextlib import contextmanager
 from datetime import datetime
 import logging
-import time
+import os
+import random
+import shutil
+import socket
 import sys
+import threading
+import time
 
 import boto3
-from boto3.s3.transfer import TransferConfig
-
-from zfs_uploader.backup_db import BackupDB, DATETIME_FORMAT
-from zfs_uploader.snapshot_db import SnapshotDB
+from boto3.s3.transfer import (create_transfer_manager,
+                               ProgressCallbackInvoker, TransferConfig)
+from botocore.config import Config as BotocoreConfig
+from botocore.exceptions import BotoCoreError, ClientError
+
+from zfs_uploader.backend import get_backend
+from zfs_uploader.backup_db import BackupDB, DATETIME_FORMAT, Verification
+from zfs_uploader.endpoints import get_endpoint_pool
+from zfs_uploader.lease import Lease
+from zfs_uploader.metrics import (instrument_client, JOB_FAILURES,
+                                  LAST_SUCCESS, PHASE_DURATION, QUEUE_WAIT)
+from zfs_uploader.progress import PROGRESS
+from zfs_uploader.retention import (plan_backups, plan_sharded_backups,
+                                    plan_snapshots, RetentionPolicy)
+from zfs_uploader.snapshot_db import create_snapshots, SnapshotDB
+from zfs_uploader.spool import SPOOL_CHUNK_SIZE, SpoolError
+from zfs_uploader.stream import (ChecksumReader, RingBuffer,
+                                 SendStreamVerifier)
+from zfs_uploader.throttle import ThrottledWriter
+from zfs_uploader.tracing import span
 from zfs_uploader.utils import derive_s3_key
-from zfs_uploader.zfs import (destroy_filesystem, destroy_snapshot,
+from zfs_uploader.zfs import (abort_receive, DEFAULT_SEND_PROFILE,
+                              destroy_filesystem, get_receive_resume_token,
                               get_snapshot_send_size,
                               get_snapshot_send_size_inc,
-                              open_snapshot_stream,
-                              open_snapshot_stream_inc, rollback_filesystem,
-                              ZFSError)
+                              is_send_profile_compatible, mount_filesystem,
+                              open_receive_check, open_snapshot_stream,
+                              open_snapshot_stream_inc,
+                              rename_filesystem, rollback_filesystem,
+                              SEND_PROFILES, ZFSError)
 
 KB = 1024
 MB = KB * KB
 S3_MAX_CONCURRENCY = 20
+S3_MIN_PART_SIZE = 8 * MB
+S3_REQUEST_TIMEOUT = 120
+S3_MAX_ATTEMPTS = 10
+STALL_TIMEOUT = 600
+DOWNLOAD_MAX_PARTS = 1000
+S3_MAX_DELETE_KEYS = 1000
+# name of the filesystem that full backups are dry-run received into
+VERIFY_FILESYSTEM = 'zfsup_verify'
+
+# one lock per filesystem so that job objects replaced by a configuration
+# reload never run alongside the objects replacing them
+_filesystem_locks = {}
+_filesystem_locks_lock = threading.Lock()
 
 
 class BackupError(Exception):
@@ -29,6 +69,10 @@ class RestoreError(Exception):
     """ Baseclass for restore exceptions. """
 
 
+class TransferStalledError(Exception):
+    """ Raised if an S3 transfer makes no progress. """
+
+
 class ZFSjob:
     """ ZFS backup job. """
     @property
@@ -46,6 +90,11 @@ class ZFSjob:
         """ S3 Endpoint. """
         return self._endpoint
 
+    @property
+    def endpoints(self):
+        """ S3 endpoints that parts are distributed across. """
+        return self._endpoints
+
     @property
     def access_key(self):
         """ S3 access key. """
@@ -91,6 +140,13 @@ class ZFSjob:
         """ Maximum number of incremental backups per full backup. """
         return self._max_incremental_backups_per_full
 
+    @property
+    def retention_policy(self):
+        """ Backup retention policy. """
+        return RetentionPolicy(self._max_backups, self._keep_hourly,
+                               self._keep_daily, self._keep_weekly,
+                               self._keep_monthly)
+
     @property
     def storage_class(self):
         """ S3 storage class. """
@@ -101,6 +157,76 @@ class ZFSjob:
         """ Maximum number of parts to use in a multipart S3 upload. """
         return self._max_multipart_parts
 
+    @property
+    def max_concurrency(self):
+        """ Maximum number of concurrent S3 part transfers. """
+        return self._max_concurrency
+
+    @property
+    def min_part_size(self):
+        """ Minimum multipart S3 part size in bytes. """
+        return self._min_part_size
+
+    @property
+    def request_timeout(self):
+        """ S3 connect and read timeout in seconds. """
+        return self._request_timeout
+
+    @property
+    def stall_timeout(self):
+        """ Seconds without progress until a transfer is cancelled. """
+        return self._stall_timeout
+
+    @property
+    def restore_priority(self):
+        """ Restore priority. Higher priorities are restored first. """
+        return self._restore_priority
+
+    @property
+    def recursive(self):
+        """ Back up the filesystem and its descendants as one stream. """
+        return self._recursive
+
+    @property
+    def send_intermediate(self):
+        """ Send intermediate snapshots with incremental backups. """
+        return self._send_intermediate
+
+    @property
+    def send_profile(self):
+        """ `zfs send` flags used for new backups. """
+        return self._send_profile
+
+    @property
+    def buffer_size(self):
+        """ Size of the ring buffer between zfs send and the uploader. """
+        return self._buffer_size
+
+    @property
+    def spool(self):
+        """ Spool for staging send streams. """
+        return self._spool
+
+    @property
+    def backend(self):
+        """ ZFS backend. """
+        return self._backend
+
+    @property
+    def verify_backups(self):
+        """ Verify each new backup in the maintenance queue. """
+        return self._verify_backups
+
+    @property
+    def lease(self):
+        """ Lease on the filesystem. None if leases are disabled. """
+        return self._lease
+
+    @property
+    def running(self):
+        """ True while a backup or maintenance of the filesystem runs. """
+        return self._lock.locked() or self._backup_waiting.is_set()
+
     @property
     def backup_db(self):
         """ BackupDB """
@@ -114,7 +240,15 @@ class ZFSjob:
     def __init__(self, bucket_name, access_key, secret_key, filesystem,
                  prefix=None, region=None, cron=None, max_snapshots=None,
                  max_backups=None, max_incremental_backups_per_full=None,
-                 storage_class=None, endpoint=None, max_multipart_parts=None):
+                 storage_class=None, endpoint=None, max_multipart_parts=None,
+                 spool=None, buffer_size=None, recursive=False,
+                 send_intermediate=False, backend=None, max_concurrency=None,
+                 min_part_size=None, request_timeout=None,
+                 stall_timeout=None, restore_priority=None, keep_hourly=None,
+                 keep_daily=None, keep_weekly=None, keep_monthly=None,
+                 catalog=None, verify_backups=False, node_id=None,
+                 lease_duration=None, shard_backup_db=False,
+                 send_profile=None):
         """ Create ZFSjob object.
 
         Parameters
@@ -131,8 +265,10 @@ class ZFSjob:
             The prefix added to the s3 key for backups.
         region : str, default: us-east-1
             S3 region.
-        endpoint : str, optional
-            S3 endpoint for alternative services
+        endpoint : str or list(str), optional
+            S3 endpoint for alternative services. Part uploads and ranged
+            downloads are distributed across multiple endpoints of the same
+            object store. Other requests use the first endpoint.
         cron : str, optional
             Cron schedule. Example: `* 0 * * *`
         max_snapshots : int, optional
@@ -145,6 +281,58 @@ class ZFSjob:
             S3 storage class.
         max_multipart_parts : int, default: 10000
             Maximum number of parts to use in a multipart S3 upload.
+        spool : Spool, optional
+            Spool for staging send streams on local disk.
+        buffer_size : int, default: 64 MiB
+            Size of the ring buffer between `zfs send` and the uploader in
+            bytes.
+        recursive : bool, default: False
+            Back up the filesystem and its descendants as one replication
+            stream.
+        send_intermediate : bool, default: False
+            Send incremental backups from the most recent backup and include
+            all intermediate snapshots (`zfs send -I`).
+        backend : ZFSBackend, optional
+            Backend used for listing, creating and destroying snapshots.
+            Defaults to the CLI backend.
+        max_concurrency : int, default: 20
+            Maximum number of concurrent S3 part transfers.
+        min_part_size : int, default: 8 MiB
+            Minimum multipart S3 part size in bytes. Larger parts are used
+            if the backup would need more than `max_multipart_parts` parts.
+        request_timeout : int, default: 120
+            S3 connect and read timeout in seconds. Timed out requests, such
+            as a part upload on a dead connection, are retried with
+            exponential backoff and jitter.
+        stall_timeout : int, default: 600
+            Cancel a transfer and fail the job if no bytes were transferred
+            for this many seconds.
+        restore_priority : int, default: 0
+            Jobs with higher priorities are restored first by
+            `restore_jobs`.
+        keep_hourly : int, optional
+            Keep the most recent backup of this many hours.
+        keep_daily : int, optional
+            Keep the most recent backup of this many days.
+        keep_weekly : int, optional
+            Keep the most recent backup of this many weeks.
+        keep_monthly : int, optional
+            Keep the most recent backup of this many months.
+        catalog : Catalog, optional
+            Local catalog mirroring `backup.db`.
+        verify_backups : bool, default: False
+            Verify each new backup in the maintenance queue.
+        node_id : str, default: host name
+            Name of this node in the lease on the filesystem.
+        lease_duration : int, optional
+            Only back up the filesystem while holding a lease that is valid
+            for this many seconds. Used for sharing the filesystems of one
+            bucket between nodes.
+        shard_backup_db : bool, default: False
+            Split `backup.db` into monthly shards.
+        send_profile : str, default: raw
+            `zfs send` flags used for new backups. Supported profiles are
+            `raw`, `compressed`, `large_block` and `plain`.
 
         """
         self._bucket_name = bucket_name
@@ -153,25 +341,69 @@ class ZFSjob:
         self._secret_key = secret_key
         self._filesystem = filesystem
         self._prefix = prefix
-        self._endpoint = endpoint
-
+        if isinstance(endpoint, str):
+            endpoint = [endpoint]
+        self._endpoints = list(endpoint or [])
+        self._endpoint = self._endpoints[0] if self._endpoints else None
+        self._max_concurrency = max_concurrency or S3_MAX_CONCURRENCY
+        self._request_timeout = request_timeout or S3_REQUEST_TIMEOUT
+        self._stall_timeout = stall_timeout or STALL_TIMEOUT
+
+        # standard retry mode uses exponential backoff with jitter
+        config = BotocoreConfig(connect_timeout=self._request_timeout,
+                                read_timeout=self._request_timeout,
+                                retries={'max_attempts': S3_MAX_ATTEMPTS,
+                                         'mode': 'standard'},
+                                max_pool_connections=self._max_concurrency)
         self._s3 = boto3.resource(service_name='s3',
                                   region_name=self._region,
                                   aws_access_key_id=self._access_key,
                                   aws_secret_access_key=self._secret_key,
-                                  endpoint_url=endpoint)
+                                  endpoint_url=self._endpoint,
+                                  config=config)
+        instrument_client(self._s3.meta.client, self._filesystem)
+        if len(self._endpoints) > 1:
+            get_endpoint_pool(self._endpoints).instrument(
+                self._s3.meta.client)
         self._bucket = self._s3.Bucket(self._bucket_name)
         self._backup_db = BackupDB(self._bucket, self._filesystem,
-                                   self._prefix)
-        self._snapshot_db = SnapshotDB(self._filesystem)
+                                   self._prefix, catalog, shard_backup_db)
+        self._recursive = recursive
+        self._send_intermediate = send_intermediate
+        self._send_profile = send_profile or DEFAULT_SEND_PROFILE
+        self._backend = backend or get_backend()
+        self._snapshot_db = SnapshotDB(self._filesystem, self._recursive,
+                                       self._backend)
         self._cron = cron
         self._max_snapshots = max_snapshots
         self._max_backups = max_backups
         self._max_incremental_backups_per_full = max_incremental_backups_per_full # noqa
+        self._keep_hourly = keep_hourly
+        self._keep_daily = keep_daily
+        self._keep_weekly = keep_weekly
+        self._keep_monthly = keep_monthly
         self._storage_class = storage_class or 'STANDARD'
         self._max_multipart_parts = max_multipart_parts or 10000
+        self._min_part_size = min_part_size or S3_MIN_PART_SIZE
+        self._restore_priority = restore_priority or 0
+        self._spool = spool
+        self._buffer_size = buffer_size
+        self._verify_backups = verify_backups
+        self._lease = None
+        if lease_duration:
+            self._lease = Lease(self._bucket, self._filesystem,
+                                node_id or socket.gethostname(),
+                                self._prefix, lease_duration)
         self._logger = logging.getLogger(__name__)
 
+        # held by backups and maintenance, backups go first
+        self._lock = _get_filesystem_lock(self._filesystem)
+        self._backup_waiting = threading.Event()
+        # transfers are cancelled if another node takes over the lease
+        self._lease_lost = threading.Event()
+        self._lease_callbacks = []
+        self._lease_lock = threading.Lock()
+
         if max_snapshots and not max_snapshots >= 0:
             self._logger.error(f'filesystem={self._filesystem} '
                                'msg="max_snapshots must be greater than or '
@@ -190,47 +422,315 @@ class ZFSjob:
                                'greater than or equal to 0."')
             sys.exit(1)
 
-    def start(self):
-        """ Start ZFS backup job. """
+        if self._send_profile not in SEND_PROFILES:
+            self._logger.error(f'filesystem={self._filesystem} '
+                               'msg="send_profile must be one of '
+                               f'{", ".join(SEND_PROFILES)}."')
+            sys.exit(1)
+
+        try:
+            self.retention_policy
+        except ValueError as e:
+            self._logger.error(f'filesystem={self._filesystem} '
+                               f'msg="{e}"')
+            sys.exit(1)
+
+    def start(self, snapshot=None, maintenance=None):
+        """ Start ZFS backup job.
+
+        Parameters
+        ----------
+        snapshot : Snapshot, optional
+            Snapshot to back up. A new snapshot is created if not provided.
+        maintenance : MaintenanceQueue, optional
+            Queue that retention and verification are deferred to. They
+            run right after the upload if not provided.
+
+        """
+        if not self.acquire_lease():
+            return
+
+        self.acquire_backup_lock()
+        try:
+            with self.run_backup():
+                self._start(snapshot, retention=maintenance is None)
+        finally:
+            self.release_backup_lock()
+
+        if maintenance is not None:
+            maintenance.submit('maintain', self.maintain, self._filesystem)
+
+    def acquire_backup_lock(self):
+        """ Wait until no backup or maintenance of the filesystem runs.
+
+        Running maintenance stops at its next checkpoint.
+        """
+        self._backup_waiting.set()
+        try:
+            self._lock.acquire()
+        finally:
+            self._backup_waiting.clear()
+
+    def release_backup_lock(self):
+        """ Let maintenance and the next backup of the filesystem run. """
+        self._lock.release()
+
+    @contextmanager
+    def run_backup(self):
+        """ Trace a backup, renew the lease and record the job metrics.
+
+        The backup lock must be held while the block runs.
+        """
         self._logger.info(f'filesystem={self._filesystem} msg="Starting job."')
-        backups_inc = self._backup_db.get_backups(backup_type='inc')
-        backups_full = self._backup_db.get_backups(backup_type='full')
 
+        try:
+            with self.trace_phase('job'), self._hold_lease():
+                yield
+        except Exception:
+            JOB_FAILURES.inc(filesystem=self._filesystem)
+            raise
+
+        LAST_SUCCESS.set(time.time(), filesystem=self._filesystem)
+        self._logger.info(f'filesystem={self._filesystem} msg="Finished job."')
+
+    def maintain(self):
+        """ Run deferred retention and verification.
+
+        Maintenance never delays a backup of the filesystem. It is skipped
+        if a backup is running and stops between deletions if a backup is
+        waiting. The backup requests maintenance again once it finished.
+
+        Returns
+        -------
+        bool
+            False if maintenance was skipped or stopped.
+
+        """
+        if not self.acquire_lease():
+            return False
+
+        if self._backup_waiting.is_set() or \
+                not self._lock.acquire(blocking=False):
+            self._logger.info(f'filesystem={self._filesystem} '
+                              'msg="Backup running. Skipping maintenance."')
+            return False
+
+        try:
+            with self.trace_phase('maintenance'):
+                self.prune(interrupt=self._backup_waiting.is_set)
+        finally:
+            self._lock.release()
+
+        if self._backup_waiting.is_set():
+            self._logger.info(f'filesystem={self._filesystem} '
+                              'msg="Backup waiting. Stopped maintenance."')
+            return False
+
+        if self._verify_backups:
+            self._verify_latest_backup()
+        return True
+
+    def acquire_lease(self):
+        """ Acquire or renew the lease on the filesystem.
+
+        Returns
+        -------
+        bool
+            True if leases are disabled or the lease was acquired. False if
+            another node holds the lease.
+
+        """
+        if self._lease is None:
+            return True
+
+        held = self._lease.held
+        if self._lease.acquire():
+            if not held:
+                # another node may have changed backup.db while it held the
+                # lease
+                self._backup_db.reload()
+            return True
+
+        self._logger.info(f'filesystem={self._filesystem} '
+                          f'holder={self._lease.holder} '
+                          'msg="Lease held by another node. Skipping job."')
+        return False
+
+    def release_lease(self):
+        """ Let other nodes take over the filesystem right away. """
+        if self._lease is None:
+            return
+
+        try:
+            self._lease.release()
+        except (BotoCoreError, ClientError) as e:
+            self._logger.warning(f'filesystem={self._filesystem} '
+                                 'msg="Failed to release lease." '
+                                 f'error="{e}"')
+
+    @contextmanager
+    def _hold_lease(self):
+        """ Renew the lease while a backup runs.
+
+        Running transfers are cancelled if the lease is lost.
+        """
+        if self._lease is None:
+            yield
+            return
+
+        self._lease_lost.clear()
+        try:
+            with self._lease.hold(on_lost=self._lose_lease):
+                yield
+        finally:
+            self._lease_lost.clear()
+
+    def _lose_lease(self):
+        with self._lease_lock:
+            self._lease_lost.set()
+            callbacks = list(self._lease_callbacks)
+        for callback in callbacks:
+            callback()
+
+    @contextmanager
+    def _cancel_on_lease_loss(self, cancel):
+        """ Call cancel if the lease is lost while the block runs. """
+        with self._lease_lock:
+            self._lease_callbacks.append(cancel)
+            lost = self._lease_lost.is_set()
+        if lost:
+            cancel()
+        try:
+            yield
+        finally:
+            with self._lease_lock:
+                self._lease_callbacks.remove(cancel)
+
+    def _check_lease(self):
+        """ Raise BackupError if the lease was lost during the backup. """
+        if self._lease_lost.is_set():
+            raise BackupError(f'Lost lease on {self._filesystem} to another '
+                              'node.')
+
+    def _verify_latest_backup(self):
+        """ Verify the most recent backup if it wasn't verified yet. """
+        backup = self._backup_db.get_latest_backup()
+        if backup is None or backup.verification is not None:
+            return
+
+        verification = self.verify_backup(backup)
+        self._backup_db.set_verifications([verification])
+
+    def _start(self, snapshot=None, retention=True):
+        """ Run backup job phases. """
+        if self._spool:
+            with self.trace_phase('spool_resume'):
+                self._upload_spool_files()
+
+        base = self.get_backup_source()
+        if base is None:
+            self._backup_full(snapshot)
+        else:
+            self._backup_incremental(base, snapshot)
+
+        if retention:
+            self.prune()
+
+    def get_backup_source(self):
+        """ Get incremental source of the next backup.
+
+        Returns
+        -------
+        str
+            Backup time of the incremental source. None is returned if the
+            next backup is a full backup.
+
+        """
         # find most recent full backup
-        backup = backups_full[-1] if backups_full else None
+        backup = self._backup_db.get_latest_backup(backup_type='full')
 
         # if no full backup exists
         if backup is None:
-            self._backup_full()
+            return None
+
+        # if zfs receive would reject an incremental stream of the profile
+        elif not is_send_profile_compatible(self._send_profile,
+                                            backup.send_profile):
+            self._logger.info(f'filesystem={self._filesystem} '
+                              f'send_profile={self._send_profile} '
+                              'msg="Send profile changed. Starting full '
+                              'backup."')
+            return None
 
         # if we don't want incremental backups
         elif self._max_incremental_backups_per_full == 0:
-            self._backup_full()
+            return None
 
         # if we want incremental backups and multiple full backups
         elif self._max_incremental_backups_per_full:
             backup_time = backup.backup_time
 
-            dependants = [True if b.dependency == backup_time
-                          else False for b in backups_inc]
+            if self._send_intermediate:
+                latest = self._backup_db.get_latest_backup()
+                chain = self._backup_db.get_chain(latest.backup_time)
+                dependants = [True for b in chain[1:]]
+            else:
+                # dependants are never older than their full backup
+                backups_inc = self._backup_db.get_backups(
+                    backup_type='inc', since=backup_time)
+                dependants = [True if b.dependency == backup_time
+                              else False for b in backups_inc]
 
             if sum(dependants) >= self._max_incremental_backups_per_full:
-                self._backup_full()
+                return None
             else:
-                self._backup_incremental(backup_time)
+                return self._get_base(backup)
 
         # if we want incremental backups and not multiple full backups
         else:
-            self._backup_incremental(backup.backup_time)
+            return self._get_base(backup)
 
-        if self._max_snapshots or self._max_snapshots == 0:
-            self._limit_snapshots()
-        if self._max_backups or self._max_backups == 0:
-            self._limit_backups()
+    def prune(self, dry_run=False, interrupt=None):
+        """ Apply snapshot and backup retention.
 
-        self._logger.info(f'filesystem={self._filesystem} msg="Finished job."')
+        Parameters
+        ----------
+        dry_run : bool, default: False
+            Only compute what would be deleted.
+        interrupt : callable, optional
+            Checked between deletions. Retention stops early if it returns
+            True.
+
+        Returns
+        -------
+        tuple(RetentionPlan, RetentionPlan)
+            Snapshot and backup retention plans. None if no limit is set.
+
+        """
+        snapshot_plan = None
+        if self._max_snapshots is not None:
+            with self.trace_phase('limit_snapshots'):
+                snapshot_plan = self._limit_snapshots(dry_run)
+
+        backup_plan = None
+        if self.retention_policy and not (interrupt and interrupt()):
+            with self.trace_phase('limit_backups'):
+                backup_plan = self._limit_backups(dry_run, interrupt)
+
+        # shards left behind by failed backup.db uploads
+        if not dry_run and self._backup_db.sharded and \
+                not (interrupt and interrupt()):
+            try:
+                self._backup_db.delete_orphaned_shards()
+            except (BotoCoreError, ClientError) as e:
+                self._logger.warning(f'filesystem={self._filesystem} '
+                                     'msg="Failed to delete orphaned '
+                                     f'shards." error="{e}"')
 
-    def restore(self, backup_time=None, filesystem=None):
+        return snapshot_plan, backup_plan
+
+    def restore(self, backup_time=None, filesystem=None, subtree=None,
+                rate_limiter=None):
         """ Restore from backup.
 
         Defaults to most recent backup if backup_time is not specified.
@@ -248,12 +748,26 @@ class ZFSjob:
         filesystem : str, optional
             File system to restore to. Defaults to the file system that the
             backup was taken from.
+
+        subtree : str, optional
+            Descendant filesystem to restore from a recursive backup. The
+            subtree is restored to `filesystem` or to its original name and
+            the destination must not exist.
+
+        rate_limiter : RateLimiter, optional
+            Limits the download bandwidth. May be shared by many restores.
         """
         self._snapshot_db.refresh()
         snapshots = self._snapshot_db.get_snapshot_names()
 
+        snapshot_name = None
         if backup_time:
-            backup = self._backup_db.get_backup(backup_time)
+            if backup_time in self._backup_db.get_backup_times():
+                backup = self._backup_db.get_backup(backup_time)
+            else:
+                # restore intermediate snapshot of an incremental backup
+                backup = self._backup_db.get_backup_containing(backup_time)
+                snapshot_name = backup_time
         else:
             backups = self._backup_db.get_backups()
             if backups is None:
@@ -262,9 +776,16 @@ class ZFSjob:
                 backup = backups[-1]
 
         backup_time = backup.backup_time
-        backup_type = backup.backup_type
         s3_key = backup.s3_key
 
+        # fail before anything is destroyed
+        chain = self._backup_db.get_chain(backup_time)
+        _check_send_profiles(chain)
+
+        if subtree:
+            self._restore_subtree(backup, subtree, filesystem, rate_limiter)
+            return
+
         # Since we can't use the `-F` option with `zfs receive` for encrypted
         # filesystems we have to handle removing filesystems, snapshots, and
         # data written after the most recent snapshot ourselves.
@@ -273,6 +794,7 @@ class ZFSjob:
                 # Destroy any snapshots that occurred after the backup
                 backup_datetime = datetime.strptime(backup_time,
                                                     DATETIME_FORMAT)
+                destroy = []
                 for snapshot in snapshots:
                     snapshot_datetime = datetime.strptime(snapshot,
                                                           DATETIME_FORMAT)
@@ -282,8 +804,9 @@ class ZFSjob:
                                           f's3_key={s3_key} '
                                           f'msg="Destroying {snapshot} since '
                                           'it occurred after the backup."')
-                        destroy_snapshot(backup.filesystem, snapshot)
+                        destroy.append(snapshot)
 
+                self._snapshot_db.delete_snapshots(destroy)
                 self._snapshot_db.refresh()
                 snapshots = self._snapshot_db.get_snapshot_names()
 
@@ -295,9 +818,22 @@ class ZFSjob:
                                       f's3_key={s3_key} '
                                       'msg="Rolling filesystem back to '
                                       f'{snapshots[-1]}"')
-                    out = rollback_filesystem(backup.filesystem, snapshots[-1])
-                    if out.returncode:
-                        raise ZFSError(out.stderr)
+                    if backup.recursive:
+                        filesystems = self._backend.list_filesystems(
+                            backup.filesystem)
+                        # descendants created after the snapshot don't
+                        # have it
+                        existing = self._backend.list_snapshots(filesystems)
+                        filesystems = [
+                            name for name in filesystems
+                            if f'{name}@{snapshots[-1]}' in existing]
+                    else:
+                        filesystems = [backup.filesystem]
+
+                    for name in filesystems:
+                        out = rollback_filesystem(name, snapshots[-1])
+                        if out.returncode:
+                            raise ZFSError(out.stderr)
 
                     self._snapshot_db.refresh()
                     snapshots = self._snapshot_db.get_snapshot_names()
@@ -317,44 +853,111 @@ class ZFSjob:
                                   'no snapshots."')
                 destroy_filesystem(backup.filesystem)
 
-        if backup_type == 'full':
-            if backup_time in snapshots and filesystem is None:
+        # restore full backup first followed by incremental backups
+        for b in chain:
+            if b.backup_time in snapshots and filesystem is None:
                 self._logger.info(f'filesystem={self.filesystem} '
-                                  f'snapshot_name={backup_time} '
-                                  f's3_key={s3_key} '
+                                  f'snapshot_name={b.backup_time} '
+                                  f's3_key={b.s3_key} '
                                   'msg="Snapshot already exists."')
             else:
-                self._restore_snapshot(backup, filesystem)
+                self._restore_snapshot(b, filesystem,
+                                       rate_limiter=rate_limiter)
+
+        if snapshot_name:
+            self._logger.info(f'filesystem={self.filesystem} '
+                              f'snapshot_name={snapshot_name} '
+                              f's3_key={s3_key} '
+                              'msg="Rolling filesystem back to intermediate '
+                              'snapshot."')
+            out = rollback_filesystem(filesystem or backup.filesystem,
+                                      snapshot_name)
+            if out.returncode:
+                raise ZFSError(out.stderr)
+            self._snapshot_db.refresh()
+
+    def _restore_subtree(self, backup, subtree, filesystem=None,
+                         rate_limiter=None):
+        """ Restore descendant filesystem from recursive backup.
+
+        The replication stream is received unmounted into a staging
+        filesystem. The subtree is then renamed to the destination and the
+        staging filesystem is destroyed.
+
+        Parameters
+        ----------
+        backup : Backup
 
-        elif backup_type == 'inc':
-            # restore full backup first
-            backup_full = self._backup_db.get_backup(backup.dependency)
+        subtree : str
+            Descendant filesystem to restore.
 
-            if backup_full.backup_time in snapshots and filesystem is None:
-                self._logger.info(f'filesystem={self.filesystem} '
-                                  f'snapshot_name={backup_full.backup_time} '
-                                  f's3_key={backup_full.s3_key} '
-                                  'msg="Snapshot already exists."')
-            else:
-                self._restore_snapshot(backup_full, filesystem)
+        filesystem : str, optional
+            File system to restore to. Defaults to the subtree.
 
-            if backup_time in snapshots and filesystem is None:
-                self._logger.info(f'filesystem={self.filesystem} '
-                                  f'snapshot_name={backup_time} '
-                                  f's3_key={s3_key} '
-                                  'msg="Snapshot already exists."')
-            else:
-                self._restore_snapshot(backup, filesystem)
+        rate_limiter : RateLimiter, optional
+            Limits the download bandwidth.
+        """
+        if not backup.recursive:
+            raise RestoreError('Backup is not recursive.')
+
+        if (subtree != backup.filesystem and
+                not subtree.startswith(f'{backup.filesystem}/')):
+            raise RestoreError('Subtree is not a descendant of '
+                               f'{backup.filesystem}.')
+
+        destination = filesystem or subtree
+        if self._backend.list_filesystems(destination):
+            raise RestoreError(f'{destination} already exists.')
+
+        backups = [backup]
+        if backup.backup_type == 'inc':
+            backups.insert(0, self._backup_db.get_backup(backup.dependency))
+
+        pool = destination.split('/')[0]
+        staging = f'{pool}/zfsup_restore_{backup.backup_time}'
+
+        try:
+            for b in backups:
+                self._restore_snapshot(b, staging, mount=False,
+                                       rate_limiter=rate_limiter)
+
+            relative = subtree[len(backup.filesystem):]
+            self._logger.info(f'filesystem={destination} '
+                              f'snapshot_name={backup.backup_time} '
+                              f's3_key={backup.s3_key} '
+                              f'msg="Renaming {staging}{relative}."')
+            out = rename_filesystem(f'{staging}{relative}', destination)
+            if out.returncode:
+                raise ZFSError(out.stderr)
+        finally:
+            destroy_filesystem(staging)
+
+        for name in self._backend.list_filesystems(destination):
+            out = mount_filesystem(name)
+            if out.returncode:
+                self._logger.warning(f'filesystem={name} '
+                                     'msg="Unable to mount filesystem." '
+                                     f'error="{out.stderr.strip()}"')
+
+    def _backup_full(self, snapshot=None):
+        """ Create snapshot and upload full backup.
 
-    def _backup_full(self):
-        """ Create snapshot and upload full backup. """
-        snapshot = self._snapshot_db.create_snapshot()
+        Parameters
+        ----------
+        snapshot : Snapshot, optional
+            Snapshot to back up. A new snapshot is created if not provided.
+
+        """
+        if snapshot is None:
+            with self.trace_phase('snapshot'):
+                snapshot = self._snapshot_db.create_snapshot()
         backup_time = snapshot.name
         filesystem = snapshot.filesystem
 
-        send_size = int(get_snapshot_send_size(filesystem, backup_time))
-        transfer_config = _get_transfer_config(send_size,
-                                               self._max_multipart_parts)
+        with self.trace_phase('send_size'):
+            send_size = int(get_snapshot_send_size(filesystem, backup_time,
+                                                   self._recursive,
+                                                   self._send_profile))
 
         s3_key = derive_s3_key(f'{backup_time}.full', filesystem,
                                self.prefix)
@@ -364,47 +967,73 @@ class ZFSjob:
                           f's3_key={s3_key} '
                           'msg="Starting full backup."')
 
-        with open_snapshot_stream(filesystem, backup_time, 'r') as f:
-            transfer_callback = TransferCallback(self._logger, send_size,
-                                                 filesystem, backup_time,
-                                                 s3_key)
-            self._bucket.upload_fileobj(f.stdout,
-                                        s3_key,
-                                        Callback=transfer_callback.callback,
-                                        Config=transfer_config,
-                                        ExtraArgs={
-                                            'StorageClass': self._storage_class
-                                        })
-            stderr = f.stderr.read().decode('utf-8')
-        if f.returncode:
-            raise ZFSError(stderr)
+        self._upload_snapshot(
+            lambda: open_snapshot_stream(filesystem, backup_time, 'r',
+                                         self._recursive,
+                                         send_profile=self._send_profile),
+            backup_time, 'full', s3_key, send_size)
 
-        backup_size = self._check_backup(s3_key)
-        self._backup_db.create_backup(backup_time, 'full', s3_key,
-                                      dependency=None, backup_size=backup_size)
         self._logger.info(f'filesystem={filesystem} '
                           f'snapshot_name={backup_time} '
                           f's3_key={s3_key} '
                           'msg="Finished full backup."')
 
-    def _backup_incremental(self, backup_time_full):
+    def _get_base(self, backup_full):
+        """ Get backup time of the incremental source snapshot.
+
+        Incremental backups are sent from the full backup unless intermediate
+        snapshots are sent. They are then sent from the most recent backup
+        of the chain whose snapshot still exists.
+
+        Parameters
+        ----------
+        backup_full : Backup
+            Most recent full backup.
+
+        Returns
+        -------
+        str
+
+        """
+        if not self._send_intermediate:
+            return backup_full.backup_time
+
+        snapshots = self._snapshot_db.get_snapshot_names()
+        latest = self._backup_db.get_latest_backup()
+        for backup in reversed(self._backup_db.get_chain(
+                latest.backup_time)):
+            if backup.backup_time in snapshots:
+                return backup.backup_time
+
+        return backup_full.backup_time
+
+    def _backup_incremental(self, backup_time_full, snapshot=None):
         """ Create snapshot and upload incremental backup.
 
         Parameters
         ----------
         backup_time_full : str
-            Backup time in %Y%m%d_%H%M%S format.
+            Backup time in %Y%m%d_%H%M%S format of the incremental source.
+            This is the full backup unless intermediate snapshots are sent.
+        snapshot : Snapshot, optional
+            Snapshot to back up. A new snapshot is created if not provided.
 
         """
-        snapshot = self._snapshot_db.create_snapshot()
+        if snapshot is None:
+            with self.trace_phase('snapshot'):
+                snapshot = self._snapshot_db.create_snapshot()
         backup_time = snapshot.name
         filesystem = snapshot.filesystem
 
-        send_size = int(get_snapshot_send_size_inc(filesystem,
-                                                   backup_time_full,
-                                                   backup_time))
-        transfer_config = _get_transfer_config(send_size,
-                                               self._max_multipart_parts)
+        with self.trace_phase('send_size'):
+            send_size = int(get_snapshot_send_size_inc(
+                filesystem, backup_time_full, backup_time, self._recursive,
+                self._send_intermediate, self._send_profile))
+
+        snapshots = None
+        if self._send_intermediate:
+            snapshots = self._snapshot_db.get_snapshot_names_between(
+                backup_time_full, backup_time)
 
         s3_key = derive_s3_key(f'{backup_time}.inc', filesystem,
                                self.prefix)
@@ -414,32 +1043,457 @@ class ZFSjob:
                           f's3_key={s3_key} '
                           'msg="Starting incremental backup."')
 
-        with open_snapshot_stream_inc(
-                filesystem, backup_time_full, backup_time) as f:
-            transfer_callback = TransferCallback(self._logger, send_size,
-                                                 filesystem, backup_time,
-                                                 s3_key)
-            self._bucket.upload_fileobj(
-                f.stdout,
-                s3_key,
-                Callback=transfer_callback.callback,
-                Config=transfer_config,
-                ExtraArgs={
-                    'StorageClass': self._storage_class
-                })
+        self._upload_snapshot(
+            lambda: open_snapshot_stream_inc(filesystem, backup_time_full,
+                                             backup_time, self._recursive,
+                                             self._send_intermediate,
+                                             self._send_profile),
+            backup_time, 'inc', s3_key, send_size,
+            dependency=backup_time_full, snapshots=snapshots)
+
+        self._logger.info(f'filesystem={filesystem} '
+                          f'snapshot_name={backup_time} '
+                          f's3_key={s3_key} '
+                          'msg="Finished incremental backup."')
+
+    def _upload_snapshot(self, open_stream, backup_time, backup_type, s3_key,
+                         send_size, dependency=None, snapshots=None):
+        """ Upload snapshot stream and create backup.
+
+        The stream is staged in the spool directory if a spool is configured
+        and has enough space.
+
+        Parameters
+        ----------
+        open_stream : callable
+            Returns the `zfs send` process.
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+        backup_type : str
+            Supported backup types are `full` and `inc`.
+        s3_key : str
+            Backup S3 key.
+        send_size : int
+            Estimated send size in bytes.
+        dependency : str, optional
+            Backup time of dependency in %Y%m%d_%H%M%S format.
+        snapshots : list(str), optional
+            Names of the snapshots contained in the stream.
+
+        """
+        spool_file = None
+        if self._spool:
+            metadata = {'backup_time': backup_time,
+                        'backup_type': backup_type,
+                        's3_key': s3_key,
+                        'dependency': dependency,
+                        'recursive': self._recursive,
+                        'snapshots': snapshots,
+                        'send_profile': self._send_profile}
+            spool_file = self._spool.reserve(self._filesystem,
+                                             f'{backup_time}.{backup_type}',
+                                             send_size, metadata)
+            if spool_file is None:
+                self._logger.warning(f'filesystem={self._filesystem} '
+                                     f'snapshot_name={backup_time} '
+                                     f's3_key={s3_key} '
+                                     'msg="Spool is full. Uploading directly '
+                                     'from send stream."')
+
+        with self.trace_phase('upload', s3_key=s3_key, send_size=send_size,
+                              spooled=spool_file is not None), \
+                open_stream() as f:
+            if spool_file is None:
+                with RingBuffer(f.stdout, self._buffer_size) as buffer:
+                    checksum = self._upload_fileobj(buffer, s3_key,
+                                                    send_size, backup_time,
+                                                    buffer=buffer, process=f)
+            else:
+                spool_file.start(f.stdout)
+                uploaded = False
+                try:
+                    with spool_file.open() as fileobj:
+                        checksum = self._upload_fileobj(fileobj, s3_key,
+                                                        send_size,
+                                                        backup_time,
+                                                        process=f)
+                    uploaded = True
+                finally:
+                    try:
+                        spool_file.join()
+                    except SpoolError as e:
+                        if uploaded:
+                            raise
+                        # the upload error is raised instead
+                        self._logger.warning(
+                            f'filesystem={self._filesystem} '
+                            f'snapshot_name={backup_time} '
+                            f's3_key={s3_key} '
+                            'msg="Failed to write spool file." '
+                            f'error="{e}"')
+                    else:
+                        # keep a complete send stream for resuming the
+                        # upload
+                        if f.wait() == 0:
+                            spool_file.complete()
             stderr = f.stderr.read().decode('utf-8')
         if f.returncode:
+            if spool_file:
+                spool_file.remove()
             raise ZFSError(stderr)
 
-        backup_size = self._check_backup(s3_key)
-        self._backup_db.create_backup(backup_time, 'inc', s3_key,
-                                      backup_time_full, backup_size)
-        self._logger.info(f'filesystem={filesystem} '
+        self.record_backup(backup_time, backup_type, s3_key, checksum,
+                           dependency, snapshots)
+        if spool_file:
+            spool_file.remove()
+
+    def _upload_spool_files(self):
+        """ Resume uploads of spool files left over from a previous run. """
+        backup_times = self._backup_db.get_backup_times()
+
+        for spool_file in self._spool.get_spool_files(self._filesystem):
+            metadata = spool_file.metadata
+            backup_time = metadata['backup_time']
+            backup_type = metadata['backup_type']
+            dependency = metadata['dependency']
+            s3_key = metadata['s3_key']
+
+            if backup_time in backup_times:
+                spool_file.remove()
+                continue
+
+            if dependency and dependency not in backup_times:
+                self._logger.warning(f'filesystem={self._filesystem} '
+                                     f'snapshot_name={backup_time} '
+                                     f's3_key={s3_key} '
+                                     'msg="Dependency no longer exists. '
+                                     'Removing spool file."')
+                spool_file.remove()
+                continue
+
+            self._logger.info(f'filesystem={self._filesystem} '
+                              f'snapshot_name={backup_time} '
+                              f's3_key={s3_key} '
+                              'msg="Resuming upload from spool file."')
+
+            send_size = os.path.getsize(spool_file.path)
+            with self.trace_phase('upload', s3_key=s3_key,
+                                  send_size=send_size, spooled=True), \
+                    open(spool_file.path, 'rb') as f:
+                checksum = self._upload_fileobj(f, s3_key, send_size,
+                                                backup_time)
+
+            self.record_backup(backup_time, backup_type, s3_key, checksum,
+                               dependency, metadata.get('snapshots'),
+                               metadata.get('recursive', False),
+                               metadata.get('send_profile'))
+            backup_times.append(backup_time)
+            spool_file.remove()
+
+    def record_backup(self, backup_time, backup_type, s3_key, checksum,
+                      dependency=None, snapshots=None, recursive=None,
+                      send_profile=None):
+        """ Check an uploaded backup and add it to `backup.db`.
+
+        Parameters
+        ----------
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+        backup_type : str
+            Supported backup types are `full` and `inc`.
+        s3_key : str
+            Backup S3 key.
+        checksum : str
+            SHA-256 digest of the uploaded stream.
+        dependency : str, optional
+            Backup time of dependency in %Y%m%d_%H%M%S format.
+        snapshots : list(str), optional
+            Names of the snapshots contained in the stream.
+        recursive : bool, optional
+            Defaults to the `recursive` option of the job.
+        send_profile : str, optional
+            Defaults to the send profile of the job.
+
+        Raises
+        ------
+        BackupError
+            If the upload is empty or the lease was lost.
+
+        """
+        if recursive is None:
+            recursive = self._recursive
+
+        with self.trace_phase('check', s3_key=s3_key):
+            backup_size = self._check_backup(s3_key)
+        self._check_lease()
+        with self.trace_phase('backup_db'):
+            self._backup_db.create_backup(backup_time, backup_type, s3_key,
+                                          dependency, backup_size, recursive,
+                                          snapshots, checksum,
+                                          self._storage_class,
+                                          send_profile or self._send_profile)
+
+    def _upload_fileobj(self, fileobj, s3_key, send_size, backup_time,
+                        buffer=None, process=None):
+        """ Upload file object to S3.
+
+        Parameters
+        ----------
+        fileobj : file
+            Readable file object.
+        s3_key : str
+            Backup S3 key.
+        send_size : int
+            Estimated send size in bytes.
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+        buffer : RingBuffer, optional
+            Ring buffer used for reporting the fill level.
+        process : subprocess.Popen, optional
+            `zfs send` process feeding the file object. Killed if the
+            upload stalls.
+
+        Returns
+        -------
+        str
+            SHA-256 digest of the uploaded data.
+
+        Raises
+        ------
+        TransferStalledError
+
+        """
+        fileobj = ChecksumReader(fileobj)
+        transfer_config = _get_transfer_config(send_size,
+                                               self._max_multipart_parts,
+                                               self._max_concurrency,
+                                               self._min_part_size)
+        with PROGRESS.track(self._filesystem, backup_time, s3_key,
+                            send_size, buffer=buffer,
+                            stall_timeout=self._stall_timeout) as transfer, \
+                create_transfer_manager(self._s3.meta.client,
+                                        transfer_config) as manager:
+            future = manager.upload(
+                fileobj, self._bucket_name, s3_key,
+                extra_args={'StorageClass': self._storage_class},
+                subscribers=[ProgressCallbackInvoker(transfer.callback)])
+            self._wait_for_transfer(future, transfer, process)
+
+        return fileobj.hexdigest()
+
+    def _wait_for_transfer(self, future, transfer, process=None):
+        """ Wait for S3 transfer and cancel it if it stalls.
+
+        Stalled parts are retried by botocore. The watchdog of the progress
+        engine only fires if the whole transfer makes no progress.
+
+        Parameters
+        ----------
+        future : s3transfer.futures.TransferFuture
+        transfer : Transfer
+        process : subprocess.Popen, optional
+            `zfs` process reading from or writing to the transfer. Killed on
+            stall so that blocked stream reads and writes return.
+
+        Raises
+        ------
+        TransferStalledError
+        BackupError
+            If the lease was lost during the transfer.
+
+        """
+        def cancel():
+            future.cancel()
+            if process is not None:
+                process.kill()
+
+        with self.watch_transfer(transfer, cancel):
+            return future.result()
+
+    @contextmanager
+    def watch_transfer(self, transfer, cancel):
+        """ Cancel a transfer if it stalls or the lease is lost.
+
+        Parameters
+        ----------
+        transfer : Transfer
+        cancel : callable
+            Called without arguments from another thread. Must make the
+            block raise.
+
+        Raises
+        ------
+        TransferStalledError
+        BackupError
+            If the lease was lost during the transfer.
+
+        """
+        transfer.on_stall(cancel)
+        try:
+            with self._cancel_on_lease_loss(cancel):
+                yield
+        except BaseException:
+            if transfer.stalled:
+                raise TransferStalledError(
+                    f'{transfer.s3_key} made no progress for '
+                    f'{transfer.stall_timeout} seconds.') from None
+            self._check_lease()
+            raise
+
+    def verify_backup(self, backup, structure='parse', rate_limiter=None):
+        """ Verify backup without restoring it.
+
+        The backup is downloaded and its size and SHA-256 digest are
+        compared to the values recorded at upload time. Backups uploaded by
+        older versions have no recorded digest and only the size is
+        compared.
+
+        Parameters
+        ----------
+        backup : Backup
+
+        structure : str, default: parse
+            `parse` checks that the stream starts with a begin record and
+            ends with an end record. `receive` additionally passes the
+            stream to `zfs receive --dryrun`. `none` skips the structure
+            check.
+
+        rate_limiter : RateLimiter, optional
+            Limits the download bandwidth.
+
+        Returns
+        -------
+        Verification
+
+        """
+        if structure not in ['none', 'parse', 'receive']:
+            raise ValueError('structure must be `none`, `parse` or '
+                             '`receive`')
+
+        backup_time = backup.backup_time
+        s3_key = backup.s3_key
+        self._logger.info(f'filesystem={self._filesystem} '
                           f'snapshot_name={backup_time} '
                           f's3_key={s3_key} '
-                          'msg="Finished incremental backup."')
+                          f'structure={structure} '
+                          'msg="Verifying backup."')
+
+        status = 'passed'
+        error = None
+        with self.trace_phase('verify', s3_key=s3_key, structure=structure):
+            process = None
+            if structure == 'receive':
+                # a full stream can't be received into an existing filesystem
+                # even with --dryrun
+                filesystem = backup.filesystem
+                if backup.backup_type == 'full':
+                    filesystem = f'{filesystem}/{VERIFY_FILESYSTEM}'
+                process = open_receive_check(filesystem, backup_time,
+                                             backup.recursive,
+                                             len(backup.snapshots) > 1)
+
+            verifier = SendStreamVerifier(process.stdin if process else None)
+            fileobj = verifier
+            if rate_limiter:
+                fileobj = ThrottledWriter(fileobj, rate_limiter)
+            transfer_config = TransferConfig(
+                max_concurrency=self._max_concurrency,
+                multipart_chunksize=self._min_part_size)
+
+            try:
+                self._download_fileobj(fileobj, s3_key, backup.backup_size,
+                                       backup_time, backup.filesystem,
+                                       transfer_config, process)
+                if structure != 'none':
+                    verifier.check_structure()
+                if backup.checksum and \
+                        verifier.hexdigest() != backup.checksum:
+                    raise ValueError('Checksum does not match.')
+                if backup.backup_size is not None and \
+                        verifier.size != int(backup.backup_size):
+                    raise ValueError(f'Size {verifier.size} does not match '
+                                     f'backup size {backup.backup_size}.')
+            except (ClientError, ValueError) as e:
+                status = 'failed'
+                error = str(e)
+            except BrokenPipeError:
+                # zfs receive exited early. Its error is recorded below.
+                status = 'failed'
+            except (BotoCoreError, TransferStalledError) as e:
+                status = 'error'
+                error = str(e)
+
+            if process is not None:
+                if status == 'error':
+                    process.kill()
+                try:
+                    # flush buffered end of the stream to zfs receive
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                stderr = process.stderr.read().decode('utf-8')
+                if process.wait() and status != 'error':
+                    status = 'failed'
+                    error = error or stderr.strip()
+
+        verification = Verification(backup_time, backup.filesystem,
+                                    datetime.now().strftime(DATETIME_FORMAT),
+                                    status, structure, verifier.size,
+                                    verifier.hexdigest(), error)
+
+        if status == 'passed':
+            self._logger.info(f'filesystem={self._filesystem} '
+                              f'snapshot_name={backup_time} '
+                              f's3_key={s3_key} '
+                              'msg="Backup verified."')
+        else:
+            self._logger.error(f'filesystem={self._filesystem} '
+                               f'snapshot_name={backup_time} '
+                               f's3_key={s3_key} '
+                               f'status={status} '
+                               'msg="Backup verification failed." '
+                               f'error="{error}"')
+
+        return verification
+
+    def _download_fileobj(self, fileobj, s3_key, backup_size, backup_time,
+                          filesystem, transfer_config, process=None):
+        """ Download S3 object to file object.
+
+        Parameters
+        ----------
+        fileobj : file
+            Writable file object.
+        s3_key : str
+            Backup S3 key.
+        backup_size : int
+            Backup size in bytes.
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+        filesystem : str
+            File system that is restored to.
+        transfer_config : TransferConfig
+        process : subprocess.Popen, optional
+            `zfs receive` process reading the file object. Killed if the
+            download stalls.
 
-    def _restore_snapshot(self, backup, filesystem=None):
+        Raises
+        ------
+        TransferStalledError
+
+        """
+        with PROGRESS.track(filesystem, backup_time, s3_key, backup_size,
+                            'restore',
+                            stall_timeout=self._stall_timeout) as transfer, \
+                create_transfer_manager(self._s3.meta.client,
+                                        transfer_config) as manager:
+            future = manager.download(
+                self._bucket_name, s3_key, fileobj,
+                subscribers=[ProgressCallbackInvoker(transfer.callback)])
+            self._wait_for_transfer(future, transfer, process)
+
+    def _restore_snapshot(self, backup, filesystem=None, mount=True,
+                          rate_limiter=None):
         """ Restore snapshot from backup.
 
         Parameters
@@ -449,60 +1503,267 @@ class ZFSjob:
         filesystem : str, optional
             File system to restore to. Defaults to the file system that the
             backup was taken from.
+
+        mount : bool, default: True
+            Mount the received filesystems.
+
+        rate_limiter : RateLimiter, optional
+            Limits the download bandwidth.
+
+        The backup is downloaded into the spool first if a spool is
+        configured and has enough space. The download survives restarts and
+        a failed `zfs receive` is retried from the downloaded file.
         """
         backup_time = backup.backup_time
         backup_size = backup.backup_size
         filesystem = filesystem or backup.filesystem
         s3_key = backup.s3_key
 
-        transfer_config = TransferConfig(max_concurrency=S3_MAX_CONCURRENCY)
-
         self._logger.info(f'filesystem={filesystem} '
                           f'snapshot_name={backup_time} '
                           f's3_key={s3_key} '
+                          f'send_profile={backup.send_profile} '
                           'msg="Restoring snapshot."')
-        backup_object = self._s3.Object(self._bucket_name, s3_key)
 
-        with open_snapshot_stream(filesystem, backup_time, 'w') as f:
-            transfer_callback = TransferCallback(self._logger, backup_size,
-                                                 filesystem, backup_time,
-                                                 s3_key)
-            try:
-                backup_object.download_fileobj(
-                    f.stdin,
-                    Callback=transfer_callback.callback,
-                    Config=transfer_config)
-            except BrokenPipeError:
-                pass
-            stderr = f.stderr.read().decode('utf-8')
+        # a partially received stream blocks receiving into the filesystem
+        if get_receive_resume_token(filesystem):
+            self._logger.warning(f'filesystem={filesystem} '
+                                 'msg="Discarding partially received '
+                                 'stream."')
+            out = abort_receive(filesystem)
+            if out.returncode:
+                raise ZFSError(out.stderr)
+
+        with self.trace_phase('restore', s3_key=s3_key):
+            download_file = None
+            if self._spool:
+                download_file = self._download_to_spool(backup, filesystem,
+                                                        rate_limiter)
+
+            with open_snapshot_stream(filesystem, backup_time, 'w',
+                                      backup.recursive, mount,
+                                      len(backup.snapshots) > 1) as f:
+                broken_pipe = False
+                try:
+                    if download_file is None:
+                        transfer_config = TransferConfig(
+                            max_concurrency=self._max_concurrency,
+                            multipart_chunksize=self._min_part_size)
+                        fileobj = f.stdin
+                        if rate_limiter:
+                            fileobj = ThrottledWriter(fileobj, rate_limiter)
+                        self._download_fileobj(fileobj, s3_key, backup_size,
+                                               backup_time, filesystem,
+                                               transfer_config, process=f)
+                    else:
+                        with open(download_file.path, 'rb') as spooled:
+                            shutil.copyfileobj(spooled, f.stdin,
+                                               SPOOL_CHUNK_SIZE)
+                    # flush buffered end of the stream to zfs receive
+                    f.stdin.close()
+                except BrokenPipeError:
+                    # zfs receive exited early. Its error is raised below.
+                    broken_pipe = True
+                stderr = f.stderr.read().decode('utf-8')
+
         if f.returncode:
             raise ZFSError(stderr)
+        if broken_pipe:
+            raise ZFSError('zfs receive exited before the end of the '
+                           'stream.')
 
+        if download_file:
+            download_file.remove()
         self._snapshot_db.refresh()
 
-    def _limit_snapshots(self):
+    def _download_to_spool(self, backup, filesystem, rate_limiter=None):
+        """ Download backup into the spool with parallel ranged GETs.
+
+        Parameters
+        ----------
+        backup : Backup
+
+        filesystem : str
+            File system that is restored to.
+
+        rate_limiter : RateLimiter, optional
+            Limits the download bandwidth.
+
+        Returns
+        -------
+        DownloadFile
+            None is returned if the spool does not have enough space.
+
+        Raises
+        ------
+        TransferStalledError
+
+        """
+        s3_key = backup.s3_key
+        response = self._s3.meta.client.head_object(
+            Bucket=self._bucket_name, Key=s3_key)
+        size = response['ContentLength']
+        part_size = max(self._min_part_size, -(-size // DOWNLOAD_MAX_PARTS))
+        metadata = {'s3_key': s3_key, 'size': size,
+                    'etag': response['ETag'], 'part_size': part_size}
+
+        download_file = self._spool.reserve_download(
+            backup.filesystem, s3_key.split('/')[-1], metadata)
+        if download_file is None:
+            self._logger.warning(f'filesystem={filesystem} '
+                                 f'snapshot_name={backup.backup_time} '
+                                 f's3_key={s3_key} '
+                                 'msg="Spool is full. Restoring directly from '
+                                 'S3."')
+            return None
+
+        missing_parts = download_file.missing_parts
+        if not missing_parts:
+            download_file.close()
+            return download_file
+
+        if download_file.downloaded:
+            self._logger.info(f'filesystem={filesystem} '
+                              f'snapshot_name={backup.backup_time} '
+                              f's3_key={s3_key} '
+                              f'downloaded={download_file.downloaded} '
+                              'msg="Resuming download from spool."')
+
+        cancelled = threading.Event()
+        remaining = size - download_file.downloaded
+        with PROGRESS.track(filesystem, backup.backup_time, s3_key,
+                            remaining, 'restore',
+                            stall_timeout=self._stall_timeout) as transfer, \
+                download_file, \
+                ThreadPoolExecutor(self._max_concurrency) as executor:
+            transfer.on_stall(cancelled.set)
+
+            def callback(amount):
+                transfer.callback(amount)
+                if rate_limiter:
+                    rate_limiter.acquire(amount)
+
+            futures = {executor.submit(self._download_part, download_file,
+                                       s3_key, metadata['etag'], start, end,
+                                       callback, cancelled): index
+                       for index, start, end in missing_parts}
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    download_file.complete_part(futures[future])
+            except Exception:
+                cancelled.set()
+                if transfer.stalled:
+                    raise TransferStalledError(
+                        f'{s3_key} made no progress for '
+                        f'{transfer.stall_timeout} seconds.') from None
+                raise
+
+        return download_file
+
+    def _download_part(self, download_file, s3_key, etag, start, end,
+                       callback, cancelled):
+        """ Download byte range into download file.
+
+        Reading the response body is not retried by botocore. The range is
+        requested again from the current offset with backoff and jitter.
+        """
+        offset = start
+        attempt = 0
+        while offset <= end:
+            try:
+                response = self._s3.meta.client.get_object(
+                    Bucket=self._bucket_name, Key=s3_key, IfMatch=etag,
+                    Range=f'bytes={offset}-{end}')
+                body = response['Body']
+                while offset <= end:
+                    if cancelled.is_set():
+                        raise RestoreError('Download cancelled.')
+                    data = body.read(SPOOL_CHUNK_SIZE)
+                    if not data:
+                        break
+                    download_file.write(offset, data)
+                    offset += len(data)
+                    callback(len(data))
+                if offset <= end:
+                    raise RestoreError(f'{s3_key} ended before byte {end}.')
+            except (BotoCoreError, RestoreError) as e:
+                attempt += 1
+                if cancelled.is_set() or attempt >= S3_MAX_ATTEMPTS:
+                    raise
+                self._logger.warning(f'filesystem={self._filesystem} '
+                                     f's3_key={s3_key} '
+                                     f'offset={offset} '
+                                     'msg="Retrying part download." '
+                                     f'error="{e}"')
+                time.sleep(random.uniform(0, min(2 ** attempt, 20)))
+
+    @contextmanager
+    def trace_phase(self, phase, **attributes):
+        """ Trace a job phase and observe its duration. """
+        with span(phase, filesystem=self._filesystem, **attributes) as s:
+            try:
+                yield s
+            finally:
+                PHASE_DURATION.observe(s.duration,
+                                       filesystem=self._filesystem,
+                                       phase=phase)
+
+    def _limit_snapshots(self, dry_run=False):
         """ Limit number of snapshots.
 
         We only remove snapshots that were used for incremental backups.
         Keeping snapshots that were used for full backups allow us to
         restore without having to download the full backup.
+
+        Parameters
+        ----------
+        dry_run : bool, default: False
+            Only compute which snapshots would be deleted.
+
+        Returns
+        -------
+        RetentionPlan
+
         """
-        backup_times_full = self._backup_db.get_backup_times('full')
-        results = self._snapshot_db.get_snapshots()
+        names = [snapshot.name for snapshot in
+                 self._snapshot_db.get_snapshots()]
 
-        if len(results) > self._max_snapshots:
+        # only the oldest snapshots above the limit can be deleted so only
+        # the shards of their backups are downloaded
+        excess = max(len(names) - self._max_snapshots, 0)
+        protected = [b.backup_time for b in self._backup_db.get_backups(
+            'full', months={name[:6] for name in names[:excess]})]
+
+        # keep the source snapshot of the next incremental backup
+        if self._send_intermediate:
+            latest = self._backup_db.get_latest_backup()
+            if latest:
+                protected.append(latest.backup_time)
+
+        plan = plan_snapshots(names, self._max_snapshots, protected)
+
+        if plan.delete:
             self._logger.info(f'filesystem={self._filesystem} '
                               'msg="Snapshot limit achieved."')
+        if dry_run:
+            return plan
+
+        for name in plan.delete:
+            self._logger.info(f'filesystem={self._filesystem} '
+                              f'snapshot_name={name} '
+                              'msg="Deleting snapshot."')
 
-        while len(results) > self._max_snapshots:
-            snapshot = results.pop(0)
-            backup_time = snapshot.name
+        # destroy all snapshots with one backend call, falling back to one
+        # call per snapshot so a held or busy snapshot doesn't keep the rest
+        try:
+            self._snapshot_db.delete_snapshots(plan.delete)
+        except ZFSError as e:
+            self._logger.warning(f'filesystem={self._filesystem} '
+                                 'msg="Unable to delete some snapshots." '
+                                 f'error="{str(e).strip()}"')
 
-            if backup_time not in backup_times_full:
-                self._logger.info(f'filesystem={self._filesystem} '
-                                  f'snapshot_name={snapshot.name} '
-                                  'msg="Deleting snapshot."')
-                self._snapshot_db.delete_snapshot(snapshot.name)
+        return plan
 
     def _check_backup(self, s3_key):
         """ Check if S3 object exists and returns object size.
@@ -524,106 +1785,402 @@ class ZFSjob:
 
         return backup_object.content_length
 
-    def _delete_backup(self, backup):
-        """ Delete backup.
+    def _delete_backups(self, backups, interrupt=None):
+        """ Delete backups with bulk S3 requests.
+
+        Backup records are only removed if their S3 object was deleted.
 
         Parameters
         ----------
-        backup : Backup
+        backups : list(Backup)
 
-        """
-        backup_time = backup.backup_time
-        s3_key = backup.s3_key
+        interrupt : callable, optional
+            Checked between bulk requests. Stops deleting if it returns
+            True.
 
-        self._logger.info(f's3_key={s3_key} '
-                          'msg="Deleting backup."')
-        backup_object = self._s3.Object(self._bucket_name, s3_key)
-        backup_object.delete()
-        self._backup_db.delete_backup(backup_time)
-
-    def _limit_backups(self):
-        """ Limit number of incremental and full backups.
-
-        Only backups with no dependants are removed.
         """
-        backups = self._backup_db.get_backups()
+        deleted = []
+        for i in range(0, len(backups), S3_MAX_DELETE_KEYS):
+            if interrupt and interrupt():
+                break
 
-        if len(backups) > self._max_backups:
-            self._logger.info(f'filesystem={self._filesystem} '
-                              'msg="Backup limit achieved."')
+            batch = {b.s3_key: b for b in backups[i:i + S3_MAX_DELETE_KEYS]}
+            for s3_key in batch:
+                self._logger.info(f's3_key={s3_key} '
+                                  'msg="Deleting backup."')
 
-        count = 0
-        while len(backups) > self._max_backups:
-            backup = backups[count]
-            backup_time = backup.backup_time
-            backup_type = backup.backup_type
-            s3_key = backup.s3_key
-
-            if backup_type == "inc":
-                self._delete_backup(backup)
-                backups.pop(count)
-
-            elif backup_type == "full":
-                dependants = any([True if b.dependency == backup_time
-                                  else False for b in backups])
-                if dependants:
-                    self._logger.info(f's3_key={s3_key} '
-                                      'msg="Backup has dependants. Not '
-                                      'deleting."')
-                else:
-                    self._delete_backup(backup)
-                    backups.pop(count)
+            response = self._bucket.delete_objects(Delete={
+                'Objects': [{'Key': s3_key} for s3_key in batch],
+                'Quiet': True
+            })
 
-            count += 1
+            failed = set()
+            for error in response.get('Errors', []):
+                failed.add(error['Key'])
+                self._logger.warning(f's3_key={error["Key"]} '
+                                     'msg="Unable to delete backup." '
+                                     f'error="{error.get("Message")}"')
 
+            deleted.extend(b.backup_time for s3_key, b in batch.items()
+                           if s3_key not in failed)
 
-class TransferCallback:
-    def __init__(self, logger, file_size, filesystem, backup_time, s3_key):
-        self._logger = logger
-        self._file_size = file_size
-        self._filesystem = filesystem
-        self._backup_time = backup_time
-        self._s3_key = s3_key
-
-        self._transfer_0 = 0
-        self._transfer_buffer = 0
-        self._time_0 = time.time()
-        self._time_start = time.time()
+        if deleted:
+            self._backup_db.delete_backups(deleted)
 
-    def callback(self, transfer):
-        time_1 = time.time()
-        time_diff = time_1 - self._time_0
-        time_elapsed = time_1 - self._time_start
+    def _limit_backups(self, dry_run=False, interrupt=None):
+        """ Apply backup retention policy.
 
-        self._transfer_buffer += transfer
+        Backups needed for restoring a kept backup are never removed. If
+        intermediate snapshots are sent the most recent chain of backups is
+        kept since the next incremental backup is sent from its last backup.
 
-        if time_diff > 5:
-            transfer_1 = self._transfer_0 + self._transfer_buffer
-
-            progress = transfer_1 / self._file_size
-            speed = self._transfer_buffer / time_diff
-
-            self._logger.info(
-                f'filesystem={self._filesystem} '
-                f'snapshot_name={self._backup_time} '
-                f's3_key={self._s3_key} '
-                f'progress={round(progress * 100)}% '
-                f'speed="{round(speed / MB)} MBps" '
-                f'transferred="{round(transfer_1 / MB)}/'
-                f'{round(self._file_size / MB)} MB" '
-                f'time_elapsed={round(time_elapsed / 60)}m'
-            )
+        Parameters
+        ----------
+        dry_run : bool, default: False
+            Only compute which backups would be deleted.
+        interrupt : callable, optional
+            Checked between bulk deletions. Stops deleting if it returns
+            True.
 
-            self._transfer_0 = transfer_1
-            self._transfer_buffer = 0
-            self._time_0 = time_1
+        Returns
+        -------
+        RetentionPlan
 
+        """
+        protected = []
+        if self._send_intermediate:
+            latest = self._backup_db.get_latest_backup()
+            if latest:
+                protected = [b.backup_time for b in
+                             self._backup_db.get_chain(latest.backup_time)]
+
+        # a dry run lists every backup with the reasons for keeping it
+        shards = None if dry_run else self._backup_db.get_shards()
+        if shards is None:
+            plan = plan_backups(self._backup_db.get_backups(),
+                                self.retention_policy, protected)
+        else:
+            plan = plan_sharded_backups(
+                shards, lambda months: self._backup_db.get_backups(
+                    months=months), self.retention_policy, protected)
 
-def _get_transfer_config(send_size, max_multipart_parts):
+        if plan.delete:
+            self._logger.info(f'filesystem={self._filesystem} '
+                              'msg="Backup limit achieved."')
+        if dry_run:
+            return plan
+
+        self._delete_backups([self._backup_db.get_backup(backup_time)
+                              for backup_time in plan.delete], interrupt)
+
+        return plan
+
+
+def start_jobs(jobs, max_workers=None, scheduled_time=None,
+               maintenance=None):
+    """ Start ZFS backup jobs that share a schedule.
+
+    Snapshots for all jobs are created atomically with one `zfs snapshot`
+    call. The uploads then run in parallel.
+
+    Parameters
+    ----------
+    jobs : list(ZFSjob)
+    max_workers : int, optional
+        Maximum number of jobs running in parallel.
+    scheduled_time : float, optional
+        Unix time the jobs were scheduled to start at. Used for measuring
+        the queue wait. Defaults to now.
+    maintenance : MaintenanceQueue, optional
+        Queue that retention and verification are deferred to.
+
+    """
+    logger = logging.getLogger(__name__)
+    scheduled_time = scheduled_time or time.time()
+
+    # filesystems leased by other nodes are neither snapshotted nor backed up
+    errors = []
+    leased = []
+    for job in jobs:
+        try:
+            if job.acquire_lease():
+                leased.append(job)
+        except (BotoCoreError, ClientError) as e:
+            JOB_FAILURES.inc(filesystem=job.filesystem)
+            logger.error(f'filesystem={job.filesystem} '
+                         f'msg="Failed to acquire lease." error="{e}"')
+            errors.append(e)
+
+    jobs = leased
+    if not jobs:
+        if errors:
+            raise errors[0]
+        return
+
+    filesystems = [job.filesystem for job in jobs]
+    with span('snapshot', filesystems=filesystems) as s:
+        snapshots = create_snapshots([job.snapshot_db for job in jobs])
+    for filesystem in filesystems:
+        PHASE_DURATION.observe(s.duration, filesystem=filesystem,
+                               phase='snapshot')
+
+    def start_job(job):
+        QUEUE_WAIT.observe(max(time.time() - scheduled_time, 0),
+                           filesystem=job.filesystem)
+        job.start(snapshots[job.filesystem], maintenance)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {job.filesystem: executor.submit(start_job, job)
+                   for job in jobs}
+
+    for filesystem, future in futures.items():
+        error = future.exception()
+        if error:
+            logger.error(f'filesystem={filesystem} '
+                         f'msg="Job failed." error="{error}"')
+            errors.append(error)
+
+    if errors:
+        raise errors[0]
+
+
+def restore_jobs(jobs, backup_time=None, max_workers=None,
+                 rate_limiter=None, pool_limit=None, order='priority'):
+    """ Restore many filesystems in parallel.
+
+    Filesystems are restored in place to the most recent backup or snapshot
+    at or before backup_time. Filesystems without such a backup are
+    skipped.
+
+    Parameters
+    ----------
+    jobs : list(ZFSjob)
+    backup_time : str, optional
+        Point in time in %Y%m%d_%H%M%S format. Defaults to the most recent
+        backup.
+    max_workers : int, optional
+        Maximum number of filesystems restored in parallel.
+    rate_limiter : RateLimiter, optional
+        Global download bandwidth limit shared by all restores.
+    pool_limit : int, optional
+        Maximum number of filesystems restored in parallel per pool.
+    order : str, default: priority
+        `priority` restores jobs by descending `restore_priority` and then
+        smallest first. `smallest` restores the smallest restores first.
+
+    Returns
+    -------
+    list(str)
+        Restored filesystems.
+
+    """
+    logger = logging.getLogger(__name__)
+
+    restores = []
+    for job in jobs:
+        name = job.backup_db.get_restore_point(backup_time)
+        if name is None:
+            logger.warning(f'filesystem={job.filesystem} '
+                           'msg="No backup to restore. Skipping."')
+            continue
+        restores.append((job, name, job.backup_db.get_restore_size(name)))
+
+    if order == 'smallest':
+        restores.sort(key=lambda r: r[2])
+    elif order == 'priority':
+        restores.sort(key=lambda r: (-r[0].restore_priority, r[2]))
+    else:
+        raise ValueError('order must be `priority` or `smallest`')
+
+    def restore_job(job, name):
+        logger.info(f'filesystem={job.filesystem} '
+                    f'snapshot_name={name} '
+                    'msg="Starting restore."')
+        job.restore(name, rate_limiter=rate_limiter)
+        logger.info(f'filesystem={job.filesystem} '
+                    f'snapshot_name={name} '
+                    'msg="Finished restore."')
+
+    futures = _run_by_pool([(job, name) for job, name, _ in restores],
+                           restore_job, max_workers, pool_limit)
+
+    errors = []
+    for filesystem, future in futures.items():
+        error = future.exception()
+        if error:
+            logger.error(f'filesystem={filesystem} '
+                         f'msg="Restore failed." error="{error}"')
+            errors.append(error)
+
+    if errors:
+        raise errors[0]
+
+    return list(futures)
+
+
+def verify_jobs(jobs, backup_time=None, max_workers=None,
+                rate_limiter=None, structure='parse'):
+    """ Verify backups of many filesystems in parallel.
+
+    Results are recorded in the `backup.db` of each filesystem.
+
+    Parameters
+    ----------
+    jobs : list(ZFSjob)
+    backup_time : str, optional
+        Only verify the backups needed for restoring the most recent backup
+        or snapshot at or before this time. All backups are verified if not
+        set.
+    max_workers : int, optional
+        Maximum number of backups verified in parallel.
+    rate_limiter : RateLimiter, optional
+        Global download bandwidth limit shared by all verifications.
+    structure : str, default: parse
+        Structure check. Supported checks are `none`, `parse` and `receive`.
+
+    Returns
+    -------
+    list(Verification)
+
+    """
+    logger = logging.getLogger(__name__)
+
+    tasks = []
+    for job in jobs:
+        backups = job.backup_db.get_backups()
+        if backup_time is not None:
+            name = job.backup_db.get_restore_point(backup_time)
+            if name is None:
+                backups = []
+            else:
+                backup = job.backup_db.get_backup_containing(name)
+                backups = job.backup_db.get_chain(backup.backup_time)
+
+        if not backups:
+            logger.warning(f'filesystem={job.filesystem} '
+                           'msg="No backup to verify. Skipping."')
+        tasks.extend((index, job, backup)
+                     for index, backup in enumerate(backups))
+
+    # interleave filesystems so that all of them are verified concurrently
+    tasks.sort(key=lambda t: t[0])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(job, backup, executor.submit(job.verify_backup, backup,
+                                                 structure, rate_limiter))
+                   for _, job, backup in tasks]
+
+    verifications = []
+    errors = []
+    results = {}
+    for job, backup, future in futures:
+        error = future.exception()
+        if error:
+            logger.error(f'filesystem={job.filesystem} '
+                         f'snapshot_name={backup.backup_time} '
+                         f'msg="Verification failed." error="{error}"')
+            errors.append(error)
+            continue
+        verifications.append(future.result())
+        results.setdefault(job, []).append(future.result())
+
+    for job, job_verifications in results.items():
+        job.backup_db.set_verifications(job_verifications)
+
+    if errors:
+        raise errors[0]
+
+    return verifications
+
+
+def _get_transfer_config(send_size, max_multipart_parts,
+                         max_concurrency=S3_MAX_CONCURRENCY,
+                         min_part_size=S3_MIN_PART_SIZE):
     """ Get transfer config. """
     # should never get close to the max part number
     chunk_size = send_size // (max_multipart_parts - 100)
-    # only set chunk size if greater than default value
-    chunk_size = chunk_size if chunk_size > 8 * MB else 8 * MB
-    return TransferConfig(max_concurrency=S3_MAX_CONCURRENCY,
+    # only set chunk size if greater than the minimum part size
+    chunk_size = chunk_size if chunk_size > min_part_size else min_part_size
+    return TransferConfig(max_concurrency=max_concurrency,
                           multipart_chunksize=chunk_size)
+
+
+def _check_send_profiles(chain):
+    """ Check that `zfs receive` accepts the streams of a backup chain.
+
+    Raises
+    ------
+    RestoreError
+        If a backup was sent with an unknown send profile or its profile
+        doesn't match the backup it depends on.
+
+    """
+    for backup in chain:
+        if backup.send_profile not in SEND_PROFILES:
+            raise RestoreError(f'{backup.s3_key} was sent with the unknown '
+                               f'send profile {backup.send_profile}.')
+
+    for base, backup in zip(chain, chain[1:]):
+        if not is_send_profile_compatible(backup.send_profile,
+                                          base.send_profile):
+            raise RestoreError(f'{backup.s3_key} was sent with send profile '
+                               f'{backup.send_profile} which can not be '
+                               f'received on top of {base.send_profile}.')
+
+
+def _run_by_pool(items, fn, max_workers=None, pool_limit=None):
+    """ Run jobs in order with a limit per pool.
+
+    A job is only handed to a worker once its pool is below the limit, so
+    jobs waiting for a busy pool never hold workers that jobs of other pools
+    could use.
+
+    Parameters
+    ----------
+    items : list(tuple)
+        Arguments of fn. The first argument is the job.
+    fn : callable
+    max_workers : int, optional
+        Maximum number of jobs run in parallel.
+    pool_limit : int, optional
+        Maximum number of jobs run in parallel per pool.
+
+    Returns
+    -------
+    dict
+        Futures keyed by filesystem in the order of items.
+
+    """
+    # same default as ThreadPoolExecutor
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    pending = list(items)
+    running = {}
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            pools = [running[future] for future in running]
+            for item in list(pending):
+                if len(running) >= max_workers:
+                    break
+                pool = item[0].filesystem.split('/')[0]
+                if pool_limit and pools.count(pool) >= pool_limit:
+                    continue
+
+                pending.remove(item)
+                future = executor.submit(fn, *item)
+                running[future] = pool
+                pools.append(pool)
+                futures[item[0].filesystem] = future
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+
+    return {item[0].filesystem: futures[item[0].filesystem]
+            for item in items}
+
+
+def _get_filesystem_lock(filesystem):
+    with _filesystem_locks_lock:
+        return _filesystem_locks.setdefault(filesystem, threading.Lock())
@@ -0,0 +1,205 @@
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from zfs_uploader.utils import derive_s3_key, is_write_conflict
+
+LEASE_FILE = 'lease.json'
+LEASE_DURATION = 900
+
+
+class Lease:
+    """ Lease on the backups of a filesystem.
+
+    The lease is an object next to `backup.db` that names the node holding
+    it and the time it expires at. It is written with conditional writes so
+    that only one node holds it at a time. An expired lease is taken over by
+    the first node that acquires it. Nodes need synchronized clocks.
+    """
+
+    @property
+    def filesystem(self):
+        """ ZFS filesystem. """
+        return self._filesystem
+
+    @property
+    def node_id(self):
+        """ Name of this node. """
+        return self._node_id
+
+    @property
+    def duration(self):
+        """ Seconds the lease is valid for after it was written. """
+        return self._duration
+
+    @property
+    def holder(self):
+        """ Node holding the lease when it was last read or written. """
+        return self._holder
+
+    @property
+    def held(self):
+        """ True if this node holds an unexpired lease. """
+        with self._lock:
+            return (self._etag is not None and
+                    self._expires > time.time())
+
+    def __init__(self, bucket, filesystem, node_id, s3_prefix=None,
+                 duration=None):
+        """ Create Lease object.
+
+        Parameters
+        ----------
+        bucket : Bucket
+            S3 Bucket.
+        filesystem : str
+            ZFS filesystem.
+        node_id : str
+            Name of this node. Must be unique among the nodes sharing the
+            bucket.
+        s3_prefix : str, optional
+            The s3 prefix to prepend to the lease file.
+        duration : int, default: 900
+            Seconds the lease is valid for after it was written.
+
+        """
+        self._filesystem = filesystem
+        self._node_id = node_id
+        self._duration = duration or LEASE_DURATION
+        self._logger = logging.getLogger(__name__)
+
+        self._holder = None
+        self._etag = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+        s3_key = derive_s3_key(LEASE_FILE, filesystem, s3_prefix)
+        self._s3_object = bucket.Object(s3_key)
+
+    def acquire(self):
+        """ Acquire or renew the lease.
+
+        No request is made if this node holds the lease for more than half
+        of its duration.
+
+        Returns
+        -------
+        bool
+            False if another node holds an unexpired lease.
+
+        """
+        with self._lock:
+            now = time.time()
+            if self._etag is not None and \
+                    self._expires - now > self._duration / 2:
+                return True
+
+            try:
+                response = self._s3_object.get()
+                etag = response['ETag']
+                lease = json.loads(response['Body'].read())
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+                etag = None
+                lease = None
+
+            if lease and lease['node_id'] != self._node_id and \
+                    lease['expires'] > now:
+                self._holder = lease['node_id']
+                self._etag = None
+                return False
+
+            if lease and lease['node_id'] != self._node_id:
+                self._logger.info(f'filesystem={self._filesystem} '
+                                  f'holder={lease["node_id"]} '
+                                  'msg="Taking over expired lease."')
+
+            return self._write(etag, now + self._duration)
+
+    def renew(self):
+        """ Renew the lease held by this node.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost to another node.
+
+        """
+        with self._lock:
+            if self._etag is None:
+                return False
+            return self._write(self._etag, time.time() + self._duration)
+
+    def release(self):
+        """ Let other nodes acquire the lease right away. """
+        with self._lock:
+            if self._etag is not None:
+                self._write(self._etag, 0)
+                self._etag = None
+
+    @contextmanager
+    def hold(self, on_lost=None):
+        """ Renew the lease in the background while the block runs.
+
+        Parameters
+        ----------
+        on_lost : callable, optional
+            Called without arguments from the renew thread if the lease was
+            lost to another node.
+
+        """
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(self._duration / 3):
+                try:
+                    if not self.renew():
+                        self._logger.warning(
+                            f'filesystem={self._filesystem} '
+                            'msg="Lost lease."')
+                        if on_lost is not None:
+                            on_lost()
+                        return
+                except Exception as e:
+                    self._logger.warning(f'filesystem={self._filesystem} '
+                                         'msg="Failed to renew lease." '
+                                         f'error="{e}"')
+
+        thread = threading.Thread(target=renew, name='lease', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def _write(self, etag, expires):
+        """ Write the lease if the object still has the given ETag.
+
+        The object must not exist if etag is None.
+        """
+        body = json.dumps({'node_id': self._node_id, 'expires': expires})
+        if etag is None:
+            kwargs = {'IfNoneMatch': '*'}
+        else:
+            kwargs = {'IfMatch': etag}
+
+        try:
+            response = self._s3_object.put(Body=body.encode('utf-8'),
+                                           **kwargs)
+        except ClientError as e:
+            if not is_write_conflict(e):
+                raise
+            self._holder = None
+            self._etag = None
+            return False
+
+        self._holder = self._node_id
+        self._etag = response['ETag']
+        self._expires = expires
+        return True
@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+
+from zfs_uploader.metrics import MAINTENANCE_COALESCED
+
+# niceness added to maintenance threads and their subprocesses
+MAINTENANCE_NICENESS = 10
+
+_thread_state = threading.local()
+
+
+class MaintenanceQueue:
+    """ Low priority executor for deferred maintenance tasks.
+
+    Requests are coalesced per task and filesystem. A request that is
+    submitted while an older request of the same task and filesystem is
+    still waiting replaces it, so only the latest request runs. A request
+    that is submitted while the task is running runs once it finished.
+    """
+
+    @property
+    def max_workers(self):
+        """ Maximum number of tasks running in parallel. """
+        return self._max_workers
+
+    def __init__(self, max_workers=1):
+        """ Create MaintenanceQueue object.
+
+        Parameters
+        ----------
+        max_workers : int, default: 1
+            Maximum number of tasks running in parallel.
+
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than or '
+                             'equal to 1.')
+
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='maintenance')
+        self._logger = logging.getLogger(__name__)
+
+        self._pending = {}
+        self._running = set()
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def submit(self, task, fn, filesystem=None):
+        """ Request a maintenance task.
+
+        Parameters
+        ----------
+        task : str
+            Task name. Requests are coalesced by task and filesystem.
+        fn : callable
+            Called without arguments. Exceptions are logged.
+        filesystem : str, optional
+            ZFS filesystem the task belongs to.
+
+        Returns
+        -------
+        bool
+            False if the request replaced a waiting request.
+
+        """
+        key = (task, filesystem)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Maintenance queue is shut down.')
+
+            coalesced = key in self._pending
+            self._pending[key] = fn
+            if not coalesced and key not in self._running:
+                self._running.add(key)
+                self._executor.submit(self._run, key)
+
+        if coalesced:
+            MAINTENANCE_COALESCED.inc(task=task)
+            self._logger.info(f'filesystem={filesystem} task={task} '
+                              'msg="Coalescing maintenance request."')
+        return not coalesced
+
+    def shutdown(self, wait=True):
+        """ Stop accepting requests.
+
+        Waiting requests still run.
+
+        Parameters
+        ----------
+        wait : bool, default: True
+            Wait for all requests to finish.
+
+        """
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, key):
+        task, filesystem = key
+        _lower_priority()
+
+        while True:
+            with self._lock:
+                fn = self._pending.pop(key, None)
+                if fn is None:
+                    self._running.discard(key)
+                    return
+
+            self._logger.info(f'filesystem={filesystem} task={task} '
+                              'msg="Running maintenance task."')
+            try:
+                fn()
+            except Exception as e:
+                self._logger.error(f'filesystem={filesystem} task={task} '
+                                   'msg="Maintenance task failed." '
+                                   f'error="{e}"')
+
+
+def _lower_priority():
+    """ Lower the scheduling priority of the calling thread.
+
+    On Linux the niceness is per thread and inherited by subprocesses.
+    Ignored where thread ids or priorities are not supported.
+    """
+    if getattr(_thread_state, 'lowered', False):
+        return
+    _thread_state.lowered = True
+
+    try:
+        thread_id = threading.get_native_id()
+        priority = os.getpriority(os.PRIO_PROCESS, thread_id)
+        os.setpriority(os.PRIO_PROCESS, thread_id,
+                       priority + MAINTENANCE_NICENESS)
+    except (AttributeError, OSError):
+        pass
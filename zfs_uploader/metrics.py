@@ -0,0 +1,364 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import math
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400,
+                    43200, 86400)
+
+
+class Registry:
+    """ Collection of metrics exposed by the metrics endpoint. """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """ Register metric. """
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """ Render metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    _type = None
+
+    @property
+    def name(self):
+        """ Metric name. """
+        return self._name
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        """ Create metric.
+
+        Parameters
+        ----------
+        name : str
+            Metric name.
+        documentation : str
+            Help text.
+        labelnames : tuple(str), optional
+            Label names.
+        registry : Registry, optional
+            Registry the metric is exposed by. Defaults to the global
+            registry.
+
+        """
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        if registry is not None:
+            registry.register(self)
+
+    def get(self, **labels):
+        """ Get current value of a labeled series. """
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        """ Get metric lines in the Prometheus text exposition format. """
+        lines = [f'# HELP {self._name} {self._documentation}',
+                 f'# TYPE {self._name} {self._type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self._name}{self._format_labels(key)} '
+                             f'{_format_value(value)}')
+        return lines
+
+    def _key(self, labels):
+        if set(labels) != set(self._labelnames):
+            raise ValueError(f'{self._name} expects labels '
+                             f'{self._labelnames}.')
+        return tuple(str(labels[name]) for name in self._labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self._labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        labels = ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs)
+        return f'{{{labels}}}'
+
+
+class Counter(_Metric):
+    """ Monotonically increasing metric. """
+    _type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """ Increment counter. """
+        if amount < 0:
+            raise ValueError('Counters can only be incremented.')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """ Metric that can go up and down. """
+    _type = 'gauge'
+
+    def set(self, value, **labels):
+        """ Set gauge. """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """ Increment gauge. """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """ Decrement gauge. """
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """ Metric that counts observations in cumulative buckets. """
+    _type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DURATION_BUCKETS, registry=REGISTRY):
+        """ Create histogram.
+
+        Parameters
+        ----------
+        name : str
+            Metric name.
+        documentation : str
+            Help text.
+        labelnames : tuple(str), optional
+            Label names.
+        buckets : tuple(float), optional
+            Upper bounds of the buckets. Defaults to durations between one
+            second and one day.
+        registry : Registry, optional
+            Registry the metric is exposed by. Defaults to the global
+            registry.
+
+        """
+        super().__init__(name, documentation, labelnames, registry)
+        self._buckets = tuple(sorted(buckets))
+        if self._buckets[-1] != math.inf:
+            self._buckets += (math.inf,)
+
+    def observe(self, value, **labels):
+        """ Observe value. """
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {
+                    'buckets': [0] * len(self._buckets),
+                    'count': 0,
+                    'sum': 0.0
+                }
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['count'] += 1
+            series['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe the duration of the enclosed block in seconds. """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def get(self, **labels):
+        """ Get number of observations of a labeled series. """
+        with self._lock:
+            series = self._values.get(self._key(labels))
+            return series['count'] if series else 0
+
+    def collect(self):
+        lines = [f'# HELP {self._name} {self._documentation}',
+                 f'# TYPE {self._name} {self._type}']
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                for bound, count in zip(self._buckets, series['buckets']):
+                    le = (('le', _format_value(bound)),)
+                    lines.append(f'{self._name}_bucket'
+                                 f'{self._format_labels(key, le)} {count}')
+                labels = self._format_labels(key)
+                lines.append(f'{self._name}_count{labels} {series["count"]}')
+                lines.append(f'{self._name}_sum{labels} '
+                             f'{_format_value(series["sum"])}')
+        return lines
+
+
+BYTES_SENT = Counter(
+    'zfsup_bytes_sent_total',
+    'Bytes uploaded to S3.',
+    ['filesystem'])
+BYTES_RECEIVED = Counter(
+    'zfsup_bytes_received_total',
+    'Bytes downloaded from S3.',
+    ['filesystem'])
+THROUGHPUT = Gauge(
+    'zfsup_throughput_bytes_per_second',
+    'Transfer speed of the most recent transfer.',
+    ['filesystem'])
+PHASE_DURATION = Histogram(
+    'zfsup_phase_duration_seconds',
+    'Duration of backup job phases.',
+    ['filesystem', 'phase'])
+QUEUE_WAIT = Histogram(
+    'zfsup_queue_wait_seconds',
+    'Time between the scheduled start and the actual start of a job.',
+    ['filesystem'])
+LAST_SUCCESS = Gauge(
+    'zfsup_last_success_timestamp_seconds',
+    'Unix time of the last successful backup job.',
+    ['filesystem'])
+JOB_FAILURES = Counter(
+    'zfsup_job_failures_total',
+    'Number of failed backup jobs.',
+    ['filesystem'])
+PARTS_IN_FLIGHT = Gauge(
+    'zfsup_parts_in_flight',
+    'Number of S3 part uploads and downloads in progress.',
+    ['filesystem'])
+BUFFER_FILL = Gauge(
+    'zfsup_buffer_fill_ratio',
+    'Fraction of the send stream ring buffer waiting to be uploaded.',
+    ['filesystem'])
+RETRIES = Counter(
+    'zfsup_s3_retries_total',
+    'Number of retried S3 requests.',
+    ['filesystem', 'operation'])
+BACKUP_DB_SIZE = Gauge(
+    'zfsup_backup_db_size_bytes',
+    'Size of backup.db in bytes.',
+    ['filesystem'])
+STALLS = Counter(
+    'zfsup_transfer_stalls_total',
+    'Number of transfers cancelled for making no progress.',
+    ['filesystem'])
+ENDPOINT_HEALTHY = Gauge(
+    'zfsup_endpoint_healthy',
+    'Whether an S3 endpoint is used for part transfers.',
+    ['endpoint'])
+MAINTENANCE_COALESCED = Counter(
+    'zfsup_maintenance_coalesced_total',
+    'Number of maintenance requests replaced by a newer request.',
+    ['task'])
+
+_TRANSFER_OPERATIONS = ('PutObject', 'UploadPart', 'GetObject')
+
+
+def instrument_client(client, filesystem):
+    """ Count in-flight parts and retries of an S3 client.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        S3 client.
+    filesystem : str
+        ZFS filesystem used as metric label.
+
+    """
+    def before_call(**kwargs):
+        PARTS_IN_FLIGHT.inc(filesystem=filesystem)
+
+    def after_call(**kwargs):
+        PARTS_IN_FLIGHT.dec(filesystem=filesystem)
+
+    def request_created(request, operation_name, **kwargs):
+        # the retries context is updated before each attempt is created
+        attempt = request.context.get('retries', {}).get('attempt', 1)
+        if attempt > 1:
+            RETRIES.inc(filesystem=filesystem, operation=operation_name)
+
+    events = client.meta.events
+    for operation in _TRANSFER_OPERATIONS:
+        events.register(f'before-call.s3.{operation}', before_call)
+        events.register(f'after-call.s3.{operation}', after_call)
+        events.register(f'after-call-error.s3.{operation}', after_call)
+    events.register('request-created.s3', request_created)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, addr=''):
+    """ Serve metrics at `/metrics` from a daemon thread.
+
+    Parameters
+    ----------
+    port : int
+        Port to listen on.
+    addr : str, optional
+        Address to listen on. Defaults to all interfaces.
+
+    Returns
+    -------
+    HTTPServer
+
+    """
+    server = _ThreadingHTTPServer((addr, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
@@ -0,0 +1,483 @@
+import logging
+import threading
+import time
+
+from zfs_uploader.metrics import (BUFFER_FILL, BYTES_RECEIVED, BYTES_SENT,
+                                  STALLS, THROUGHPUT)
+from zfs_uploader.tracing import current_span
+
+KB = 1024
+MB = KB * KB
+SAMPLE_INTERVAL = 1
+LOG_INTERVAL = 5
+EWMA_ALPHA = 0.3
+
+
+class Transfer:
+    """ Progress of one upload or restore.
+
+    The callback is called from many transfer threads. Every thread adds to
+    its own counter so that no lock or clock read is needed per chunk. The
+    reporter thread of the engine sums the counters. The transferred bytes
+    are added to the span that was current when the transfer was created.
+
+    The reporter thread marks the transfer as stalled and calls the stall
+    callbacks if no bytes were transferred for the stall timeout.
+    """
+
+    @property
+    def filesystem(self):
+        """ ZFS filesystem. """
+        return self._filesystem
+
+    @property
+    def backup_time(self):
+        """ Backup time in %Y%m%d_%H%M%S format. """
+        return self._backup_time
+
+    @property
+    def s3_key(self):
+        """ Backup S3 key. """
+        return self._s3_key
+
+    @property
+    def direction(self):
+        """ Transfer direction. Either `upload` or `restore`. """
+        return self._direction
+
+    @property
+    def total_size(self):
+        """ Expected transfer size in bytes. """
+        return self._total_size
+
+    @property
+    def transferred(self):
+        """ Number of bytes transferred. """
+        return sum(list(self._counts.values()))
+
+    @property
+    def progress(self):
+        """ Fraction of the expected size that has been transferred. """
+        if not self._total_size:
+            return None
+        return min(self.transferred / self._total_size, 1)
+
+    @property
+    def speed(self):
+        """ Exponentially weighted moving average speed in bytes/s. """
+        return self._speed or 0
+
+    @property
+    def average_speed(self):
+        """ Average speed since the start in bytes/s. """
+        elapsed = self.elapsed
+        return self.transferred / elapsed if elapsed > 0 else 0
+
+    @property
+    def eta(self):
+        """ Estimated number of seconds until the transfer is finished. """
+        if not self._total_size or not self._speed:
+            return None
+        return max(self._total_size - self.transferred, 0) / self._speed
+
+    @property
+    def elapsed(self):
+        """ Number of seconds since the start. """
+        end = self._end_time or time.monotonic()
+        return end - self._start_time
+
+    @property
+    def done(self):
+        """ Transfer has finished. """
+        return self._end_time is not None
+
+    @property
+    def buffer(self):
+        """ Ring buffer feeding the upload. """
+        return self._buffer
+
+    @property
+    def stall_timeout(self):
+        """ Seconds without progress until the transfer is stalled. """
+        return self._stall_timeout
+
+    @property
+    def stalled(self):
+        """ Transfer made no progress for the stall timeout. """
+        return self._stalled
+
+    def __init__(self, engine, filesystem, backup_time, s3_key, total_size,
+                 direction='upload', buffer=None, stall_timeout=None):
+        """ Create Transfer object.
+
+        Parameters
+        ----------
+        engine : ProgressEngine
+        filesystem : str
+            ZFS filesystem.
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+        s3_key : str
+            Backup S3 key.
+        total_size : int
+            Expected transfer size in bytes.
+        direction : str, default: upload
+            Either `upload` or `restore`.
+        buffer : RingBuffer, optional
+            Ring buffer used for reporting the fill level.
+        stall_timeout : float, optional
+            Seconds without progress until the transfer is stalled. Stall
+            detection is disabled if not set.
+
+        """
+        self._engine = engine
+        self._filesystem = filesystem
+        self._backup_time = backup_time
+        self._s3_key = s3_key
+        self._total_size = total_size
+        self._direction = direction
+        self._buffer = buffer
+        self._stall_timeout = stall_timeout
+
+        self._span = current_span()
+        self._counts = {}
+        self._start_time = time.monotonic()
+        self._end_time = None
+
+        # only touched by the reporter thread
+        self._speed = None
+        self._sampled = 0
+        self._sample_time = self._start_time
+        self._log_time = self._start_time
+        self._progress_time = self._start_time
+        self._stalled = False
+        self._stall_callbacks = []
+
+    def __enter__(self):
+        self._engine.add(self)
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+    def callback(self, amount):
+        """ Add transferred bytes. Used as boto3 transfer callback. """
+        thread_id = threading.get_ident()
+        # each thread only writes its own key
+        self._counts[thread_id] = self._counts.get(thread_id, 0) + amount
+
+    def on_stall(self, callback):
+        """ Add callback that is called once if the transfer stalls.
+
+        Callbacks are called from the reporter thread.
+
+        Parameters
+        ----------
+        callback : callable
+            Called without arguments.
+
+        """
+        self._stall_callbacks.append(callback)
+
+    def finish(self):
+        """ Mark transfer as finished. """
+        if self._end_time is None:
+            self._end_time = time.monotonic()
+            self._engine.remove(self)
+            if self._span:
+                self._span.add_bytes(self.transferred)
+
+
+class ProgressEngine:
+    """ Shared progress reporter for all active transfers.
+
+    A single reporter thread samples the active transfers, updates the
+    moving average speeds and metrics, logs progress and renders views.
+    """
+
+    @property
+    def transfers(self):
+        """ Active transfers. """
+        with self._lock:
+            return list(self._transfers)
+
+    def __init__(self, interval=SAMPLE_INTERVAL, log_interval=LOG_INTERVAL,
+                 alpha=EWMA_ALPHA):
+        """ Create ProgressEngine object.
+
+        Parameters
+        ----------
+        interval : float, default: 1
+            Sample interval in seconds.
+        log_interval : float, default: 5
+            Progress log interval in seconds.
+        alpha : float, default: 0.3
+            Smoothing factor of the moving average speed.
+
+        """
+        self._interval = interval
+        self._log_interval = log_interval
+        self._alpha = alpha
+
+        self._transfers = []
+        self._finished = []
+        self._views = []
+        self._lock = threading.Lock()
+        self._sample_lock = threading.Lock()
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    def track(self, filesystem, backup_time, s3_key, total_size,
+              direction='upload', buffer=None, stall_timeout=None):
+        """ Create transfer. Use as context manager to track it.
+
+        Parameters
+        ----------
+        filesystem : str
+            ZFS filesystem.
+        backup_time : str
+            Backup time in %Y%m%d_%H%M%S format.
+        s3_key : str
+            Backup S3 key.
+        total_size : int
+            Expected transfer size in bytes.
+        direction : str, default: upload
+            Either `upload` or `restore`.
+        buffer : RingBuffer, optional
+            Ring buffer used for reporting the fill level.
+        stall_timeout : float, optional
+            Seconds without progress until the transfer is stalled.
+
+        Returns
+        -------
+        Transfer
+
+        """
+        return Transfer(self, filesystem, backup_time, s3_key, total_size,
+                        direction, buffer, stall_timeout)
+
+    def add(self, transfer):
+        """ Start tracking transfer. """
+        with self._lock:
+            self._transfers.append(transfer)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+
+    def remove(self, transfer):
+        """ Stop tracking transfer after a final sample. """
+        with self._lock:
+            if transfer in self._transfers:
+                self._transfers.remove(transfer)
+                self._finished.append(transfer)
+        self.sample()
+
+    def add_view(self, view):
+        """ Add view that is rendered on every sample.
+
+        Parameters
+        ----------
+        view : ProgressView
+
+        """
+        with self._lock:
+            self._views.append(view)
+
+    def remove_view(self, view):
+        """ Render finished transfers and remove view. """
+        self.sample()
+        with self._lock:
+            self._views.remove(view)
+
+    def sample(self, now=None):
+        """ Sample all active transfers.
+
+        Parameters
+        ----------
+        now : float, optional
+            Monotonic time of the sample. Defaults to now.
+
+        """
+        with self._sample_lock:
+            now = now or time.monotonic()
+            with self._lock:
+                transfers = list(self._transfers)
+                finished = self._finished
+                self._finished = []
+                views = list(self._views)
+
+            for transfer in transfers + finished:
+                self._sample_transfer(transfer, now)
+
+            for view in views:
+                view.render(transfers, finished)
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                if not self._transfers and not self._finished:
+                    self._thread = None
+                    return
+            self.sample()
+
+    def _sample_transfer(self, transfer, now):
+        t = transfer
+        transferred = t.transferred
+        delta = transferred - t._sampled # noqa
+        dt = (t._end_time or now) - t._sample_time # noqa
+
+        if dt > 0:
+            speed = delta / dt
+            if t._speed is None: # noqa
+                t._speed = speed
+            else:
+                t._speed = self._alpha * speed + (1 - self._alpha) * t._speed # noqa
+            t._sample_time = now
+
+        t._sampled = transferred
+
+        if delta:
+            t._progress_time = now
+        elif (t.stall_timeout and not t.done and not t.stalled and
+              now - t._progress_time >= t.stall_timeout): # noqa
+            self._stall(t)
+
+        counter = BYTES_SENT if t.direction == 'upload' else BYTES_RECEIVED
+        if delta:
+            counter.inc(delta, filesystem=t.filesystem)
+        THROUGHPUT.set(t.average_speed if t.done else t.speed,
+                       filesystem=t.filesystem)
+        if t.buffer:
+            BUFFER_FILL.set(t.buffer.fill_level, filesystem=t.filesystem)
+
+        if now - t._log_time >= self._log_interval: # noqa
+            t._log_time = now
+            self._logger.info(_format_log(t))
+
+    def _stall(self, transfer):
+        t = transfer
+        t._stalled = True
+        STALLS.inc(filesystem=t.filesystem)
+        self._logger.warning(f'filesystem={t.filesystem} '
+                             f'snapshot_name={t.backup_time} '
+                             f's3_key={t.s3_key} '
+                             f'msg="No progress for {t.stall_timeout} '
+                             'seconds. Cancelling transfer."')
+
+        for callback in t._stall_callbacks: # noqa
+            try:
+                callback()
+            except Exception as e:
+                self._logger.error(f'filesystem={t.filesystem} '
+                                   f's3_key={t.s3_key} '
+                                   'msg="Cancelling transfer failed." '
+                                   f'error="{e}"')
+
+
+class ProgressView:
+    """ Live multi-transfer progress view for a terminal. """
+
+    def __init__(self, stream, bar_width=20):
+        """ Create ProgressView object.
+
+        Parameters
+        ----------
+        stream : file
+            Terminal stream. Such as `sys.stderr`.
+        bar_width : int, default: 20
+            Width of the progress bar in characters.
+
+        """
+        self._stream = stream
+        self._bar_width = bar_width
+        self._lines = 0
+
+    def render(self, transfers, finished):
+        """ Redraw active transfers below finished transfers.
+
+        Parameters
+        ----------
+        transfers : list(Transfer)
+            Active transfers.
+        finished : list(Transfer)
+            Transfers finished since the last render. They are drawn once.
+
+        """
+        output = ''
+        if self._lines:
+            # move to the start of the previous frame and clear it
+            output += f'\x1b[{self._lines}F\x1b[J'
+
+        for transfer in finished:
+            output += self._format(transfer) + '\n'
+        for transfer in transfers:
+            output += self._format(transfer) + '\n'
+
+        self._lines = len(transfers)
+        self._stream.write(output)
+        self._stream.flush()
+
+    def _format(self, transfer):
+        progress = transfer.progress
+        if transfer.done:
+            progress = 1 if progress is not None else None
+
+        if progress is None:
+            bar = '?' * self._bar_width
+            percent = '  ?%'
+        else:
+            filled = round(progress * self._bar_width)
+            bar = '#' * filled + '.' * (self._bar_width - filled)
+            percent = f'{round(progress * 100):>3}%'
+
+        if transfer.done:
+            status = (f'done in {_format_duration(transfer.elapsed)} '
+                      f'({round(transfer.average_speed / MB)} MBps)')
+        else:
+            eta = transfer.eta
+            status = (f'{round(transfer.speed / MB)} MBps '
+                      f'ETA {_format_duration(eta) if eta else "?"}')
+
+        return (f'{transfer.filesystem}@{transfer.backup_time} [{bar}] '
+                f'{percent} {round(transfer.transferred / MB)} MB {status}')
+
+
+def _format_log(transfer):
+    t = transfer
+    total = round(t.total_size / MB) if t.total_size else '?'
+    progress = (f'{round(t.progress * 100)}%' if t.progress is not None
+                else 'unknown')
+    eta = f'{round(t.eta)}s' if t.eta is not None else 'unknown'
+
+    msg = (
+        f'filesystem={t.filesystem} '
+        f'snapshot_name={t.backup_time} '
+        f's3_key={t.s3_key} '
+        f'progress={progress} '
+        f'speed="{round(t.speed / MB)} MBps" '
+        f'transferred="{round(t.transferred / MB)}/{total} MB" '
+        f'time_elapsed={round(t.elapsed / 60)}m '
+        f'eta={eta}'
+    )
+    if t.buffer:
+        buffer = t.buffer
+        msg += (f' buffer_fill={round(buffer.fill_level * 100)}%'
+                f' buffer_producer_waits={buffer.producer_waits}'
+                f' buffer_consumer_waits={buffer.consumer_waits}')
+    return msg
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f'{hours}h{minutes:02}m'
+    if minutes:
+        return f'{minutes}m{seconds:02}s'
+    return f'{seconds}s'
+
+
+PROGRESS = ProgressEngine()
@@ -0,0 +1,295 @@
+from datetime import datetime
+
+from zfs_uploader import DATETIME_FORMAT
+
+# period rules ordered from the shortest to the longest period
+PERIODS = ('hourly', 'daily', 'weekly', 'monthly')
+
+
+class RetentionPolicy:
+    """ Grandfather-father-son retention policy for backups.
+
+    The most recent backup of each of the last `keep_<period>` periods is
+    kept. Backups needed for restoring a kept backup are kept as well.
+    `max_backups` additionally caps the number of backups. Without any
+    period rule all backups are kept until `max_backups` is reached.
+    """
+
+    @property
+    def max_backups(self):
+        """ Maximum number of full and incremental backups. """
+        return self._max_backups
+
+    @property
+    def rules(self):
+        """ Number of periods to keep keyed by period. """
+        return self._rules
+
+    def __init__(self, max_backups=None, keep_hourly=None, keep_daily=None,
+                 keep_weekly=None, keep_monthly=None):
+        """ Create RetentionPolicy object.
+
+        Parameters
+        ----------
+        max_backups : int, optional
+            Maximum number of full and incremental backups.
+        keep_hourly : int, optional
+            Number of hours to keep the most recent backup of.
+        keep_daily : int, optional
+            Number of days to keep the most recent backup of.
+        keep_weekly : int, optional
+            Number of ISO weeks to keep the most recent backup of.
+        keep_monthly : int, optional
+            Number of months to keep the most recent backup of.
+
+        """
+        self._max_backups = max_backups
+
+        rules = zip(PERIODS, (keep_hourly, keep_daily, keep_weekly,
+                              keep_monthly))
+        self._rules = {period: count for period, count in rules
+                       if count is not None}
+
+        for period, count in self._rules.items():
+            if count < 0:
+                raise ValueError(f'keep_{period} must be greater than or '
+                                 'equal to 0.')
+
+    def __bool__(self):
+        return self._max_backups is not None or bool(self._rules)
+
+
+class RetentionPlan:
+    """ Names to keep and delete with the reasons for keeping them. """
+
+    @property
+    def keep(self):
+        """ Names to keep. Oldest first. """
+        return self._keep
+
+    @property
+    def delete(self):
+        """ Names to delete. Oldest first. """
+        return self._delete
+
+    @property
+    def reasons(self):
+        """ Reasons for keeping or deleting keyed by name. """
+        return self._reasons
+
+    def __init__(self, keep, delete, reasons):
+        """ Create RetentionPlan object.
+
+        Parameters
+        ----------
+        keep : list(str)
+            Names to keep.
+        delete : list(str)
+            Names to delete.
+        reasons : dict
+            Lists of reasons keyed by name.
+
+        """
+        self._keep = keep
+        self._delete = delete
+        self._reasons = reasons
+
+
+def plan_backups(backups, policy, protected=()):
+    """ Compute which backups to keep and delete.
+
+    Runs in linear time. Period rules and dependencies are resolved in one
+    pass from the most recent backup to the oldest since a dependency is
+    always older than its dependants. `max_backups` is then applied in one
+    pass from the oldest backup, skipping backups with dependants.
+
+    Parameters
+    ----------
+    backups : list(Backup)
+        Backups sorted by backup time. Most recent backup is last.
+    policy : RetentionPolicy
+
+    protected : list(str), optional
+        Backup times that are never deleted.
+
+    Returns
+    -------
+    RetentionPlan
+
+    """
+    protected = set(protected)
+    reasons = {b.backup_time: [] for b in backups}
+    deleted = set()
+
+    if policy.rules:
+        last_periods = {}
+        counts = dict.fromkeys(policy.rules, 0)
+        needed = set()
+
+        for backup in reversed(backups):
+            backup_time = backup.backup_time
+            periods = _get_periods(backup_time)
+            for period, count in policy.rules.items():
+                if counts[period] < count and \
+                        last_periods.get(period) != periods[period]:
+                    last_periods[period] = periods[period]
+                    counts[period] += 1
+                    reasons[backup_time].append(period)
+
+            if backup_time in protected:
+                reasons[backup_time].append('most recent chain')
+            if backup_time in needed:
+                reasons[backup_time].append('dependency')
+
+            if reasons[backup_time]:
+                if backup.dependency:
+                    needed.add(backup.dependency)
+            else:
+                deleted.add(backup_time)
+
+    if policy.max_backups is not None:
+        remaining = [b for b in backups if b.backup_time not in deleted]
+        dependencies = {b.dependency for b in remaining}
+        excess = len(remaining) - policy.max_backups
+
+        for backup in remaining:
+            if excess <= 0:
+                break
+            backup_time = backup.backup_time
+            if backup_time in protected:
+                _add_reason(reasons, backup_time, 'most recent chain')
+            elif backup_time in dependencies:
+                _add_reason(reasons, backup_time, 'has dependants')
+            else:
+                deleted.add(backup_time)
+                excess -= 1
+
+    keep = [b.backup_time for b in backups if b.backup_time not in deleted]
+    delete = [b.backup_time for b in backups if b.backup_time in deleted]
+    for backup_time in keep:
+        if not reasons[backup_time]:
+            reasons[backup_time].append('max_backups')
+    for backup_time in delete:
+        reasons[backup_time] = []
+
+    return RetentionPlan(keep, delete, reasons)
+
+
+def plan_sharded_backups(shards, get_backups, policy, protected=()):
+    """ Compute which backups to delete from a sharded `backup.db`.
+
+    Deletes the same backups as `plan_backups` but only downloads the
+    shards that can hold backups to delete. A shard holding a single full
+    backup is fully described by the head index. Without period rules the
+    oldest shards are downloaded until the backups to delete are known. A
+    backup only depends on backups back to the most recent full backup
+    before it, so backups older than the last full backup of the
+    downloaded shards have no dependants in the other shards.
+
+    Parameters
+    ----------
+    shards : dict
+        Number of backups (`count`) and most recent full backup time
+        (`last_full`) keyed by month in %Y%m format.
+    get_backups : callable
+        Called with a list of months. Returns the backups of those months
+        sorted by backup time.
+    policy : RetentionPolicy
+
+    protected : list(str), optional
+        Backup times that are never deleted.
+
+    Returns
+    -------
+    RetentionPlan
+        Only backups of downloaded shards and single full backups are
+        listed as kept.
+
+    """
+    months = sorted(shards)
+
+    if not policy.rules and policy.max_backups is not None:
+        excess = sum(shards[m]['count'] for m in months) - policy.max_backups
+        if excess <= 0:
+            return RetentionPlan([], [], {})
+
+        for index, month in enumerate(months[:-1]):
+            boundary = shards[month]['last_full']
+            if boundary is None:
+                continue
+            backups = get_backups(months[:index + 1])
+            unloaded = sum(shards[m]['count'] for m in months[index + 1:])
+            plan = plan_backups(
+                backups, RetentionPolicy(policy.max_backups - unloaded),
+                protected)
+            if len(plan.delete) == excess and \
+                    all(t < boundary for t in plan.delete):
+                return plan
+
+    singles = [_FullBackup(shards[m]['last_full']) for m in months
+               if shards[m]['count'] == 1 and shards[m]['last_full']]
+    backups = get_backups([m for m in months if shards[m]['count'] > 1 or
+                           not shards[m]['last_full']])
+    backups = sorted(backups + singles, key=lambda b: b.backup_time)
+    return plan_backups(backups, policy, protected)
+
+
+def plan_snapshots(snapshot_names, max_snapshots, protected=()):
+    """ Compute which snapshots to keep and delete.
+
+    The oldest snapshots above `max_snapshots` are deleted unless they are
+    protected. Protected snapshots still count towards the excess.
+
+    Parameters
+    ----------
+    snapshot_names : list(str)
+        Snapshot names sorted by creation. Most recent snapshot is last.
+    max_snapshots : int
+        Maximum number of snapshots.
+    protected : list(str), optional
+        Snapshot names that are never deleted.
+
+    Returns
+    -------
+    RetentionPlan
+
+    """
+    protected = set(protected)
+    reasons = {name: [] for name in snapshot_names}
+    excess = max(len(snapshot_names) - max_snapshots, 0)
+
+    delete = []
+    for name in snapshot_names[:excess]:
+        if name in protected:
+            reasons[name].append('backup source')
+        else:
+            delete.append(name)
+
+    deleted = set(delete)
+    keep = [name for name in snapshot_names if name not in deleted]
+    for name in keep:
+        if not reasons[name]:
+            reasons[name].append('max_snapshots')
+    return RetentionPlan(keep, delete, reasons)
+
+
+class _FullBackup:
+    """ Full backup described by the head index of a sharded backup.db. """
+    dependency = None
+
+    def __init__(self, backup_time):
+        self.backup_time = backup_time
+
+
+def _get_periods(backup_time):
+    dt = datetime.strptime(backup_time, DATETIME_FORMAT)
+    year, week, _ = dt.isocalendar()
+    return {'hourly': backup_time[:11],
+            'daily': backup_time[:8],
+            'weekly': (year, week),
+            'monthly': backup_time[:6]}
+
+
+def _add_reason(reasons, name, reason):
+    if reason not in reasons[name]:
+        reasons[name].append(reason)
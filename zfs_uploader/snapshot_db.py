@@ -1,7 +1,9 @@
 from time import sleep
 
+from zfs_uploader.backend import get_backend
+from zfs_uploader.tracing import span
 from zfs_uploader.utils import get_date_time
-from zfs_uploader import zfs
+from zfs_uploader.zfs import ZFSError
 
 
 class SnapshotDB:
@@ -10,7 +12,17 @@ class SnapshotDB:
         """ ZFS file system. """
         return self._filesystem
 
-    def __init__(self, filesystem):
+    @property
+    def recursive(self):
+        """ Snapshots include descendant filesystems. """
+        return self._recursive
+
+    @property
+    def backend(self):
+        """ ZFS backend. """
+        return self._backend
+
+    def __init__(self, filesystem, recursive=False, backend=None):
         """ Create SnapshotDB object.
 
         Snapshot DB is used for storing Snapshot objects. Creating a
@@ -20,9 +32,16 @@ class SnapshotDB:
         ----------
         filesystem : str
             ZFS filesystem.
+        recursive : bool, default: False
+            Create and destroy snapshots of descendant filesystems.
+        backend : ZFSBackend, optional
+            Backend used for listing, creating and destroying snapshots.
+            Defaults to the CLI backend.
 
         """
         self._filesystem = filesystem
+        self._recursive = recursive
+        self._backend = backend or get_backend()
         self._snapshots = {}
 
         self.refresh()
@@ -42,10 +61,8 @@ class SnapshotDB:
             sleep(1)
             name = get_date_time()
 
-        out = zfs.create_snapshot(self._filesystem, name)
-        if out.returncode:
-            raise zfs.ZFSError(out.stderr)
-
+        self._backend.create_snapshots([self._filesystem], name,
+                                       self._recursive)
         self.refresh()
 
         return self._snapshots[name]
@@ -58,9 +75,69 @@ class SnapshotDB:
         name : str
 
         """
-        zfs.destroy_snapshot(self._filesystem, name)
+        self.delete_snapshots([name])
+
+    def delete_snapshots(self, names):
+        """ Delete Snapshot objects and ZFS snapshots.
 
-        del self._snapshots[name]
+        The ZFS snapshots are destroyed with one backend call. The batch
+        is atomic, so if it fails the snapshots are destroyed one by one
+        and only the snapshots that could not be destroyed are kept.
+
+        Parameters
+        ----------
+        names : list(str)
+
+        Raises
+        ------
+        ZFSError
+            If any snapshot could not be destroyed. The error names the
+            snapshots that were kept.
+
+        """
+        if not names:
+            return
+
+        try:
+            self._backend.destroy_snapshots(self._filesystem, names,
+                                            self._recursive)
+        except ZFSError:
+            if len(names) == 1:
+                raise
+        else:
+            for name in names:
+                self._snapshots.pop(name, None)
+            return
+
+        errors = []
+        for name in names:
+            try:
+                self._backend.destroy_snapshots(self._filesystem, [name],
+                                                self._recursive)
+            except ZFSError as e:
+                errors.append(f'{name}: {str(e).strip()}')
+            else:
+                self._snapshots.pop(name, None)
+
+        if errors:
+            raise ZFSError('; '.join(errors))
+
+    def get_snapshot(self, name):
+        """ Get snapshot using snapshot name.
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+        Snapshot
+
+        """
+        try:
+            return self._snapshots[name]
+        except KeyError:
+            raise KeyError('Snapshot does not exist.') from None
 
     def get_snapshots(self):
         """ Get sorted list of snapshots.
@@ -88,18 +165,101 @@ class SnapshotDB:
         """
         return list(self._snapshots.keys())
 
-    def refresh(self):
-        """ Refresh SnapshotDB with latest snapshots. """
-        self._snapshots = {}
-        for k, v in zfs.list_snapshots().items():
-            if self._filesystem in k:
+    def get_snapshot_names_between(self, name_1, name_2):
+        """ Get snapshot names after name_1 up to and including name_2.
+
+        These are the snapshots contained in a `zfs send -I` stream.
+
+        Parameters
+        ----------
+        name_1 : str
+            Name of the incremental source snapshot.
+        name_2 : str
+            Name of the target snapshot.
+
+        Returns
+        -------
+        list(str)
+            Sorted list of snapshot names. Most recent snapshot is last.
+
+        """
+        names = self.get_snapshot_names()
+        return names[names.index(name_1) + 1:names.index(name_2) + 1]
+
+    def refresh(self, snapshots=None):
+        """ Refresh SnapshotDB with latest snapshots.
+
+        Parameters
+        ----------
+        snapshots : dict, optional
+            Output of `ZFSBackend.list_snapshots`. Used for refreshing
+            multiple SnapshotDB objects with one listing.
+
+        """
+        with span('snapshot_refresh', filesystem=self._filesystem):
+            if snapshots is None:
+                snapshots = self._backend.list_snapshots([self._filesystem])
+
+            self._snapshots = {}
+            for k, v in snapshots.items():
                 filesystem, name = k.split('@')
-                referenced = int(v['REFER'])
-                used = int(v['USED'])
+                if filesystem == self._filesystem:
+                    referenced = int(v['REFER'])
+                    used = int(v['USED'])
+
+                    self._snapshots.update({
+                        name: Snapshot(filesystem, name, referenced, used)
+                    })
+
+
+def create_snapshots(snapshot_dbs):
+    """ Create Snapshot objects and ZFS snapshots for multiple filesystems.
+
+    All snapshots of a backend are created with one call so that they
+    share the same name and point in time. Recursive and non-recursive
+    snapshots are created with separate calls.
+
+    Parameters
+    ----------
+    snapshot_dbs : list(SnapshotDB)
+
+    Returns
+    -------
+    dict(str, Snapshot)
+        Snapshots keyed by filesystem.
+
+    """
+    name = get_date_time()
+
+    if any(name in snapshot_db.get_snapshot_names()
+           for snapshot_db in snapshot_dbs):
+        # sleep for one second in order to increment name
+        sleep(1)
+        name = get_date_time()
 
-                self._snapshots.update({
-                    name: Snapshot(filesystem, name, referenced, used)
-                })
+    backends = []
+    for snapshot_db in snapshot_dbs:
+        if snapshot_db.backend not in backends:
+            backends.append(snapshot_db.backend)
+
+    for backend in backends:
+        backend_dbs = [snapshot_db for snapshot_db in snapshot_dbs
+                       if snapshot_db.backend is backend]
+
+        for recursive in (False, True):
+            filesystems = [snapshot_db.filesystem
+                           for snapshot_db in backend_dbs
+                           if snapshot_db.recursive == recursive]
+            if filesystems:
+                backend.create_snapshots(filesystems, name, recursive)
+
+        snapshots = backend.list_snapshots(
+            [snapshot_db.filesystem for snapshot_db in backend_dbs])
+        for snapshot_db in backend_dbs:
+            snapshot_db.refresh(snapshots)
+
+    return {snapshot_db.filesystem: snapshot_db.get_snapshot(name)
+            for snapshot_db in snapshot_dbs}
 
 
 class Snapshot:
@@ -0,0 +1,543 @@
+import json
+import logging
+import os
+import shutil
+import threading
+
+from zfs_uploader.stream import set_pipe_size
+
+KB = 1024
+MB = KB * KB
+SPOOL_CHUNK_SIZE = 4 * MB
+# downloads of backups being restored are kept apart from send streams
+RESTORE_DIRECTORY = '.restore'
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+class SpoolError(Exception):
+    """ Baseclass for spool exceptions. """
+
+
+class Spool:
+    """ Local staging directory for snapshot send streams. """
+
+    @property
+    def directory(self):
+        """ Spool directory. """
+        return self._directory
+
+    @property
+    def max_size(self):
+        """ Maximum number of bytes stored in the spool directory. """
+        return self._max_size
+
+    def __init__(self, directory, max_size=None):
+        """ Create Spool object.
+
+        The spool decouples `zfs send` from the S3 upload. The send stream is
+        written to disk at disk speed while the upload reads from the
+        growing file. Completed spool files are kept until the backup has
+        been checked so that an interrupted upload can be resumed.
+
+        Parameters
+        ----------
+        directory : str
+            Spool directory.
+        max_size : int, optional
+            Maximum number of bytes stored in the spool directory. Defaults
+            to the free space of the file system holding the directory.
+
+        """
+        self._directory = directory
+        self._max_size = max_size
+        self._reserved = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+        os.makedirs(self._directory, exist_ok=True)
+
+    def reserve(self, filesystem, object_name, send_size, metadata):
+        """ Reserve space for a send stream.
+
+        Parameters
+        ----------
+        filesystem : str
+            ZFS filesystem.
+        object_name : str
+            Object name. Such as the full/inc snapshot name.
+        send_size : int
+            Estimated send size in bytes.
+        metadata : dict
+            Backup metadata stored next to the spool file. Used for resuming
+            the upload.
+
+        Returns
+        -------
+        SpoolFile
+            None is returned if the spool does not have enough space.
+
+        """
+        path = self._get_path(filesystem, object_name)
+        if not self._reserve(path, send_size):
+            return None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SpoolFile(self, path, metadata)
+
+    def reserve_download(self, filesystem, object_name, metadata):
+        """ Reserve space for downloading a backup that is restored.
+
+        A download left over from an interrupted restore of the same object
+        is continued.
+
+        Parameters
+        ----------
+        filesystem : str
+            ZFS filesystem the backup was taken from.
+        object_name : str
+            Object name. Such as the full/inc snapshot name.
+        metadata : dict
+            Object metadata. Requires `size`, `etag` and `part_size`.
+
+        Returns
+        -------
+        DownloadFile
+            None is returned if the spool does not have enough space.
+
+        """
+        path = os.path.join(self._directory, RESTORE_DIRECTORY,
+                            filesystem.replace('/', '%'), object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        download_file = DownloadFile(self, path, metadata)
+        if not self._reserve(path, metadata['size'] -
+                             download_file.allocated):
+            return None
+
+        return download_file
+
+    def get_spool_files(self, filesystem):
+        """ Get completed spool files for a filesystem.
+
+        Incomplete spool files are left over from an interrupted send and
+        are removed.
+
+        Parameters
+        ----------
+        filesystem : str
+            ZFS filesystem.
+
+        Returns
+        -------
+        list(SpoolFile)
+            Sorted list of spool files. Most recent spool file is last.
+
+        """
+        directory = self._get_path(filesystem, '')
+        if not os.path.isdir(directory):
+            return []
+
+        spool_files = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.json'):
+                continue
+
+            path = os.path.join(directory, name)
+            try:
+                with open(f'{path}.json', 'r') as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                metadata = {}
+
+            spool_file = SpoolFile(self, path, metadata)
+            if metadata.get('complete'):
+                spool_files.append(spool_file)
+            else:
+                self._logger.info(f'filesystem={filesystem} '
+                                  f'spool_file={path} '
+                                  'msg="Removing incomplete spool file."')
+                spool_file.remove()
+
+        return spool_files
+
+    def release(self, path):
+        """ Release reserved space. """
+        with self._lock:
+            self._reserved.pop(path, None)
+
+    def _reserve(self, path, size):
+        with self._lock:
+            free = shutil.disk_usage(self._directory).free
+            reserved = sum(self._reserved.values())
+            if size + reserved > free:
+                return False
+
+            if self._max_size is not None:
+                used = self._get_used_size()
+                if size + reserved + used > self._max_size:
+                    return False
+
+            self._reserved[path] = size
+        return True
+
+    def _get_path(self, filesystem, object_name):
+        return os.path.join(self._directory, filesystem.replace('/', '%'),
+                            object_name)
+
+    def _get_used_size(self):
+        used = 0
+        for root, _, files in os.walk(self._directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in self._reserved:
+                    used += os.path.getsize(path)
+        return used
+
+
+def get_spool(directory, max_size=None):
+    """ Get spool shared by all jobs using the same spool directory.
+
+    The spool is kept across configuration reloads so that space reserved
+    by running backups is accounted for by the jobs of the new
+    configuration. The maximum size of an existing spool is updated.
+
+    Parameters
+    ----------
+    directory : str
+        Spool directory.
+    max_size : int, optional
+        Maximum number of bytes stored in the spool directory.
+
+    Returns
+    -------
+    Spool
+
+    """
+    key = os.path.abspath(directory)
+    with _spools_lock:
+        spool = _spools.get(key)
+        if spool is None:
+            spool = _spools[key] = Spool(directory, max_size)
+        else:
+            with spool._lock:
+                spool._max_size = max_size
+        return spool
+
+
+class SpoolFile:
+    """ Spool file object. """
+
+    @property
+    def path(self):
+        """ Spool file path. """
+        return self._path
+
+    @property
+    def metadata(self):
+        """ Backup metadata. """
+        return self._metadata
+
+    def __init__(self, spool, path, metadata):
+        """ Create SpoolFile object.
+
+        Parameters
+        ----------
+        spool : Spool
+        path : str
+            Spool file path.
+        metadata : dict
+            Backup metadata.
+
+        """
+        self._spool = spool
+        self._path = path
+        self._metadata = metadata
+
+        self._size = 0
+        self._done = False
+        self._error = None
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def start(self, stream):
+        """ Start writing the send stream to the spool file.
+
+        Parameters
+        ----------
+        stream : file
+            Readable send stream.
+
+        """
+        self._write_metadata(complete=False)
+        set_pipe_size(stream)
+        self._thread = threading.Thread(target=self._write, args=(stream,),
+                                        daemon=True)
+        self._thread.start()
+
+    def open(self):
+        """ Open spool file for reading while it is being written.
+
+        Returns
+        -------
+        SpoolReader
+
+        """
+        return SpoolReader(self)
+
+    def join(self):
+        """ Wait for the send stream to be written. """
+        self._thread.join()
+        self._spool.release(self._path)
+        if self._error:
+            raise SpoolError(self._error)
+
+    def complete(self):
+        """ Mark spool file as complete so that it can be resumed. """
+        self._write_metadata(complete=True)
+
+    def remove(self):
+        """ Remove spool file and metadata. """
+        for path in (self._path, f'{self._path}.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._spool.release(self._path)
+
+    def _write(self, stream):
+        try:
+            with open(self._path, 'wb') as f:
+                while True:
+                    data = stream.read1(SPOOL_CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    f.flush()
+                    with self._condition:
+                        self._size += len(data)
+                        self._condition.notify_all()
+        except OSError as e:
+            self._error = str(e)
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def _wait(self, size):
+        """ Wait until the spool file is larger than size or finished. """
+        with self._condition:
+            while self._size <= size and not self._done:
+                self._condition.wait()
+            if self._error:
+                raise SpoolError(self._error)
+            return self._size
+
+    def _write_metadata(self, complete):
+        self._metadata['complete'] = complete
+        with open(f'{self._path}.json', 'w') as f:
+            json.dump(self._metadata, f)
+
+
+class SpoolReader:
+    """ Reader for a spool file that is still being written.
+
+    The reader is not seekable so that boto reads it sequentially. Reads
+    block until the requested number of bytes has been spooled or the send
+    stream has finished.
+    """
+
+    def __init__(self, spool_file):
+        self._spool_file = spool_file
+        self._position = 0
+        self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        if self._f is None:
+            self._spool_file._wait(0) # noqa
+            self._f = open(self._spool_file.path, 'rb')
+
+        chunks = []
+        remaining = size
+        while remaining != 0:
+            available = self._spool_file._wait(self._position) # noqa
+            if available <= self._position:
+                break
+
+            amount = available - self._position
+            if remaining > 0:
+                amount = min(amount, remaining)
+                remaining -= amount
+
+            data = self._f.read(amount)
+            self._position += len(data)
+            chunks.append(data)
+
+        return b''.join(chunks)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class DownloadFile:
+    """ Resumable download of a backup into the spool.
+
+    Parts are written in place. Finished parts are recorded in a metadata
+    file next to the download so that a restore interrupted by a crash or
+    restart only downloads the missing parts. The recorded parts are
+    discarded if the object has changed.
+    """
+
+    @property
+    def path(self):
+        """ Download file path. """
+        return self._path
+
+    @property
+    def metadata(self):
+        """ Object metadata. """
+        return self._metadata
+
+    @property
+    def size(self):
+        """ Object size in bytes. """
+        return self._metadata['size']
+
+    @property
+    def part_size(self):
+        """ Part size in bytes. """
+        return self._metadata['part_size']
+
+    @property
+    def missing_parts(self):
+        """ Parts that have not been downloaded.
+
+        Returns
+        -------
+        list(tuple(int, int, int))
+            Part index, first byte and last byte of every missing part.
+
+        """
+        parts = []
+        for index in range(-(-self.size // self.part_size)):
+            if index not in self._parts:
+                start = index * self.part_size
+                end = min(start + self.part_size, self.size) - 1
+                parts.append((index, start, end))
+        return parts
+
+    @property
+    def downloaded(self):
+        """ Number of bytes in finished parts. """
+        missing = sum(end - start + 1 for _, start, end in
+                      self.missing_parts)
+        return self.size - missing
+
+    @property
+    def complete(self):
+        """ All parts have been downloaded. """
+        return not self.missing_parts
+
+    @property
+    def allocated(self):
+        """ Number of bytes allocated on disk. """
+        try:
+            return os.stat(self._path).st_blocks * 512
+        except FileNotFoundError:
+            return 0
+
+    def __init__(self, spool, path, metadata):
+        """ Create DownloadFile object.
+
+        Parameters
+        ----------
+        spool : Spool
+        path : str
+            Download file path.
+        metadata : dict
+            Object metadata. Requires `size`, `etag` and `part_size`.
+
+        """
+        self._spool = spool
+        self._path = path
+        self._metadata = dict(metadata)
+        self._parts = set()
+        self._fd = None
+        self._lock = threading.Lock()
+
+        try:
+            with open(f'{path}.json', 'r') as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+
+        keys = ('size', 'etag', 'part_size')
+        if all(previous.get(k) == self._metadata[k] for k in keys):
+            self._parts = set(previous.get('parts', []))
+        else:
+            self.remove()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        """ Open download file for writing parts. """
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        os.ftruncate(self._fd, self.size)
+
+    def write(self, offset, data):
+        """ Write data at offset. Safe to call from many threads. """
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self._fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def complete_part(self, index):
+        """ Record part as downloaded once its data is on disk. """
+        os.fdatasync(self._fd)
+        with self._lock:
+            self._parts.add(index)
+            self._write_metadata()
+
+    def close(self):
+        """ Close download file and release reserved space. """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._spool.release(self._path)
+
+    def remove(self):
+        """ Remove download file and metadata. """
+        for path in (self._path, f'{self._path}.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._spool.release(self._path)
+
+    def _write_metadata(self):
+        metadata = dict(self._metadata, parts=sorted(self._parts))
+        # replace atomically so that a crash never leaves a corrupt record
+        with open(f'{self._path}.json.tmp', 'w') as f:
+            json.dump(metadata, f)
+        os.replace(f'{self._path}.json.tmp', f'{self._path}.json')
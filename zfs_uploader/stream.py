@@ -0,0 +1,385 @@
+import fcntl
+import hashlib
+import io
+import logging
+import queue
+import struct
+import threading
+
+KB = 1024
+MB = KB * KB
+PIPE_SIZE = 1 * MB
+RING_BUFFER_SIZE = 64 * MB
+RING_BUFFER_SLOT_SIZE = 4 * MB
+
+# send streams are a sequence of dmu_replay_record_t records, each followed
+# by an optional payload. A stream starts with a DRR_BEGIN and ends with a
+# DRR_END record.
+DRR_RECORD_SIZE = 312
+DRR_BEGIN = 0
+DRR_END = 5
+DMU_BACKUP_MAGIC = 0x2F5BACBAC
+
+# F_SETPIPE_SZ is only exposed by the fcntl module in Python 3.10+
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+_logger = logging.getLogger(__name__)
+
+
+def set_pipe_size(fileobj, size=PIPE_SIZE):
+    """ Enlarge pipe buffer.
+
+    Falls back to the system maximum if size is larger than
+    `/proc/sys/fs/pipe-max-size`.
+
+    Parameters
+    ----------
+    fileobj : file
+        Pipe file object.
+    size : int, default: 1 MiB
+        Pipe buffer size in bytes.
+
+    Returns
+    -------
+    int
+        Pipe buffer size in bytes. None is returned if the size can't be
+        set.
+
+    """
+    fd = fileobj.fileno()
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+
+    try:
+        with open('/proc/sys/fs/pipe-max-size', 'r') as f:
+            return fcntl.fcntl(fd, F_SETPIPE_SZ, min(size, int(f.read())))
+    except (OSError, ValueError):
+        return None
+
+
+class RingBuffer:
+    """ Bounded ring buffer between a send stream and the uploader.
+
+    A reader thread fills preallocated slots straight from the pipe with
+    `readinto`. The uploader reads parts from the filled slots which are then
+    reused. Slot memory is copied exactly once, into the part buffer.
+    """
+
+    @property
+    def capacity(self):
+        """ Ring buffer size in bytes. """
+        return self._slot_size * self._slot_count
+
+    @property
+    def buffered(self):
+        """ Number of bytes waiting to be read. """
+        return self._buffered
+
+    @property
+    def fill_level(self):
+        """ Fraction of the ring buffer waiting to be read. """
+        return self._buffered / self.capacity
+
+    @property
+    def producer_waits(self):
+        """ Number of times the reader waited for a free slot. """
+        return self._producer_waits
+
+    @property
+    def consumer_waits(self):
+        """ Number of times the uploader waited for data. """
+        return self._consumer_waits
+
+    def __init__(self, stream, buffer_size=None, slot_size=None):
+        """ Create RingBuffer object.
+
+        Parameters
+        ----------
+        stream : file
+            Readable send stream.
+        buffer_size : int, default: 64 MiB
+            Ring buffer size in bytes.
+        slot_size : int, default: 4 MiB
+            Size of each ring buffer slot in bytes.
+
+        """
+        self._stream = stream
+        self._slot_size = slot_size or RING_BUFFER_SLOT_SIZE
+        self._slot_count = max(2, (buffer_size or RING_BUFFER_SIZE) //
+                               self._slot_size)
+
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for _ in range(self._slot_count):
+            self._free.put(memoryview(bytearray(self._slot_size)))
+
+        self._current = None
+        self._current_size = 0
+        self._offset = 0
+
+        self._buffered = 0
+        self._producer_waits = 0
+        self._consumer_waits = 0
+        self._error = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        """ Start reader thread. """
+        set_pipe_size(self._stream)
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        """ Read from ring buffer.
+
+        Blocks until size bytes are available or the stream has ended.
+        """
+        data = bytearray(max(size, 0))
+        view = memoryview(data)
+        position = 0
+
+        while size < 0 or position < size:
+            if self._current is None:
+                if self._filled.empty():
+                    self._consumer_waits += 1
+                item = self._filled.get()
+                if item is None:
+                    # keep end of stream marker for subsequent reads
+                    self._filled.put(None)
+                    if self._error:
+                        raise self._error
+                    break
+                self._current, self._current_size = item
+                self._offset = 0
+
+            amount = self._current_size - self._offset
+            if size >= 0:
+                amount = min(amount, size - position)
+
+            chunk = self._current[self._offset:self._offset + amount]
+            if size < 0:
+                view.release()
+                data += chunk
+                view = memoryview(data)
+            else:
+                view[position:position + amount] = chunk
+            position += amount
+            self._offset += amount
+
+            with self._lock:
+                self._buffered -= amount
+
+            # release slot as soon as it has been copied so that parts larger
+            # than the ring buffer don't block the reader thread
+            if self._offset == self._current_size:
+                self._free.put(self._current)
+                self._current = None
+
+        view.release()
+        if position < len(data):
+            del data[position:]
+
+        return data
+
+    def close(self):
+        """ Stop reader thread. """
+        self._closed = True
+
+    def _fill(self):
+        raw = getattr(self._stream, 'raw', self._stream)
+
+        try:
+            while not self._closed:
+                if self._free.empty():
+                    self._producer_waits += 1
+                slot = self._get_free_slot()
+                if slot is None:
+                    return
+
+                size = 0
+                while size < self._slot_size:
+                    n = raw.readinto(slot[size:])
+                    if not n:
+                        break
+                    size += n
+
+                if size:
+                    with self._lock:
+                        self._buffered += size
+                    self._filled.put((slot, size))
+
+                if size < self._slot_size:
+                    break
+        except (OSError, ValueError) as e:
+            self._error = e
+            _logger.error(f'msg="Reading send stream failed." error="{e}"')
+
+        self._filled.put(None)
+
+    def _get_free_slot(self):
+        while not self._closed:
+            try:
+                return self._free.get(timeout=1)
+            except queue.Empty:
+                pass
+        return None
+
+
+class ChecksumReader:
+    """ Readable stream computing the SHA-256 digest of the data read.
+
+    Seekable if the underlying stream is, so that seekable files are still
+    uploaded in parallel parts. Data is hashed in stream order, so bytes
+    read again after seeking back are only hashed once.
+    """
+
+    @property
+    def size(self):
+        """ Number of bytes hashed. """
+        return self._size
+
+    def __init__(self, fileobj):
+        """ Create ChecksumReader object.
+
+        Parameters
+        ----------
+        fileobj : file
+            Readable stream.
+
+        """
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._position = fileobj.tell() if fileobj.seekable() else 0
+        self._start = self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._fileobj.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._position = self._fileobj.seek(offset, whence)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        end = self._start + self._size
+        if self._position > end:
+            raise ValueError('ChecksumReader can only skip data that was '
+                             'already read.')
+        if self._position + len(data) > end:
+            self._hash.update(data[end - self._position:])
+            self._size += self._position + len(data) - end
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+    def hexdigest(self):
+        """ SHA-256 digest of the data read so far. """
+        return self._hash.hexdigest()
+
+
+class SendStreamVerifier:
+    """ Writable stream checking a send stream on its way through.
+
+    Computes the SHA-256 digest and keeps the first and last record so that
+    the framing of the stream can be checked without parsing every record.
+    Data is passed on to fileobj if set.
+    """
+
+    @property
+    def size(self):
+        """ Number of bytes written. """
+        return self._size
+
+    def __init__(self, fileobj=None):
+        """ Create SendStreamVerifier object.
+
+        Parameters
+        ----------
+        fileobj : file, optional
+            Writable stream receiving the data, e.g. `zfs receive` stdin.
+
+        """
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._head = b''
+        self._tail = b''
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        self._hash.update(data)
+        self._size += len(data)
+
+        if len(self._head) < DRR_RECORD_SIZE:
+            self._head += data[:DRR_RECORD_SIZE - len(self._head)]
+        self._tail = (self._tail + data[-DRR_RECORD_SIZE:])[-DRR_RECORD_SIZE:]
+
+        if self._fileobj is not None:
+            self._fileobj.write(data)
+        return len(data)
+
+    def flush(self):
+        if self._fileobj is not None:
+            self._fileobj.flush()
+
+    def hexdigest(self):
+        """ SHA-256 digest of the data written so far. """
+        return self._hash.hexdigest()
+
+    def check_structure(self):
+        """ Check that the stream starts and ends with a complete record.
+
+        Raises
+        ------
+        ValueError
+            If the stream is not a complete send stream.
+
+        """
+        if len(self._head) < DRR_RECORD_SIZE:
+            raise ValueError('Stream is shorter than one record.')
+
+        # records are written in the byte order of the sending host
+        for byte_order in '<>':
+            drr_type, = struct.unpack_from(f'{byte_order}I', self._head)
+            magic, = struct.unpack_from(f'{byte_order}Q', self._head, 8)
+            if drr_type == DRR_BEGIN and magic == DMU_BACKUP_MAGIC:
+                break
+        else:
+            raise ValueError('Stream does not start with a begin record.')
+
+        drr_type, payload_length = struct.unpack_from(f'{byte_order}II',
+                                                      self._tail)
+        if drr_type != DRR_END or payload_length != 0:
+            raise ValueError('Stream does not end with an end record. The '
+                             'stream is truncated.')
@@ -0,0 +1,92 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """ Token bucket shared by many threads.
+
+    Callers take the tokens they need up front and sleep off any debt, so
+    that large and small chunks are limited fairly without a queue.
+    """
+
+    @property
+    def rate(self):
+        """ Rate limit in bytes per second. """
+        return self._rate
+
+    def __init__(self, rate, burst=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        """ Create RateLimiter object.
+
+        Parameters
+        ----------
+        rate : float
+            Rate limit in bytes per second.
+        burst : float, optional
+            Number of bytes that can be taken at once without waiting.
+            Defaults to one second worth of bytes.
+        clock : callable, default: time.monotonic
+        sleep : callable, default: time.sleep
+
+        """
+        if rate <= 0:
+            raise ValueError('Rate must be greater than 0.')
+
+        self._rate = rate
+        self._burst = burst or rate
+        self._clock = clock
+        self._sleep = sleep
+
+        self._tokens = self._burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount):
+        """ Wait until amount bytes may be transferred.
+
+        Parameters
+        ----------
+        amount : int
+            Number of bytes.
+
+        Returns
+        -------
+        float
+            Number of seconds waited.
+
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class ThrottledWriter:
+    """ Writable stream limited by a shared rate limiter. """
+
+    def __init__(self, fileobj, rate_limiter):
+        """ Create ThrottledWriter object.
+
+        Parameters
+        ----------
+        fileobj : file
+            Writable stream.
+        rate_limiter : RateLimiter
+
+        """
+        self._fileobj = fileobj
+        self._rate_limiter = rate_limiter
+
+    def write(self, data):
+        self._rate_limiter.acquire(len(data))
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
@@ -0,0 +1,364 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import os
+import threading
+import time
+
+_exporters = []
+_exporters_lock = threading.Lock()
+
+
+# context variables are separate per thread and per asyncio task
+_current = ContextVar('zfs_uploader_span', default=None)
+
+
+class Span:
+    """ Timing span of a job phase.
+
+    Spans nest per thread and per asyncio task. Bytes and subprocesses are
+    added to the current span and all of its parents.
+    """
+
+    @property
+    def name(self):
+        """ Span name. """
+        return self._name
+
+    @property
+    def trace_id(self):
+        """ Trace ID shared by the span and its parents. """
+        return self._trace_id
+
+    @property
+    def span_id(self):
+        """ Span ID. """
+        return self._span_id
+
+    @property
+    def parent(self):
+        """ Parent span. """
+        return self._parent
+
+    @property
+    def attributes(self):
+        """ Span attributes. """
+        return self._attributes
+
+    @property
+    def start_time(self):
+        """ Unix time the span started at. """
+        return self._start_time
+
+    @property
+    def end_time(self):
+        """ Unix time the span ended at. """
+        return self._end_time
+
+    @property
+    def duration(self):
+        """ Duration in seconds. """
+        if self._end_time is None:
+            return time.monotonic() - self._start_monotonic
+        return self._end_monotonic - self._start_monotonic
+
+    @property
+    def bytes(self):
+        """ Number of bytes transferred during the span. """
+        return self._bytes
+
+    @property
+    def subprocesses(self):
+        """ Number of subprocesses started during the span. """
+        return self._subprocesses
+
+    @property
+    def error(self):
+        """ Error that ended the span. """
+        return self._error
+
+    def __init__(self, name, parent=None, **attributes):
+        """ Create Span object.
+
+        Parameters
+        ----------
+        name : str
+            Span name. Such as the job phase.
+        parent : Span, optional
+            Parent span.
+        attributes : dict
+            Span attributes. Such as the filesystem.
+
+        """
+        self._name = name
+        self._parent = parent
+        self._trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self._span_id = os.urandom(8).hex()
+        self._attributes = attributes
+
+        self._start_time = time.time()
+        self._start_monotonic = time.monotonic()
+        self._end_time = None
+        self._end_monotonic = None
+        self._bytes = 0
+        self._subprocesses = 0
+        self._error = None
+        self._lock = threading.Lock()
+        self.context = {}
+
+    def set_attribute(self, key, value):
+        """ Set span attribute. """
+        self._attributes[key] = value
+
+    def add_bytes(self, amount):
+        """ Add transferred bytes to the span and its parents. """
+        span = self
+        while span:
+            with span._lock: # noqa
+                span._bytes += amount # noqa
+            span = span.parent
+
+    def add_subprocess(self):
+        """ Add started subprocess to the span and its parents. """
+        span = self
+        while span:
+            with span._lock: # noqa
+                span._subprocesses += 1 # noqa
+            span = span.parent
+
+    def end(self, error=None):
+        """ End span. """
+        self._end_time = time.time()
+        self._end_monotonic = time.monotonic()
+        if error is not None:
+            self._error = f'{type(error).__name__}: {error}'
+
+    def to_dict(self):
+        """ Get span as JSON serializable dictionary. """
+        return {
+            'name': self._name,
+            'trace_id': self._trace_id,
+            'span_id': self._span_id,
+            'parent_id': self._parent.span_id if self._parent else None,
+            'start': self._start_time,
+            'end': self._end_time,
+            'duration': self.duration,
+            'bytes': self._bytes,
+            'subprocesses': self._subprocesses,
+            'error': self._error,
+            'attributes': self._attributes
+        }
+
+
+class SpanExporter:
+    """ Baseclass for span exporters. """
+
+    def on_start(self, span):
+        """ Called when a span starts. """
+
+    def on_end(self, span):
+        """ Called when a span ends. """
+
+    def shutdown(self):
+        """ Flush and close exporter. """
+
+
+class JSONExporter(SpanExporter):
+    """ Write finished spans as JSON lines.
+
+    Spans are written to the `zfs_uploader.tracing` logger at debug level if
+    no file path is provided.
+    """
+
+    def __init__(self, file_path=None):
+        """ Create JSONExporter object.
+
+        Parameters
+        ----------
+        file_path : str, optional
+            JSON lines file the spans are appended to.
+
+        """
+        self._file_path = file_path
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def on_end(self, span):
+        record = json.dumps(span.to_dict(), default=str)
+        if self._file_path is None:
+            self._logger.debug(record)
+            return
+
+        with self._lock:
+            with open(self._file_path, 'a') as f:
+                f.write(record + '\n')
+
+
+class OpenTelemetryExporter(SpanExporter):
+    """ Export spans to an OpenTelemetry collector over OTLP.
+
+    Requires the `opentelemetry-sdk` and `opentelemetry-exporter-otlp`
+    packages.
+    """
+
+    def __init__(self, endpoint=None, service_name='zfs_uploader'):
+        """ Create OpenTelemetryExporter object.
+
+        Parameters
+        ----------
+        endpoint : str, optional
+            OTLP gRPC endpoint. Defaults to the `OTEL_EXPORTER_OTLP_ENDPOINT`
+            environment variable or `http://localhost:4317`.
+        service_name : str, default: zfs_uploader
+            Service name of the exported spans.
+
+        """
+        try:
+            from opentelemetry import trace
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter # noqa
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError:
+            raise ImportError('OpenTelemetry export requires the '
+                              'opentelemetry-sdk and '
+                              'opentelemetry-exporter-otlp packages.')
+
+        self._trace = trace
+        self._provider = TracerProvider(
+            resource=Resource.create({'service.name': service_name}))
+        self._provider.add_span_processor(
+            BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        self._tracer = self._provider.get_tracer(__name__)
+
+    def on_start(self, span):
+        context = None
+        if span.parent and 'otel' in span.parent.context:
+            context = self._trace.set_span_in_context(
+                span.parent.context['otel'])
+
+        span.context['otel'] = self._tracer.start_span(
+            span.name, context=context,
+            start_time=int(span.start_time * 1e9))
+
+    def on_end(self, span):
+        otel_span = span.context.pop('otel', None)
+        if otel_span is None:
+            return
+
+        for key, value in span.attributes.items():
+            if value is not None:
+                otel_span.set_attribute(key, value)
+        otel_span.set_attribute('bytes', span.bytes)
+        otel_span.set_attribute('subprocesses', span.subprocesses)
+        if span.error:
+            otel_span.set_status(self._trace.Status(
+                self._trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+    def shutdown(self):
+        self._provider.shutdown()
+
+
+def add_exporter(exporter):
+    """ Add span exporter.
+
+    Parameters
+    ----------
+    exporter : SpanExporter
+
+    """
+    with _exporters_lock:
+        _exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    """ Remove span exporter. """
+    with _exporters_lock:
+        _exporters.remove(exporter)
+
+
+def shutdown():
+    """ Flush and remove all span exporters. """
+    with _exporters_lock:
+        exporters = list(_exporters)
+        _exporters.clear()
+
+    for exporter in exporters:
+        exporter.shutdown()
+
+
+def current_span():
+    """ Get the current span of this thread or asyncio task.
+
+    Returns
+    -------
+    Span
+        None is returned if no span is active.
+
+    """
+    return _current.get()
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """ Time the enclosed block as a span.
+
+    Parameters
+    ----------
+    name : str
+        Span name.
+    parent : Span, optional
+        Parent span. Defaults to the current span of this thread or asyncio
+        task. Used for continuing a trace in another thread.
+    attributes : dict
+        Span attributes.
+
+    Yields
+    ------
+    Span
+
+    """
+    parent = parent or current_span()
+    s = Span(name, parent, **attributes)
+    _notify('on_start', s)
+
+    previous = current_span()
+    _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.end(e)
+        raise
+    else:
+        s.end()
+    finally:
+        _current.set(previous)
+        _notify('on_end', s)
+
+
+def add_bytes(amount):
+    """ Count transferred bytes in the current span. """
+    s = current_span()
+    if s:
+        s.add_bytes(amount)
+
+
+def add_subprocess():
+    """ Count a started subprocess in the current span. """
+    s = current_span()
+    if s:
+        s.add_subprocess()
+
+
+def _notify(method, s):
+    with _exporters_lock:
+        exporters = list(_exporters)
+
+    for exporter in exporters:
+        try:
+            getattr(exporter, method)(s)
+        except Exception as e:
+            logging.getLogger(__name__).warning(
+                f'span={s.name} msg="Span export failed." error="{e}"')
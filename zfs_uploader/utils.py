@@ -36,3 +36,22 @@ def derive_s3_key(object_name, filesystem, prefix=None):
     if prefix is not None:
         s3_key = f'{prefix}/{s3_key}'
     return s3_key
+
+
+def is_write_conflict(error):
+    """
+    Check if a conditional S3 write failed.
+
+    Parameters
+    ----------
+    error : ClientError
+      Error raised by a write with `IfMatch` or `IfNoneMatch`.
+
+    Returns
+    -------
+    bool
+      True if the object was changed or created by someone else.
+
+    """
+    code = error.response.get('Error', {}).get('Code')
+    return code in ('PreconditionFailed', 'ConditionalRequestConflict')
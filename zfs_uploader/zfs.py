@@ -1,18 +1,34 @@
 import subprocess
 
+from zfs_uploader.tracing import add_subprocess
+
 SUBPROCESS_KWARGS = dict(stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE,
                          encoding='utf-8')
+# `zfs send` flags of each send profile
+SEND_PROFILES = {
+    'raw': ('--raw',),
+    'compressed': ('--large-block', '--embed', '--compressed'),
+    'large_block': ('--large-block', '--embed'),
+    'plain': ()
+}
+DEFAULT_SEND_PROFILE = 'raw'
 
 
 class ZFSError(Exception):
     """ Baseclass for ZFS exceptions. """
 
 
-def list_snapshots():
-    """ List snapshots. """
-    cmd = ['zfs', 'list', '-p', '-t', 'snapshot']
-    out = subprocess.run(cmd, **SUBPROCESS_KWARGS)
+def list_snapshots(filesystems=None):
+    """ List snapshots.
+
+    Only snapshots of the given filesystems are listed if filesystems is
+    set. Otherwise all snapshots are listed.
+    """
+    cmd = ['zfs', 'list', '-p', '-t', 'snapshot', '-s', 'createtxg']
+    if filesystems:
+        cmd += ['-d', '1'] + list(filesystems)
+    out = _run(cmd)
 
     lines = out.stdout.splitlines()
     snapshots = {}
@@ -28,81 +44,299 @@ def list_snapshots():
     return snapshots
 
 
-def create_snapshot(filesystem, snapshot_name):
+def list_filesystems(filesystem):
+    """ List filesystem and descendant filesystems. """
+    cmd = ['zfs', 'list', '-H', '-o', 'name', '-t', 'filesystem', '-r',
+           filesystem]
+    out = _run(cmd)
+    return out.stdout.splitlines()
+
+
+def create_snapshot(filesystem, snapshot_name, recursive=False):
     """ Create filesystem snapshot. """
-    cmd = ['zfs', 'snapshot', f'{filesystem}@{snapshot_name}']
-    return subprocess.run(cmd, **SUBPROCESS_KWARGS)
+    cmd = ['zfs', 'snapshot'] + _recursive_flag(recursive)
+    cmd.append(f'{filesystem}@{snapshot_name}')
+    return _run(cmd)
+
+
+def create_snapshots(filesystems, snapshot_name, recursive=False):
+    """ Create snapshot of multiple filesystems atomically. """
+    cmd = ['zfs', 'snapshot'] + _recursive_flag(recursive)
+    cmd.extend(f'{filesystem}@{snapshot_name}' for filesystem in filesystems)
+    return _run(cmd)
 
 
 def create_filesystem(filesystem):
     """ Create filesystem. """
     cmd = ['zfs', 'create', filesystem]
-    return subprocess.run(cmd, **SUBPROCESS_KWARGS)
+    return _run(cmd)
 
 
-def destroy_snapshot(filesystem, snapshot_name):
+def destroy_snapshot(filesystem, snapshot_name, recursive=False):
     """ Destroy filesystem snapshot. """
-    cmd = ['zfs', 'destroy', f'{filesystem}@{snapshot_name}']
-    return subprocess.run(cmd, **SUBPROCESS_KWARGS)
+    cmd = ['zfs', 'destroy'] + _recursive_flag(recursive)
+    cmd.append(f'{filesystem}@{snapshot_name}')
+    return _run(cmd)
+
+
+def destroy_snapshots(filesystem, snapshot_names, recursive=False):
+    """ Destroy multiple filesystem snapshots with one command. """
+    cmd = ['zfs', 'destroy'] + _recursive_flag(recursive)
+    cmd.append(f'{filesystem}@{",".join(snapshot_names)}')
+    return _run(cmd)
 
 
 def destroy_filesystem(filesystem):
     """ Destroy filesystem and filesystem snapshots. """
     cmd = ['zfs', 'destroy', '-r', filesystem]
-    return subprocess.run(cmd, **SUBPROCESS_KWARGS)
+    return _run(cmd)
 
 
 def mount_filesystem(filesystem):
     """ Mount filesystem. """
     cmd = ['zfs', 'mount', filesystem]
-    return subprocess.run(cmd, **SUBPROCESS_KWARGS)
+    return _run(cmd)
+
+
+def rename_filesystem(filesystem, new_filesystem):
+    """ Rename filesystem. """
+    cmd = ['zfs', 'rename', filesystem, new_filesystem]
+    return _run(cmd)
 
 
 def rollback_filesystem(filesystem, snapshot_name):
     """ Rollback filesystem. """
     cmd = ['zfs', 'rollback', '-r', f'{filesystem}@{snapshot_name}']
-    return subprocess.run(cmd, **SUBPROCESS_KWARGS)
+    return _run(cmd)
+
 
+def get_snapshot_send_size(filesystem, snapshot_name, recursive=False,
+                           send_profile=None):
+    cmd = ['zfs', 'send'] + _send_flags(send_profile)
+    cmd += ['--parsable', '--dryrun'] + _replicate_flag(recursive)
+    cmd.append(f'{filesystem}@{snapshot_name}')
+    out = _run(cmd)
+    return _parse_send_size(out.stdout)
 
-def get_snapshot_send_size(filesystem, snapshot_name):
-    cmd = ['zfs', 'send', '--raw', '--parsable', '--dryrun',
-           f'{filesystem}@{snapshot_name}']
-    out = subprocess.run(cmd, **SUBPROCESS_KWARGS)
-    return out.stdout.splitlines()[1].split()[1]
 
+def get_snapshot_send_size_inc(filesystem, snapshot_name_1, snapshot_name_2,
+                               recursive=False, intermediate=False,
+                               send_profile=None):
+    cmd = ['zfs', 'send'] + _send_flags(send_profile)
+    cmd += ['--parsable', '--dryrun'] + _replicate_flag(recursive)
+    cmd += [_incremental_flag(recursive or intermediate),
+            f'{filesystem}@{snapshot_name_1}',
+            f'{filesystem}@{snapshot_name_2}']
+    out = _run(cmd)
+    return _parse_send_size(out.stdout)
 
-def get_snapshot_send_size_inc(filesystem, snapshot_name_1, snapshot_name_2):
-    cmd = ['zfs', 'send', '--raw', '--parsable', '--dryrun', '-i',
-           f'{filesystem}@{snapshot_name_1}',
-           f'{filesystem}@{snapshot_name_2}']
-    out = subprocess.run(cmd, **SUBPROCESS_KWARGS)
-    return out.stdout.splitlines()[1].split()[1]
 
+def is_send_profile_compatible(send_profile, base_send_profile):
+    """ Check if an incremental stream can be sent on top of a backup.
 
-def open_snapshot_stream(filesystem, snapshot_name, mode):
-    """ Open snapshot stream. """
+    `zfs receive` rejects incremental streams that don't match the raw and
+    large block features of the previously received stream. Unknown send
+    profiles, e.g. of backups made by a newer version, are incompatible.
+
+    Parameters
+    ----------
+    send_profile : str
+        Send profile of the incremental stream.
+    base_send_profile : str
+        Send profile of the backup the stream is received on top of.
+
+    Returns
+    -------
+    bool
+
+    """
+    for profile in (send_profile, base_send_profile):
+        if (profile or DEFAULT_SEND_PROFILE) not in SEND_PROFILES:
+            return False
+
+    return _send_features(send_profile) == _send_features(base_send_profile)
+
+
+def open_snapshot_stream(filesystem, snapshot_name, mode, recursive=False,
+                         mount=True, intermediate=False, send_profile=None):
+    """ Open snapshot stream.
+
+    Replication streams of a filesystem and its descendants are sent if
+    recursive is set. Replication streams and streams with intermediate
+    snapshots are received into the filesystem rather than the snapshot.
+    Received filesystems are left unmounted if mount is not set. Streams
+    are sent with the flags of the send profile.
+    """
     if mode == 'r':
-        cmd = ['zfs', 'send', '--raw', f'{filesystem}@{snapshot_name}']
-        return subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+        cmd = _send_cmd(filesystem, snapshot_name, recursive, send_profile)
+        return _popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     elif mode == 'w':
-        cmd = ['zfs', 'receive', f'{filesystem}@{snapshot_name}']
-        return subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+        cmd = ['zfs', 'receive'] + ([] if mount else ['-u'])
+        if recursive or intermediate:
+            cmd.append(filesystem)
+        else:
+            cmd.append(f'{filesystem}@{snapshot_name}')
+        return _popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE)
     else:
         raise ValueError('Mode must be r or w')
 
 
-def open_snapshot_stream_inc(filesystem, snapshot_name_1, snapshot_name_2):
-    """ Open incremental snapshot read stream. """
-    cmd = ['zfs', 'send', '--raw', '-i', f'{filesystem}@{snapshot_name_1}',
-           f'{filesystem}@{snapshot_name_2}']
-    return subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
+def open_receive_check(filesystem, snapshot_name, recursive=False,
+                       intermediate=False):
+    """ Open `zfs receive --dryrun` stream.
+
+    The stream is read and checked by `zfs receive` but nothing is received.
+    """
+    cmd = ['zfs', 'receive', '-n']
+    if recursive or intermediate:
+        cmd.append(filesystem)
+    else:
+        cmd.append(f'{filesystem}@{snapshot_name}')
+    return _popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE)
+
+
+def open_snapshot_stream_inc(filesystem, snapshot_name_1, snapshot_name_2,
+                             recursive=False, intermediate=False,
+                             send_profile=None):
+    """ Open incremental snapshot read stream.
+
+    All snapshots between the two snapshots are included if intermediate is
+    set.
+    """
+    cmd = _send_inc_cmd(filesystem, snapshot_name_1, snapshot_name_2,
+                        recursive, intermediate, send_profile)
+    return _popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+async def open_snapshot_stream_async(filesystem, snapshot_name,
+                                     recursive=False, send_profile=None):
+    """ Open snapshot read stream on the running event loop.
+
+    Returns an `asyncio.subprocess.Process`.
+    """
+    cmd = _send_cmd(filesystem, snapshot_name, recursive, send_profile)
+    return await _popen_async(cmd)
+
+
+async def open_snapshot_stream_inc_async(filesystem, snapshot_name_1,
+                                         snapshot_name_2, recursive=False,
+                                         intermediate=False,
+                                         send_profile=None):
+    """ Open incremental snapshot read stream on the running event loop.
+
+    Returns an `asyncio.subprocess.Process`.
+    """
+    cmd = _send_inc_cmd(filesystem, snapshot_name_1, snapshot_name_2,
+                        recursive, intermediate, send_profile)
+    return await _popen_async(cmd)
+
+
+def get_receive_resume_token(filesystem):
+    """ Get resume token of a partially received stream.
+
+    Returns None if there is no partially received stream.
+    """
+    cmd = ['zfs', 'get', '-H', '-o', 'value', 'receive_resume_token',
+           filesystem]
+    out = _run(cmd)
+    token = out.stdout.strip()
+    if out.returncode or token in ('', '-'):
+        return None
+    return token
+
+
+def abort_receive(filesystem):
+    """ Discard partially received stream. """
+    cmd = ['zfs', 'receive', '-A', filesystem]
+    return _run(cmd)
+
+
+def run_channel_program(pool, script_path, args, sync=True,
+                        instruction_limit=None, memory_limit=None):
+    """ Run channel program with JSON output. """
+    cmd = ['zfs', 'program', '-j']
+    if instruction_limit:
+        cmd += ['-t', str(instruction_limit)]
+    if memory_limit:
+        cmd += ['-m', str(memory_limit)]
+    if not sync:
+        cmd.append('-n')
+    cmd += [pool, script_path] + list(args)
+    return _run(cmd)
 
 
 def load_key(filesystem, keylocation):
     """ Load encryption key. """
     cmd = ['zfs', 'load-key', '-L', keylocation, filesystem]
+    return _run(cmd)
+
+
+def _run(cmd):
+    add_subprocess()
     return subprocess.run(cmd, **SUBPROCESS_KWARGS)
+
+
+def _popen(cmd, **kwargs):
+    add_subprocess()
+    return subprocess.Popen(cmd, **kwargs)
+
+
+async def _popen_async(cmd):
+    import asyncio
+
+    add_subprocess()
+    return await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+
+def _send_cmd(filesystem, snapshot_name, recursive, send_profile=None):
+    cmd = ['zfs', 'send'] + _send_flags(send_profile)
+    cmd += _replicate_flag(recursive)
+    cmd.append(f'{filesystem}@{snapshot_name}')
+    return cmd
+
+
+def _send_inc_cmd(filesystem, snapshot_name_1, snapshot_name_2, recursive,
+                  intermediate, send_profile=None):
+    cmd = ['zfs', 'send'] + _send_flags(send_profile)
+    cmd += _replicate_flag(recursive)
+    cmd += [_incremental_flag(recursive or intermediate),
+            f'{filesystem}@{snapshot_name_1}',
+            f'{filesystem}@{snapshot_name_2}']
+    return cmd
+
+
+def _send_flags(send_profile):
+    return list(SEND_PROFILES[send_profile or DEFAULT_SEND_PROFILE])
+
+
+def _send_features(send_profile):
+    """ Get the stream features that incremental streams must match. """
+    flags = _send_flags(send_profile)
+    # raw streams always keep large blocks
+    raw = '--raw' in flags
+    return raw, raw or '--large-block' in flags
+
+
+def _recursive_flag(recursive):
+    return ['-r'] if recursive else []
+
+
+def _replicate_flag(recursive):
+    return ['-R'] if recursive else []
+
+
+def _incremental_flag(intermediate):
+    # replication streams include the intermediate snapshots of descendants
+    return '-I' if intermediate else '-i'
+
+
+def _parse_send_size(stdout):
+    """ Parse total size from `zfs send --parsable --dryrun` output. """
+    for line in reversed(stdout.splitlines()):
+        values = line.split()
+        if values and values[0] == 'size':
+            return values[1]
+    raise ZFSError(f'Unable to parse send size: {stdout}')